@@ -2,76 +2,383 @@ from logger_utils import log, set_logging
 import sqlalchemy
 import pandas as pd
 from format_utils import sanitize_for_pandas, pandas_time_to_str, format_datetime_for_sqlserver
+from metrics_utils import metrics
 import time
 
 
 # --- Implementación mejorada con gestión de conexiones ---
-import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from threading import Lock
+from contextlib import contextmanager
+from threading import Condition, Event, RLock, Lock, Thread
 from typing import Optional, Dict
 
 class ConnectionPool:
-    """Pool de conexiones para mantener y reutilizar conexiones activas."""
+    """
+    Pool de conexiones por llave (artefacto) para mantener y reutilizar conexiones activas.
+
+    Cada llave tiene entre `min_connections` y `max_connections` conexiones. Si todas están en
+    uso, `get_connection` espera hasta `acquire_timeout` segundos a que se libere una; los que
+    esperan se atienden en orden de llegada (FIFO). Antes de entregar una conexión reutilizada se
+    valida con `validate_fn` (local, sin ida al servidor) o, si estuvo libre más de `ping_after`
+    segundos, con `ping_fn` (`SELECT 1`); las inválidas o expiradas se cierran y se reemplazan.
+    `prewarm` crea por adelantado las conexiones de la concurrencia esperada.
+
+    El lock sólo protege la contabilidad del pool: el login (`connection_factory`), la validación
+    y el cierre de conexiones ocurren fuera de él. Mientras se crea una conexión su cupo queda
+    reservado, así un login lento no detiene a los hilos que piden otra llave o que pueden tomar
+    una conexión libre. Las conexiones libres expiradas las cierra un hilo en segundo plano cada
+    `reap_interval` segundos (None para no iniciarlo).
+
+    `stats` acumula solicitudes, reutilizaciones, creaciones, fallas y los tiempos de espera y de
+    login; `get_stats` agrega el estado actual y los promedios.
+    """
     
-    def __init__(self, max_connections=5, connection_timeout=300):
-        self.connections: Dict[str, Dict] = {}  # {connection_key: {connection, last_used, in_use}}
-        self.max_connections = max_connections
+    def __init__(self, max_connections=5, connection_timeout=300, min_connections=0, acquire_timeout=30, validate_fn=None, reap_interval=60,
+                 ping_after=30, ping_fn=None):
+        self.connections: Dict[str, Dict] = {}  # {connection_key: {idle: deque[(connection, last_used)], in_use, creating, waiters}}
+        self.max_connections = max_connections  # por llave
+        self.min_connections = min_connections
         self.connection_timeout = connection_timeout  # en segundos
-        self.lock = Lock()
+        self.acquire_timeout = acquire_timeout
+        self.validate_fn = validate_fn or _is_connection_open
+        self.ping_after = ping_after  # en segundos libre
+        self.ping_fn = ping_fn or _ping_connection
+        self.stats = {
+            'total_requests': 0,
+            'successful_connections': 0,
+            'failed_connections': 0,
+            'connection_reuse': 0,
+            'connections_created': 0,
+            'creation_failures': 0,
+            'acquire_timeouts': 0,
+            'validation_failures': 0,
+            'expired_closed': 0,
+            'prewarmed': 0,
+            'wait_seconds': 0.0,
+            'create_seconds': 0.0,
+        }
+        self.lock = RLock()
+        self.available = Condition(self.lock)
+        self._stop_reaper = Event()
+        self._reaper = None
+        if reap_interval:
+            self._reaper = Thread(target=self._reap, args=(reap_interval,), name="ConnectionPoolReaper", daemon=True)
+            self._reaper.start()
+
+    def _key_pool(self, connection_key):
+        if connection_key not in self.connections:
+            # `in_use` incluye los cupos reservados para conexiones que se están creando (`creating`)
+            self.connections[connection_key] = {'idle': deque(), 'in_use': 0, 'creating': 0, 'waiters': deque()}
+        return self.connections[connection_key]
         
-    def get_connection(self, connection_key: str, connection_factory) -> Optional[object]:
-        """Obtiene una conexión del pool o crea una nueva si es necesario."""
+    def get_connection(self, connection_key: str, connection_factory, timeout: Optional[float] = None) -> Optional[object]:
+        """
+        Obtiene una conexión del pool o crea una nueva si hay cupo; si no, espera a que otra se
+        libere. Retorna None si se agota el tiempo de espera o no se pudo crear la conexión.
+        """
+        start = time.time()
+        deadline = start + (self.acquire_timeout if timeout is None else timeout)
+        reserved, connection, last_used = self._reserve(connection_key, deadline)
+        wait_seconds = time.time() - start
+        metrics.observe("pool_wait_seconds", wait_seconds, pool=connection_key)
+        self._record(total_requests=1, wait_seconds=wait_seconds)
+        if not reserved:
+            self._record(failed_connections=1, acquire_timeouts=1)
+            return None
+
+        if connection is not None:
+            # Ping al servidor sólo si estuvo libre mucho tiempo (firewalls / timeouts de sesión)
+            is_valid = self.ping_fn if time.time() - last_used >= self.ping_after else self.validate_fn
+            if is_valid(connection):
+                self._record(successful_connections=1, connection_reuse=1)
+                log(f"✅ Reutilizando conexión existente para {connection_key}", level="debug")
+                return connection
+            # Inválida: se cierra y se crea otra con el mismo cupo
+            _close_connection(connection)
+            log(f"🧹 Conexión inválida descartada para {connection_key}", level="info")
+            with self.lock:
+                self.connections[connection_key]['creating'] += 1
+                self.stats['validation_failures'] += 1
+
+        connection = self._create(connection_key, connection_factory)
+        self._record(**({'successful_connections': 1} if connection else {'failed_connections': 1}))
+        return connection
+
+    def _record(self, **increments):
         with self.lock:
-            # Limpiar conexiones expiradas
-            self._cleanup_expired_connections()
-            
-            # Verificar si existe una conexión disponible
-            if connection_key in self.connections:
-                conn_info = self.connections[connection_key]
-                if not conn_info['in_use'] and not self._is_expired(conn_info['last_used']):
-                    conn_info['in_use'] = True
-                    conn_info['last_used'] = time.time()
-                    log(f"✅ Reutilizando conexión existente para {connection_key}", level="info")
-                    return conn_info['connection']
-            
-            # Si no hay conexiones disponibles y no excedemos el límite, crear nueva
-            if len(self.connections) < self.max_connections:
-                connection = connection_factory()
-                if connection:
-                    self.connections[connection_key] = {
-                        'connection': connection,
-                        'last_used': time.time(),
-                        'in_use': True
-                    }
-                    log(f"✅ Nueva conexión creada para {connection_key}", level="info")
-                    return connection
-            
-            log(f"❌ No se pudo obtener conexión para {connection_key}. Pool lleno.", level="error")
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def _reserve(self, connection_key, deadline):
+        """
+        Espera su turno (FIFO) y reserva un cupo de la llave. Retorna (True, conexión libre, último
+        uso) para reutilizar, (True, None, None) si hay que crear la conexión y (False, None, None)
+        si se agotó la espera.
+        """
+        ticket = object()
+        expired = []
+        try:
+            with self.lock:
+                pool = self._key_pool(connection_key)
+                pool['waiters'].append(ticket)
+                try:
+                    while True:
+                        # Sólo el primero de la fila puede tomar una conexión (FIFO)
+                        if pool['waiters'][0] is ticket:
+                            # Verificar si existe una conexión disponible (la más reciente, aún "caliente")
+                            while pool['idle']:
+                                connection, last_used = pool['idle'].pop()
+                                if self._is_expired(last_used):
+                                    expired.append(connection)
+                                    continue
+                                pool['in_use'] += 1
+                                return True, connection, last_used
+
+                            # Si no hay conexiones disponibles y no excedemos el límite, reservar el cupo
+                            if pool['in_use'] < self.max_connections:
+                                pool['in_use'] += 1
+                                pool['creating'] += 1
+                                return True, None, None
+
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            log(f"❌ No se pudo obtener conexión para {connection_key}. Pool lleno "
+                                f"({pool['in_use']}/{self.max_connections} en uso, {pool['creating']} creándose, "
+                                f"{len(pool['waiters'])} en espera).", level="error")
+                            return False, None, None
+                        self.available.wait(remaining)
+                finally:
+                    pool['waiters'].remove(ticket)
+                    # El siguiente de la fila puede tener su turno
+                    self.available.notify_all()
+                    self.stats['expired_closed'] += len(expired)
+        finally:
+            for connection in expired:
+                _close_connection(connection)
+                log(f"🧹 Conexión expirada eliminada para {connection_key}", level="info")
+
+    def _create(self, connection_key, connection_factory):
+        """Crea la conexión fuera del lock sobre un cupo ya reservado; si falla, libera el cupo."""
+        connection = None
+        start = time.time()
+        try:
+            connection = connection_factory()
+        except Exception as e:
+            log(f"❌ Error al crear la conexión para {connection_key}: {e}", level="error")
+        create_seconds = time.time() - start
+        metrics.observe("connection_create_seconds", create_seconds, pool=connection_key)
+        with self.lock:
+            pool = self.connections[connection_key]
+            pool['creating'] -= 1
+            if connection:
+                self.stats['connections_created'] += 1
+                self.stats['create_seconds'] += create_seconds
+            else:
+                self.stats['creation_failures'] += 1
+                pool['in_use'] -= 1
+                self.available.notify_all()
+            in_use = pool['in_use']
+        if not connection:
+            metrics.inc("connection_failures_total", pool=connection_key)
+            log(f"❌ No se pudo crear la conexión para {connection_key}", level="error")
             return None
+        log(f"✅ Nueva conexión creada para {connection_key} en {create_seconds:.1f}s ({in_use}/{self.max_connections} en uso)", level="info")
+        return connection
+
+    def prewarm(self, connection_key: str, connection_factory, count: int) -> int:
+        """
+        Crea en paralelo (fuera del lock) las conexiones que faltan para tener `count` en la llave
+        (hasta `max_connections`) y las deja libres en el pool. Retorna cuántas se crearon.
+        """
+        with self.lock:
+            pool = self._key_pool(connection_key)
+            missing = max(0, min(count, self.max_connections) - len(pool['idle']) - pool['in_use'])
+            pool['in_use'] += missing
+            pool['creating'] += missing
+        if not missing:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=missing, thread_name_prefix="ConnectionPrewarm") as executor:
+            connections = list(executor.map(lambda _: self._create(connection_key, connection_factory), range(missing)))
+        created = [connection for connection in connections if connection]
+        for connection in created:
+            self.release_connection(connection_key, connection)
+        self._record(prewarmed=len(created))
+        log(f"🔥 Pool precalentado para {connection_key}: {len(created)}/{missing} conexiones nuevas", level="info")
+        return len(created)
     
-    def release_connection(self, connection_key: str):
-        """Libera una conexión para que pueda ser reutilizada."""
+    def release_connection(self, connection_key: str, connection=None):
+        """Devuelve una conexión al pool para que pueda ser reutilizada."""
         with self.lock:
-            if connection_key in self.connections:
-                self.connections[connection_key]['in_use'] = False
-                self.connections[connection_key]['last_used'] = time.time()
-                log(f"✅ Conexión liberada para {connection_key}", level="info")
+            pool = self.connections.get(connection_key)
+            if pool is None or pool['in_use'] == 0:
+                return
+            pool['in_use'] -= 1
+            if connection is not None:
+                pool['idle'].append((connection, time.time()))
+            self.available.notify_all()
+        log(f"✅ Conexión liberada para {connection_key}", level="debug")
+
+    @contextmanager
+    def acquire_connection_context(self, connection_key: str, connection_factory, wait_for: Optional[float] = None):
+        """
+        Préstamo de una conexión para el bloque `with`: entrega la conexión (o None si no se pudo
+        obtener en `wait_for` segundos) y la devuelve al pool al salir, aun si el bloque falla.
+        """
+        connection = self.get_connection(connection_key, connection_factory, timeout=wait_for)
+        try:
+            yield connection
+        finally:
+            if connection is not None:
+                self.release_connection(connection_key, connection)
     
     def _is_expired(self, last_used: float) -> bool:
         """Verifica si una conexión ha expirado."""
         return (time.time() - last_used) > self.connection_timeout
     
     def _cleanup_expired_connections(self):
-        """Elimina las conexiones expiradas del pool."""
-        current_time = time.time()
-        expired_keys = [
-            key for key, info in self.connections.items()
-            if self._is_expired(info['last_used'])
-        ]
-        for key in expired_keys:
-            del self.connections[key]
+        """Cierra las conexiones libres expiradas (conservando `min_connections` por llave). Retorna cuántas cerró."""
+        expired = []
+        with self.lock:
+            for key, pool in self.connections.items():
+                keep = deque()
+                for connection, last_used in pool['idle']:
+                    if self._is_expired(last_used) and len(keep) + pool['in_use'] >= self.min_connections:
+                        expired.append((key, connection))
+                    else:
+                        keep.append((connection, last_used))
+                pool['idle'] = keep
+            self.stats['expired_closed'] += len(expired)
+        for key, connection in expired:
+            _close_connection(connection)
             log(f"🧹 Conexión expirada eliminada para {key}", level="info")
+        return len(expired)
+
+    def _reap(self, interval):
+        while not self._stop_reaper.wait(interval):
+            try:
+                self._cleanup_expired_connections()
+            except Exception as e:
+                log(f"❌ Error al limpiar conexiones expiradas: {e}", level="error")
+
+    def get_stats(self):
+        """Contadores acumulados más el estado actual del pool y los promedios de espera y de login."""
+        with self.lock:
+            stats = dict(self.stats)
+            pools = list(self.connections.values())
+            active = sum(pool['in_use'] for pool in pools)
+            stats.update({
+                'active_connections': active,
+                'idle_connections': sum(len(pool['idle']) for pool in pools),
+                'creating_connections': sum(pool['creating'] for pool in pools),
+                'waiting_requests': sum(len(pool['waiters']) for pool in pools),
+                'available_slots': self.max_connections * max(1, len(pools)) - active,
+            })
+        stats['reuse_ratio'] = round(stats['connection_reuse'] / stats['successful_connections'], 3) if stats['successful_connections'] else None
+        stats['avg_wait_seconds'] = round(stats['wait_seconds'] / stats['total_requests'], 3) if stats['total_requests'] else None
+        stats['avg_create_seconds'] = round(stats['create_seconds'] / stats['connections_created'], 3) if stats['connections_created'] else None
+        return stats
+
+    def close(self):
+        """Detiene el hilo de limpieza y cierra las conexiones libres."""
+        self._stop_reaper.set()
+        if self._reaper is not None:
+            self._reaper.join()
+        with self.lock:
+            idle = [connection for pool in self.connections.values() for connection, _ in pool['idle']]
+            for pool in self.connections.values():
+                pool['idle'].clear()
+        for connection in idle:
+            _close_connection(connection)
+
+
+def _is_connection_open(connection) -> bool:
+    """Validación local (sin ida y vuelta al servidor): una conexión cerrada no entrega cursores."""
+    try:
+        connection.cursor().close()
+        return True
+    except Exception:
+        return False
+
+
+def _ping_connection(connection) -> bool:
+    """Validación con ida y vuelta al servidor (`SELECT 1`) para conexiones que estuvieron libres mucho tiempo."""
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        finally:
+            cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+def _close_connection(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class PooledConnection:
+    """
+    Conexión prestada por el pool. Se usa igual que la conexión (`cursor()`, `commit()`,
+    `pd.read_sql`) y vuelve al pool con `close()` o al salir de un bloque `with`; los llamadores
+    deben liberarla así. Si quedara sin liberar, vuelve al pool cuando deja de referenciarse
+    (junto con sus cursores), solo como respaldo.
+    """
+
+    def __init__(self, pool, connection_key, connection):
+        self._connection = connection
+        self._release = weakref.finalize(self, pool.release_connection, connection_key, connection)
+
+    def cursor(self, *args, **kwargs):
+        return _PooledCursor(self._connection.cursor(*args, **kwargs), self)
+
+    def close(self):
+        """Devuelve la conexión al pool (no la cierra)."""
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _PooledCursor:
+    # Mantiene viva la conexión prestada mientras el cursor esté en uso
+    def __init__(self, cursor, owner):
+        self._cursor = cursor
+        self._owner = owner
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        # Opciones como `fast_executemany` deben llegar al cursor de pyodbc, no al envoltorio
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
 
 class FabricConnectionManager:
     _instance = None
@@ -83,57 +390,61 @@ class FabricConnectionManager:
                 cls._instance = super().__new__(cls)
             return cls._instance
     
-    def __init__(self, notebookutils=None, ws_id=None, warehouse_type=None, artifact_name=None):
+    def __init__(self, notebookutils=None, ws_id=None, warehouse_type=None, artifact_name=None, max_connections=5, acquire_timeout=60):
         if not hasattr(self, 'initialized'):
             self.notebookutils = notebookutils
             self.ws_id = ws_id
             self.warehouse_type = warehouse_type
             self.artifact_name = artifact_name
-            self.connection_pool = ConnectionPool(max_connections=5, connection_timeout=300)
-            self.stats = {
-                'total_requests': 0,
-                'successful_connections': 0,
-                'failed_connections': 0,
-                'connection_reuse': 0
-            }
+            self.connection_pool = ConnectionPool(max_connections=max_connections, connection_timeout=300, acquire_timeout=acquire_timeout)
+            self.stats = self.connection_pool.stats  # los actualiza el pool en cada préstamo
             self.initialized = True
     
-    def get_warehouse_connection(self):
-        """Obtiene una conexión al warehouse desde el pool."""
-        connection_key = f"warehouse_{self.artifact_name}"
-        return self.connection_pool.get_connection(
-            connection_key,
-            lambda: get_db_connection_warehouse(
+    def _borrow(self, connection_key, connection_factory):
+        connection = self.connection_pool.get_connection(connection_key, connection_factory)
+        if connection is None:
+            return None
+        return PooledConnection(self.connection_pool, connection_key, connection)
+
+    def _source(self, connection_type):
+        """Llave del pool y función de login para 'sql' o 'warehouse'."""
+        if connection_type == "warehouse":
+            return f"warehouse_{self.artifact_name}", lambda: get_db_connection_warehouse(
                 self.artifact_name, self.ws_id, self.warehouse_type, self.notebookutils
             )
+        return f"sql_{self.artifact_name}", lambda: get_db_connection_fabricsqldatabase2(
+            self.artifact_name, self.ws_id, self.notebookutils
         )
+
+    def get_warehouse_connection(self):
+        """Obtiene una conexión al warehouse desde el pool (vuelve al pool al cerrarla o soltarla)."""
+        return self._borrow(*self._source("warehouse"))
     
     def get_sql_connection(self):
-        """Obtiene una conexión SQL desde el pool."""
-        connection_key = f"sql_{self.artifact_name}"
-        return self.connection_pool.get_connection(
-            connection_key,
-            lambda: get_db_connection_fabricsqldatabase2(
-                self.artifact_name, self.ws_id, self.notebookutils
-            )
-        )
+        """Obtiene una conexión SQL desde el pool (vuelve al pool al cerrarla o soltarla)."""
+        return self._borrow(*self._source("sql"))
+
+    def prewarm(self, count=None, connection_types=("sql",)):
+        """
+        Abre por adelantado `count` conexiones por tipo (por defecto `max_connections`), en paralelo,
+        para que los workers no hagan login todos a la vez al inicio de la corrida.
+        """
+        count = self.connection_pool.max_connections if count is None else count
+        return {connection_type: self.connection_pool.prewarm(*self._source(connection_type), count)
+                for connection_type in connection_types}
     
     def get_sql_connection2(self):
         """Obtiene una conexión SQL2 desde el pool."""
         return self.get_sql_connection()  # Usa el mismo método ya mejorado
     
-    def release_connection(self, connection_type: str):
-        """Libera una conexión para que pueda ser reutilizada."""
-        connection_key = f"{connection_type}_{self.artifact_name}"
-        self.connection_pool.release_connection(connection_key)
+    def release_connection(self, connection_type: str, connection=None):
+        """Libera una conexión obtenida con `get_sql_connection` / `get_warehouse_connection`."""
+        if isinstance(connection, PooledConnection):
+            connection.close()
     
     def get_stats(self):
         """Retorna estadísticas de uso de conexiones."""
-        return {
-            **self.stats,
-            'active_connections': len(self.connection_pool.connections),
-            'available_slots': self.connection_pool.max_connections - len(self.connection_pool.connections)
-        }
+        return self.connection_pool.get_stats()
     
 
 
@@ -0,0 +1,372 @@
+import datetime
+import random
+import threading
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from deltalake import DeltaTable, WriterProperties
+from deltalake.exceptions import TableNotFoundError, CommitFailedError
+from logger_utils import log
+from metrics_utils import metrics as run_metrics
+from dedup_utils import get_primary_key_columns, deduplicate_by_keys
+from partition_utils import plan_partition_columns
+
+
+WRITE_MODES = ("append", "merge")
+
+# Layout de particiones por ruta de tabla. El layout no cambia después de crear la tabla, así que
+# se resuelve una sola vez por tabla y no en cada escritura (evita recargar el log de Delta).
+_partition_layouts = {}
+# Layouts planificados para tablas que aún no existen; se descartan en cuanto la tabla existe
+_planned_layouts = {}
+_partition_layouts_lock = threading.Lock()
+
+# Rutas de tablas cuyas propiedades (columnas con estadísticas) ya se verificaron en esta corrida
+_table_properties_applied = set()
+_table_properties_lock = threading.Lock()
+
+STATS_COLUMNS_PROPERTY = "delta.dataSkippingStatsColumns"
+
+# Perfiles de escritura Parquet (argumentos de WriterProperties), elegidos con `write_profile` del schedule.
+# - default: valores por defecto de deltalake (snappy).
+# - fast: snappy con páginas de diccionario grandes; menor costo de CPU al escribir.
+# - balanced: zstd nivel 3; archivos más chicos con tiempos de escritura/lectura similares a snappy.
+# - compact: zstd nivel 9; tablas grandes y poco escritas donde pesa más el almacenamiento y el escaneo.
+WRITE_PROFILES = {
+    "default": {},
+    "fast": {"compression": "SNAPPY", "dictionary_page_size_limit": 2 * 1024 * 1024},
+    "balanced": {"compression": "ZSTD", "compression_level": 3, "dictionary_page_size_limit": 2 * 1024 * 1024,
+                 "data_page_size_limit": 1024 * 1024, "statistics_truncate_length": 64},
+    "compact": {"compression": "ZSTD", "compression_level": 9, "dictionary_page_size_limit": 4 * 1024 * 1024,
+                "data_page_size_limit": 2 * 1024 * 1024, "statistics_truncate_length": 64},
+}
+
+
+def _is_true(value):
+    return str(value).strip().lower() in ("1", "true")
+
+
+def _parse_int(value):
+    """Convierte un valor opcional del schedule a int (None si viene vacío o NaN)."""
+    if value is None or (isinstance(value, float) and pd.isna(value)) or str(value).strip() == "":
+        return None
+    return int(float(value))
+
+
+def get_table_write_options(resource, table_name):
+    """
+    Obtiene las opciones de escritura de una tabla desde la metadata de programación (`get_schedules`).
+
+    Columnas opcionales leídas del schedule:
+        - write_mode: 'append' (por defecto) o 'merge'.
+        - merge_prune_watermark: 1/True para descartar del merge los archivos con watermark mayor
+          al máximo del lote. Sólo es seguro cuando el watermark de una fila nunca disminuye.
+        - partition_info: campos de DataOn.PartitionFields usados para el layout de tablas nuevas.
+        - sort_within_files: 1/True para ordenar cada escritura por (idPartner, watermark) y que
+          el min/max de cada archivo sirva para descartar archivos en lecturas incrementales.
+        - target_file_size_mb: tamaño objetivo de los archivos Parquet.
+        - row_group_rows: filas máximas por row group.
+        - stats_columns: columnas separadas por coma que recolectan estadísticas
+          (`delta.dataSkippingStatsColumns`); por defecto Delta usa las primeras 32.
+        - write_profile: perfil de `WRITE_PROFILES` (codec, nivel, páginas); por defecto 'default'.
+        - commit_metrics: 1/True para leer del historial de Delta los archivos agregados por cada
+          append (una lectura extra del log por commit); los merges ya los reportan.
+
+    Args:
+        resource (DataFrame): programaciones del proyecto (una fila por recurso).
+        table_name (str): nombre del recurso (`resource_name`).
+
+    Returns:
+        dict con write_mode, key_columns, watermark_column, prune_by_watermark, partition_info,
+        sort_columns, target_file_size, max_row_group_size, stats_columns, write_profile y commit_metrics.
+    """
+    options = {"write_mode": "append", "key_columns": [], "watermark_column": None, "prune_by_watermark": False,
+               "partition_info": None, "sort_columns": [], "target_file_size": None, "max_row_group_size": None,
+               "stats_columns": [], "write_profile": "default", "commit_metrics": False}
+    if resource is None or "resource_name" not in resource.columns:
+        return options
+
+    rows = resource[resource["resource_name"] == table_name]
+    if rows.empty:
+        return options
+    row = rows.iloc[0]
+
+    write_mode = str(row.get("write_mode") or "append").strip().lower()
+    if write_mode not in WRITE_MODES:
+        log(f"⚠️ write_mode '{write_mode}' no soportado para {table_name}, se usa append", level="warning")
+        write_mode = "append"
+
+    options["write_mode"] = write_mode
+    options["key_columns"] = get_primary_key_columns(row.get("keys_info"))
+    if bool(row.get("is_incremental")) and pd.notna(row.get("watermark_column")):
+        options["watermark_column"] = row.get("watermark_column")
+    options["prune_by_watermark"] = _is_true(row.get("merge_prune_watermark"))
+    options["partition_info"] = row.get("partition_info")
+    options["commit_metrics"] = _is_true(row.get("commit_metrics"))
+
+    if _is_true(row.get("sort_within_files")):
+        options["sort_columns"] = [c for c in ("idPartner", options["watermark_column"]) if c]
+    target_file_size_mb = _parse_int(row.get("target_file_size_mb"))
+    if target_file_size_mb:
+        options["target_file_size"] = target_file_size_mb * 1024 * 1024
+    options["max_row_group_size"] = _parse_int(row.get("row_group_rows"))
+    stats_columns = row.get("stats_columns")
+    if isinstance(stats_columns, str):
+        options["stats_columns"] = [c.strip() for c in stats_columns.split(",") if c.strip()]
+
+    write_profile = str(row.get("write_profile") or "default").strip().lower()
+    if write_profile not in WRITE_PROFILES:
+        log(f"⚠️ write_profile '{write_profile}' no soportado para {table_name}, se usa default", level="warning")
+        write_profile = "default"
+    options["write_profile"] = write_profile
+    return options
+
+
+def cluster_data(data, sort_columns):
+    """
+    Ordena los datos (DataFrame o pa.Table) por `sort_columns` antes de escribirlos, para que
+    cada archivo cubra un rango acotado de partners y watermark en sus estadísticas min/max.
+    """
+    if data is None or not sort_columns:
+        return data
+    columns = data.column_names if isinstance(data, pa.Table) else list(data.columns)
+    sort_columns = [c for c in sort_columns if c in columns]
+    if not sort_columns:
+        return data
+    if isinstance(data, pa.Table):
+        return data.sort_by([(c, "ascending") for c in sort_columns])
+    return data.sort_values(sort_columns, kind="stable").reset_index(drop=True)
+
+
+def build_write_kwargs(write_options):
+    """
+    Argumentos de escritura de Delta derivados de las opciones de la tabla (sólo los configurados,
+    así una tabla sin opciones se escribe con los valores por defecto de deltalake).
+    """
+    kwargs = {}
+    if write_options.get("target_file_size"):
+        kwargs["target_file_size"] = write_options["target_file_size"]
+
+    writer_properties = dict(WRITE_PROFILES.get(write_options.get("write_profile") or "default", {}))
+    if write_options.get("max_row_group_size"):
+        writer_properties["max_row_group_size"] = write_options["max_row_group_size"]
+    if writer_properties:
+        kwargs["writer_properties"] = WriterProperties(**writer_properties)
+    if write_options.get("stats_columns"):
+        kwargs["configuration"] = {STATS_COLUMNS_PROPERTY: ",".join(write_options["stats_columns"])}
+    return kwargs
+
+
+def ensure_table_properties(table_path, storage_options, configuration):
+    """
+    Aplica propiedades a una tabla existente (una vez por corrida y tabla).
+
+    `configuration` en `write_deltalake` sólo aplica al crear la tabla; las tablas existentes
+    se actualizan con `alter.set_table_properties` cuando sus valores difieren.
+    """
+    if not configuration:
+        return
+    with _table_properties_lock:
+        if table_path in _table_properties_applied:
+            return
+
+    try:
+        delta_table = DeltaTable(table_path, storage_options=storage_options)
+        current = delta_table.metadata().configuration
+        changed = {k: v for k, v in configuration.items() if current.get(k) != v}
+        if changed:
+            delta_table.alter.set_table_properties(changed)
+            log(f"⚙️ Propiedades actualizadas en {table_path}: {changed}", level="info")
+    except TableNotFoundError:
+        # La escritura la crea con `configuration`
+        return
+    except Exception as e:
+        # Se reintenta en el próximo commit; no impide escribir los datos
+        log(f"⚠️ No se pudieron actualizar las propiedades de {table_path}: {e}", level="warning")
+        return
+
+    with _table_properties_lock:
+        _table_properties_applied.add(table_path)
+
+
+def get_table_partition_columns(table_path, storage_options):
+    """
+    Retorna las columnas de partición de una tabla Delta existente, o None si la tabla no existe.
+
+    El layout de una tabla se decide al crearla; las escrituras posteriores deben respetarlo.
+    """
+    try:
+        return list(DeltaTable(table_path, storage_options=storage_options).metadata().partition_columns)
+    except TableNotFoundError:
+        return None
+
+
+def resolve_partition_columns(table_path, storage_options, df, partition_info):
+    """
+    Retorna las columnas de partición para escribir `df` en `table_path`.
+
+    Si la tabla existe se usa su layout y se cachea. Si no, se planifica con
+    `plan_partition_columns` sobre el primer lote y el plan se reutiliza en los lotes siguientes
+    (la cardinalidad de un lote posterior no cambia la decisión), pero se vuelve a revisar la tabla
+    en cada llamada: en cuanto existe (creada por esta u otra corrida) manda su layout.
+    `df` puede ser un pa.Table (commit de chunks recuperados de staging en una sesión nueva, sin
+    plan en memoria). Con `df` None y sin plan previo retorna [] (sin partición).
+    """
+    with _partition_layouts_lock:
+        if table_path in _partition_layouts:
+            return _partition_layouts[table_path]
+
+    existing = get_table_partition_columns(table_path, storage_options)
+    with _partition_layouts_lock:
+        if existing is not None:
+            _planned_layouts.pop(table_path, None)
+            return _partition_layouts.setdefault(table_path, existing)
+        if table_path in _planned_layouts or df is None:
+            return _planned_layouts.get(table_path, [])
+
+    partition_by = plan_partition_columns(df, partition_info)
+    with _partition_layouts_lock:
+        planned = _planned_layouts.setdefault(table_path, partition_by)
+    if planned is partition_by and partition_by:
+        log(f"🗂️ Tabla nueva {table_path} particionada por {partition_by}", level="info")
+    return planned
+
+
+def _format_literal(value):
+    """Formatea un valor como literal para un predicado de Delta."""
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        value = pd.Timestamp(value)
+        if value.tzinfo is not None:
+            value = value.tz_convert("UTC")
+        return f"'{value.strftime('%Y-%m-%dT%H:%M:%S.%f')}{'Z' if value.tzinfo is not None else ''}'"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def _column_names(data):
+    return data.column_names if isinstance(data, pa.Table) else list(data.columns)
+
+
+def _decoded(column):
+    # Las funciones de agregación de Arrow no operan sobre arreglos diccionario
+    return column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+
+
+def build_merge_predicate(df, key_columns, watermark_column=None, prune_by_watermark=False,
+                          source_alias="s", target_alias="t"):
+    """
+    Construye el predicado del merge: igualdad por llave más filtros sobre el destino
+    que permiten descartar archivos (idPartner del lote y, opcionalmente, watermark <= máximo
+    del lote). No hay cota inferior: la versión anterior de una fila actualizada tiene un
+    watermark menor y debe seguir coincidiendo para actualizarse en lugar de duplicarse.
+    `df` puede ser un DataFrame o un pa.Table (commits del coalescer).
+    """
+    conditions = [f"{target_alias}.{col} = {source_alias}.{col}" for col in key_columns]
+    columns = _column_names(df)
+
+    if "idPartner" in columns:
+        if isinstance(df, pa.Table):
+            partners = sorted(p for p in pc.unique(_decoded(df.column("idPartner"))).to_pylist() if p is not None)
+        else:
+            partners = sorted(pd.unique(df["idPartner"]))
+        conditions.append(f"{target_alias}.idPartner IN ({', '.join(_format_literal(p) for p in partners)})")
+
+    if prune_by_watermark and watermark_column and watermark_column in columns:
+        if isinstance(df, pa.Table):
+            high = pc.max(_decoded(df.column(watermark_column))).as_py()
+        else:
+            high = df[watermark_column].max()
+        conditions.append(f"{target_alias}.{watermark_column} <= {_format_literal(high)}")
+
+    return " AND ".join(conditions)
+
+
+def _deduplicate_source(data, key_columns, watermark_column=None):
+    """
+    Deja una fila por llave en el origen del merge (gana el watermark mayor): los lotes
+    coalescidos o recuperados de staging pueden traer la misma llave más de una vez.
+    """
+    if not isinstance(data, pa.Table):
+        return deduplicate_by_keys(data, key_columns, watermark_column)
+
+    keys = pa.table({c: _decoded(data.column(c)) for c in key_columns})
+    if keys.group_by(key_columns).aggregate([]).num_rows == data.num_rows:
+        return data
+    if watermark_column and watermark_column in data.column_names:
+        order = pc.sort_indices(_decoded(data.column(watermark_column)))
+    else:
+        order = pa.array(range(data.num_rows), type=pa.int64())
+    ranked = keys.take(order).append_column("__position", pa.array(range(data.num_rows), type=pa.int64()))
+    last = ranked.group_by(key_columns).aggregate([("__position", "max")]).column("__position_max")
+    return data.take(pc.take(order, last))
+
+
+def merge_to_delta(table_path, df, key_columns, storage_options, watermark_column=None, prune_by_watermark=False,
+                   writer_properties=None):
+    """
+    Hace upsert de `df` sobre la tabla Delta usando la llave primaria + idPartner.
+
+    Returns:
+        dict con las métricas del merge, o None si la tabla no existe todavía
+        (el llamador debe crearla con una escritura normal).
+        `writer_properties` (WriterProperties) controla los archivos que reescribe el merge.
+    """
+    if not key_columns:
+        raise ValueError(f"❌ La tabla {table_path} no tiene llave primaria en keys_info para hacer merge")
+
+    key_columns = list(key_columns)
+    if "idPartner" in _column_names(df) and "idPartner" not in key_columns:
+        key_columns.append("idPartner")
+
+    try:
+        delta_table = DeltaTable(table_path, storage_options=storage_options)
+    except TableNotFoundError:
+        return None
+
+    df = _deduplicate_source(df, key_columns, watermark_column)
+    predicate = build_merge_predicate(df, key_columns, watermark_column, prune_by_watermark)
+    metrics = (
+        delta_table.merge(source=df, predicate=predicate, source_alias="s", target_alias="t", merge_schema=True,
+                          writer_properties=writer_properties)
+        .when_matched_update_all()
+        .when_not_matched_insert_all()
+        .execute()
+    )
+    log(f"🔀 Merge en {table_path}: {metrics.get('num_target_rows_inserted', 0)} insertadas, "
+        f"{metrics.get('num_target_rows_updated', 0)} actualizadas, "
+        f"{metrics.get('num_target_files_removed', 0)} archivos reescritos", level="info")
+    return metrics
+
+
+def get_last_commit_metrics(table_path, storage_options=None):
+    """Métricas de la última operación de la tabla (archivos y filas agregados), o {} si no se pueden leer."""
+    try:
+        history = DeltaTable(table_path, storage_options=storage_options).history(1)
+        return history[0].get("operationMetrics", {}) if history else {}
+    except Exception as e:
+        log(f"⚠️ No se pudieron leer las métricas del último commit de {table_path}: {e}", level="warning")
+        return {}
+
+
+def retry_on_conflict(fn, table_name, max_retries=5, wait_seconds=1.0):
+    """
+    Ejecuta `fn` reintentando cuando el commit de Delta falla por concurrencia optimista
+    (otro writer hizo commit sobre la misma tabla entre la lectura y la escritura).
+
+    Un commit fallido no deja datos visibles, así que reintentar la escritura completa es seguro.
+    La espera crece exponencialmente con un jitter para que los writers en conflicto no
+    vuelvan a chocar.
+    """
+    for attempt in range(max_retries):
+        try:
+            return fn()
+        except CommitFailedError as e:
+            if attempt == max_retries - 1:
+                raise
+            wait_time = wait_seconds * (2 ** attempt) * (1 + random.random())
+            run_metrics.inc("retries_total", stage="commit", table=table_name)
+            log(f"⚠️ Conflicto de commit en {table_name} (intento {attempt + 1}), "
+                f"reintentando en {wait_time:.1f}s... Error: {e}", level="warning")
+            time.sleep(wait_time)
@@ -6,6 +6,18 @@ from logger_utils import log, set_logging
 import numpy as np
 
 
+# dtypes compactos por tipo SQL Server. tinyint (0..255) no cabe en int8 con signo y Delta
+# no tiene enteros sin signo, por eso se mapea a int16 (short en Delta).
+SQL_COMPACT_DTYPES = {
+    'tinyint': 'int16',
+    'smallint': 'int16',
+    'int': 'int32',
+    'bigint': 'int64',
+    'bit': 'bool',
+    'boolean': 'bool',
+    'real': 'float32',
+}
+
 
 def get_current_day():
     """Obtiene el nombre del día actual traducido al castellano."""
@@ -60,6 +72,122 @@ def format_datetime_for_sqlserver(value):
 
     raise TypeError(f"❌ Tipo de dato no soportado: {type(value)}")
 
+
+def compact_dtypes(df, schema):
+    """
+    Reduce los dtypes de un DataFrame recién extraído según los tipos SQL del esquema.
+
+    A diferencia de `clean_data` no rellena nulos: los enteros y bits con nulos pasan a los
+    dtypes nullable de pandas (`Int16`, `Int32`, `boolean`) en lugar de quedar como float64/object.
+    Se usa para reducir la memoria de los lotes mientras se acumulan antes de guardar.
+
+    Args:
+        df (DataFrame): Datos extraídos (se modifica en sitio).
+        schema (list): Lista de tuplas (columna, tipo SQL) como la de `get_sql_table_schema`.
+    """
+    if df is None or df.empty or not schema:
+        return df
+
+    for column, dtype in schema:
+        target = SQL_COMPACT_DTYPES.get(dtype)
+        if column not in df.columns or target is None:
+            continue
+        try:
+            if target == 'bool':
+                df[column] = df[column].astype('boolean' if df[column].isna().any() else bool)
+            elif target.startswith('int'):
+                values = pd.to_numeric(df[column], errors='coerce')
+                df[column] = values.astype(target.capitalize() if values.isna().any() else target)
+            else:
+                df[column] = pd.to_numeric(df[column], errors='coerce').astype(target)
+        except (TypeError, ValueError, OverflowError) as e:
+            log(f"⚠️ No se pudo compactar la columna {column} ({dtype} → {target}): {e}", level="warning")
+
+    return df
+
+
+def encode_low_cardinality(df, max_unique_ratio=0.05, sample_size=10000, exclude=None, min_rows=1000):
+    """
+    Convierte a `category` (codificación por diccionario) las columnas de texto con baja cardinalidad.
+
+    La cardinalidad se estima sobre una muestra de `sample_size` filas por columna, de modo que el
+    costo no depende del tamaño del DataFrame. Las columnas categóricas se escriben en Delta como
+    arreglos diccionario de Arrow, por lo que la codificación se conserva hasta el writer de Parquet.
+    En DataFrames pequeños el diccionario no compensa su costo y no se codifica nada.
+
+    Args:
+        df (DataFrame): Datos a codificar (se modifica en sitio).
+        max_unique_ratio (float): Proporción máxima de valores distintos sobre la muestra para codificar.
+        sample_size (int): Cantidad de filas de la muestra usada para estimar la cardinalidad.
+        exclude (list, optional): Columnas que nunca se codifican.
+        min_rows (int): Filas mínimas del DataFrame para intentar la codificación.
+    """
+    if df is None or len(df) < max(1, min_rows):
+        return df
+
+    exclude = set(exclude or [])
+    for col in df.columns:
+        if col in exclude:
+            continue
+        # Ya codificada (ej. source_table o una segunda pasada después de clean_data)
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        if not (pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])):
+            continue
+
+        sample = df[col] if len(df) <= sample_size else df[col].sample(n=sample_size, random_state=0)
+        # Sólo texto: columnas vacías, fechas, decimales o bytes en columnas object se dejan intactos
+        non_null = sample.dropna()
+        if non_null.empty or not non_null.map(lambda x: isinstance(x, str)).all():
+            continue
+
+        if sample.nunique(dropna=True) <= max(1, int(len(sample) * max_unique_ratio)):
+            df[col] = df[col].astype("category")
+
+    return df
+
+
+def concat_dataframes(dfs):
+    """
+    Concatena DataFrames conservando las columnas categóricas.
+
+    `pd.concat` degrada a `object` las columnas categóricas cuando las categorías difieren entre
+    DataFrames (p. ej. un DataFrame por partner). Aquí se unifican las categorías antes de concatenar
+    para que el resultado siga codificado por diccionario.
+    """
+    dfs = [df for df in dfs if df is not None]
+    if not dfs:
+        return pd.DataFrame()
+    if len(dfs) == 1:
+        return dfs[0]
+
+    categorical_columns = {
+        col for df in dfs for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)
+    }
+    if not categorical_columns:
+        return pd.concat(dfs, ignore_index=True)
+
+    try:
+        aligned = [df.copy(deep=False) for df in dfs]
+        for col in categorical_columns:
+            values = []
+            for df in aligned:
+                if col not in df.columns:
+                    continue
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    values.append(df[col].cat.categories.to_numpy())
+                else:
+                    values.append(pd.unique(df[col].dropna()))
+            dtype = pd.CategoricalDtype(pd.Index(np.concatenate(values)).unique())
+            for df in aligned:
+                if col in df.columns:
+                    df[col] = df[col].astype(dtype)
+        return pd.concat(aligned, ignore_index=True)
+    except Exception as e:
+        log(f"⚠️ No se pudieron unificar las categorías, se concatena sin codificación: {e}", level="warning")
+        return pd.concat(dfs, ignore_index=True)
+
+
 def clean_data(df, schema):
     import unicodedata
 
@@ -82,21 +210,42 @@ def clean_data(df, schema):
         except Exception:
             # En caso extremo, forzar str y reemplazar caracteres inválidos
             return str(v).encode('utf-8', errors='replace').decode('utf-8', errors='replace')
-    
+
+    def _to_text(series, upper):
+        """Aplica `_to_str_safe` (y opcionalmente upper) a una columna.
+
+        En columnas categóricas sólo se transforman las categorías distintas y se
+        recodifican los códigos, en lugar de recorrer cada fila.
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = pd.Index(series.cat.categories.map(_to_str_safe), dtype=object)
+            if upper:
+                categories = categories.str.upper()
+            codes = series.cat.codes.to_numpy()
+            if (codes < 0).any():
+                # Los nulos se convierten en cadena vacía, igual que en `_to_str_safe`
+                categories = categories.append(pd.Index([""], dtype=object))
+                codes = np.where(codes < 0, len(categories) - 1, codes)
+            uniques = categories.unique()
+            new_codes = uniques.get_indexer(categories)[codes]
+            return pd.Series(pd.Categorical.from_codes(new_codes, categories=uniques), index=series.index)
+
+        series = series.apply(_to_str_safe)
+        return series.str.upper() if upper else series
+
     for column, dtype in schema:
         if column not in df.columns:
             continue
 
         if dtype in ['varchar', 'nvarchar', 'char', 'nchar', 'text']:
             # Aplicar conversión segura a UTF-8 antes de upper
-            df[column] = df[column].apply(_to_str_safe)
-            df[column] = df[column].str.upper()
+            df[column] = _to_text(df[column], upper=True)
 
         elif dtype in ['int', 'bigint', 'smallint', 'tinyint']:
-            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0).astype(np.int64)        
+            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0).astype(SQL_COMPACT_DTYPES[dtype])
 
         elif dtype in ['decimal', 'numeric', 'float', 'real', 'money']:
-            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0.0)
+            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0.0).astype(SQL_COMPACT_DTYPES.get(dtype, np.float64))
 
         elif 'date' in dtype or 'time' in dtype:
             df[column] = pd.to_datetime(df[column], errors='coerce', utc=True)
@@ -107,16 +256,15 @@ def clean_data(df, schema):
 
         else:
             # fallback para tipos no mapeados: tratar como texto seguro
-            df[column] = df[column].apply(_to_str_safe)
-            df[column] = df[column].str.upper()
+            df[column] = _to_text(df[column], upper=True)
 
     # Validación para columnas adicionales no incluidas en el esquema
     for col in df.columns:
         if col not in [c[0] for c in schema]:
-            if df[col].dtype == object:
-                df[col] = df[col].apply(_to_str_safe)
+            if df[col].dtype == object or isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = _to_text(df[col], upper=False)
             elif pd.api.types.is_integer_dtype(df[col]):
-                df[col] = df[col].fillna(0).astype('Int64')
+                df[col] = df[col].fillna(0).astype(np.int64)
             elif pd.api.types.is_float_dtype(df[col]):
                 df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0)
             elif pd.api.types.is_bool_dtype(df[col]):
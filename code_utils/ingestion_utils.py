@@ -1,18 +1,29 @@
 import time 
 import pandas as pd
 import numpy as np
-from logger_utils import log, set_logging
-from logging_utils import log_operation
-from format_utils import format_datetime_for_sqlserver, sanitize_for_pandas, pandas_time_to_str, clean_data
+from logger_utils import log, set_logging, log_context, bind_log_context
+from logging_utils import log_operation, AuditWriter
+from format_utils import sanitize_for_pandas, pandas_time_to_str, clean_data, compact_dtypes, encode_low_cardinality, concat_dataframes
 from db_utils import create_db_connection
-from partition_utils import get_batches, get_block_number, get_block
+from partition_utils import get_batches, get_block_number, get_block, conform_partition_columns
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import gc
+import functools
 from sqlalchemy.exc import SQLAlchemyError, OperationalError
 from collections import defaultdict
 import datetime  # módulo completo → para datetime.datetime y datetime.time
 import uuid
-from watermark_utils import get_all_last_watermarks, get_last_watermark_from_cache
+from watermark_utils import Watermark, WATERMARK_TYPES, get_all_last_watermarks, get_last_watermark_from_cache, sql_placeholder
+from dedup_utils import get_primary_key_columns, deduplicate_by_keys
+from metrics_utils import metrics, SIZE_BUCKETS, export_run_metrics
+from tracing_utils import tracer, span, start_span, end_span, in_current_context, export_trace
+from delta_utils import get_last_commit_metrics, get_table_write_options, resolve_partition_columns, merge_to_delta, retry_on_conflict, cluster_data, build_write_kwargs, ensure_table_properties
+from writer_utils import PipelinedTableWriter, CommitCoalescer
+from staging_utils import StagingArea, recover_staged
+from watermark_store import WatermarkStore
+from maintenance_utils import maintain_project_tables
+from lakehouse_utils import fabric_storage_options, get_lakehouse_target
+import pyarrow as pa
 
 
 
@@ -111,41 +122,29 @@ def get_last_watermark(_project, _id_partner, _table_name, _watermark_type, _con
             # Pasamos None como _project ya que no lo estamos usando
             return get_last_watermark_from_cache(_project, _df_watermarks, _id_partner, _table_name, _watermark_type)
         
+        watermark_type = _watermark_type.upper()
+        if watermark_type not in WATERMARK_TYPES:
+            raise ValueError(f"❌ Tipo de watermark no soportado: {_watermark_type}")
+
         # Si no hay DataFrame cacheado, hacer la consulta individual
-        conn = _conn_mgr_fabric.get_sql_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(f"""
-                SELECT TOP 1 CAST(CurrentWaterMark AS varchar(30)) AS lastWatermarkValue
+        with _conn_mgr_fabric.get_sql_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT TOP 1 CONVERT(varchar(30), CurrentWaterMark, 121) AS lastWatermarkValue
                 FROM DataOn.IngestaLog
-                WHERE idPartner = {_id_partner}
-                  AND TableName = '{_table_name}'
-                  AND environment = '{_environment}'
-                  AND project = '{_project}'
+                WHERE idPartner = ?
+                  AND TableName = ?
+                  AND environment = ?
+                  AND project = ?
                   AND Status = 'Success'
                   AND is_incremental = 1
                 ORDER BY CurrentWaterMark DESC 
-            """)
+            """, int(_id_partner), _table_name, _environment, _project)
             rows = cursor.fetchall()
 
-        # Manejo del watermark
-        if rows:
-            last_watermark_raw = rows[0][0]  # Esto puede ser datetime o int
-            if _watermark_type.upper() == "DATETIME":
-                last_watermark_value = str(last_watermark_raw)  # Devuelve '2025-04-04 14:53:22'
-                last_watermark_value = format_datetime_for_sqlserver(last_watermark_value)
-            elif _watermark_type.upper() == "INT":
-                last_watermark_value = int(last_watermark_raw)
-            else:
-                raise ValueError(f"❌ Tipo de watermark no soportado: {_watermark_type}")
-        else:
-            # Valor por defecto si no hay registros
-            if _watermark_type.upper() == "DATETIME":
-                last_watermark_value = '1990-01-01 00:00:00'
-                last_watermark_value = format_datetime_for_sqlserver(last_watermark_value)
-            elif _watermark_type.upper() == "INT":
-                last_watermark_value = 0
-            else:
-                raise ValueError(f"❌ Tipo de watermark no soportado: {_watermark_type}")
+        # Manejo del watermark: se parsea una vez; sin registros se usa el valor por defecto
+        last_watermark_value = Watermark.parse(rows[0][0], watermark_type) if rows else None
+        if last_watermark_value is None:
+            last_watermark_value = Watermark.default(watermark_type)
         return last_watermark_value
     except Exception as e:
         log(f"❌ Error al obtener el last_watermark: {str(e)}", level="error")
@@ -153,7 +152,15 @@ def get_last_watermark(_project, _id_partner, _table_name, _watermark_type, _con
     
 
 def get_current_watermark(engine, table_name,  watermark_column, watermark_type):
+    """
+    Obtiene el máximo actual de la columna de watermark en el origen como `Watermark` tipado.
+    Las fechas futuras se limitan al momento de ejecución.
+    """
     try:
+        watermark_type = watermark_type.upper()
+        if watermark_type not in WATERMARK_TYPES:
+            raise ValueError(f"❌ Tipo de watermark no soportado: {watermark_type}")
+
         # Obtener el actual watermark
         current_watermark_query = f"""
         SELECT  MAX({watermark_column}) AS current_watermark
@@ -165,32 +172,21 @@ def get_current_watermark(engine, table_name,  watermark_column, watermark_type)
         current_watermark = None
         if response["success"]:
             current_watermark_df = response["data"]               
-            # Manejar el current_watermark
-            if current_watermark_df is not None and not current_watermark_df.empty and current_watermark_df.iloc[0, 0] is not None:
-                current_watermark = current_watermark_df.iloc[0, 0]
-            else:
-                if watermark_type.upper() == "DATETIME":
-                    current_watermark = pd.to_datetime('1990-01-01 00:00:00')  # Valor por defecto para fechas                    
-                elif watermark_type.upper() == "INT":
-                    current_watermark = 0  # Valor por defecto para enteros
+            # Manejar el current_watermark (valor nativo del driver: datetime, int o bytes)
+            if current_watermark_df is not None and not current_watermark_df.empty:
+                current_watermark = Watermark.parse(current_watermark_df.iloc[0, 0], watermark_type)
         else:            
             log(f"❌ Error al obtener datos: {response['error']}", level="error")    
-            if watermark_type.upper() == "DATETIME":
-                current_watermark = pd.to_datetime('1990-01-01 00:00:00')  # Valor por defecto para fechas                    
-            elif watermark_type.upper() == "INT":
-                current_watermark = 0  # Valor por defecto para enteros
-            else:
-                raise ValueError(f"❌ Tipo de watermark no soportado: {watermark_type}")
 
+        if current_watermark is None:
+            current_watermark = Watermark.default(watermark_type)
 
-        # Formatear current_watermark a formato datetime compatible con sql
-        if watermark_type.upper() == "DATETIME":
-            now = pd.Timestamp.now()
+        # Limitar fechas futuras al momento de ejecución
+        if watermark_type == "DATETIME":
+            now = Watermark.parse(pd.Timestamp.now(), watermark_type)
             if current_watermark > now:
                 log("Fecha y hora mayor al momento de ejecución", level="warning")
-                current_watermark = format_datetime_for_sqlserver(now)
-            else:
-                current_watermark = format_datetime_for_sqlserver(current_watermark)
+                current_watermark = now
      
         return current_watermark
     except Exception as e:
@@ -200,7 +196,8 @@ def get_current_watermark(engine, table_name,  watermark_column, watermark_type)
 
     # Funcion para validar las columnas de tipos compatibles
 
-def get_valid_columns(_engine, _table_name, _schema='dbo'):
+def get_column_types(_engine, _table_name, _schema='dbo'):
+    """Retorna {COLUMN_NAME: DATA_TYPE} de la tabla de origen, en el orden de sus columnas."""
     query = f"""
         SELECT COLUMN_NAME, DATA_TYPE
         FROM INFORMATION_SCHEMA.COLUMNS
@@ -208,8 +205,13 @@ def get_valid_columns(_engine, _table_name, _schema='dbo'):
     """
     
     df = pd.read_sql(query, _engine)
-    valid_columns = df[~df['DATA_TYPE'].isin(['hierarchyid', 'geometry', 'geography', 'sql_variant'])]['COLUMN_NAME']
-    return valid_columns.tolist()
+    return dict(zip(df['COLUMN_NAME'], df['DATA_TYPE']))
+
+
+def get_valid_columns(_engine, _table_name, _schema='dbo', _column_types=None):
+    column_types = _column_types if _column_types is not None else get_column_types(_engine, _table_name, _schema)
+    return [column for column, data_type in column_types.items()
+            if data_type not in ('hierarchyid', 'geometry', 'geography', 'sql_variant')]
      
 
 def get_sql_table_schema(row,  resource): #(engine, schema_name, json_config):
@@ -259,58 +261,171 @@ def get_sql_table_schema_database(row, resource):
         schema_info[resource_grouped] = list(zip(df_schema['COLUMN_NAME'], df_schema['DATA_TYPE']))
     return schema_info   
 
-def save_data(df_data, project_name, table_name, df_schema, _process_execution_id, table_path, _conn_mgr_fabric, _process_name, _notebookutils, _write_deltalake):
-    try: 
-        records_quantity = len(df_data)
-        
-        log(f"💾 Recurso {table_name} |  Se guardarán {records_quantity} registros...", level="info")
+def get_storage_options(_notebookutils):
+    """Opciones de almacenamiento para escribir en OneLake con el token de storage de Fabric (en cache)."""
+    return fabric_storage_options(_notebookutils)
+
+
+def prepare_data(df_data, table_name, df_schema, table_path, storage_options, _write_options=None):
+    """
+    Limpia los datos de una tabla y agrega las columnas de partición que requiere su layout.
+
+    Returns:
+        DataFrame listo para escribir en Delta Lake.
+    """
+    write_options = _write_options or {}
+    with span("clean_data", table=table_name, rows=len(df_data)), metrics.timer("stage_seconds", stage="clean", table=table_name):
         df_clean = clean_data(df_data, df_schema[table_name])       
+    metrics.inc("rows_total", len(df_clean), stage="clean", table=table_name)
+    
+    if "CreatedTS" in df_clean.columns:
+        df_clean["CreatedTS"] = pd.to_datetime(df_clean["CreatedTS"], errors="coerce", utc=True)
+        df_clean["CreatedTS"] = df_clean["CreatedTS"].fillna(pd.Timestamp("1990-01-01", tz="UTC"))
+
+    if "idPartner" in df_clean.columns:
+        df_clean["idPartner"]= pd.to_numeric(df_clean["idPartner"], errors='coerce').fillna(0).astype(np.int64)     
+
+    # Layout de particiones: el de la tabla existente o, si es nueva, el derivado de partition_info
+    partition_by = resolve_partition_columns(table_path, storage_options, df_clean, write_options.get("partition_info"))
+
+    # Mantener la codificación por diccionario hasta el writer de Parquet, salvo en las columnas de
+    # partición: delta-rs necesita su valor plano
+    df_clean = encode_low_cardinality(df_clean, exclude=partition_by)
+    return conform_partition_columns(df_clean, partition_by)
+
+
+def _log_operation(_audit_writer, _conn_mgr_fabric, *args):
+    """Registra en IngestaLogOperation: encolado en `_audit_writer` si existe, si no de forma síncrona."""
+    if _audit_writer is not None:
+        return _audit_writer.log_operation(*args)
+    return log_operation(_conn_mgr_fabric, *args)
+
+
+def commit_data(data, project_name, table_name, _process_execution_id, table_path, _conn_mgr_fabric, _process_name, _notebookutils, _write_deltalake, _write_options=None, _lakehouse=None, _state_store=None, _audit_writer=None):
+    """
+    Escribe en Delta Lake datos ya preparados (DataFrame o pyarrow.Table) en un solo commit
+    y registra la confirmación en IngestaLogOperation.
+
+    Args:
+        _process_execution_id: id de ejecución, o lista de ids cuando los datos agrupan varios
+            batches (modo pipelined / coalescer); se registra la confirmación para cada uno.
+        _write_options: dict opcional de `get_table_write_options`. Con write_mode='merge' se hace
+            upsert por llave primaria + idPartner; en otro caso se agrega (append).
+        _lakehouse: `LakehouseTarget` opcional (ver `get_lakehouse_target`) que entrega las opciones
+            de almacenamiento del backend (file://, s3://); por defecto OneLake con `_notebookutils`.
+        _state_store: `WatermarkStore` opcional; tras el commit confirma los watermarks pendientes de
+            las ejecuciones y envía la confirmación a IngestaLogOperation en segundo plano.
+        _audit_writer: `AuditWriter` opcional; los registros de IngestaLogOperation se encolan en
+            lugar de enviarse en el hilo del commit (sin `_state_store`).
+    """
+    execution_ids = _process_execution_id if isinstance(_process_execution_id, (list, tuple)) else [_process_execution_id]
+    audit_writer = _state_store if _state_store is not None else _audit_writer
+    try: 
+        write_options = _write_options or {}
+        records_quantity = data.num_rows if isinstance(data, pa.Table) else len(data)
         
-        if "CreatedTS" in df_clean.columns:
-            df_clean["CreatedTS"] = pd.to_datetime(df_clean["CreatedTS"], errors="coerce", utc=True)
-            df_clean["CreatedTS"] = df_clean["CreatedTS"].fillna(pd.Timestamp("1990-01-01", tz="UTC"))
-
-        if "idPartner" in df_clean.columns:
-            df_clean["idPartner"]= pd.to_numeric(df_clean["idPartner"], errors='coerce').fillna(0).astype(np.int64)     
-        # Otener desde df_schema el valor del campo source_table en la vatiable table_name
-        # para usarlo en el log de recolección de confirmación
-        
-        source_table = df_clean["source_table"].iloc[0]
+        # Otener el valor del campo source_table para usarlo en el log de recolección de confirmación
+        if isinstance(data, pa.Table):
+            source_table = data.column("source_table")[0].as_py()
+        else:
+            source_table = data["source_table"].iloc[0]
 
         # Guardar los datos en Delta Lake
-        storage_options = {
-            "bearer_token": _notebookutils.credentials.getToken("storage"),
-            "use_fabric_endpoint": "true"
-        }
-        _write_deltalake(table_path, df_clean, mode='append', schema_mode='merge', engine='rust', storage_options=storage_options)
+        storage_options = _lakehouse.storage_options() if _lakehouse is not None else get_storage_options(_notebookutils)
+        # En la misma sesión se reutiliza el plan de `prepare_data`; con chunks recuperados de staging
+        # en una sesión nueva (tabla aún sin crear) se planifica sobre el lote recuperado
+        partition_by = resolve_partition_columns(table_path, storage_options, data, write_options.get("partition_info"))
+        data = conform_partition_columns(data, partition_by)
+
+        # Ordenar por (idPartner, watermark) para que las estadísticas de cada archivo permitan descartarlo
+        data = cluster_data(data, write_options.get("sort_columns"))
+        write_kwargs = build_write_kwargs(write_options)
+        ensure_table_properties(table_path, storage_options, write_kwargs.get("configuration"))
+
+        # Los datos se reciben como argumento: el closure no retiene `data`, que se libera al final
+        def _write(frame):
+            merge_metrics = None
+            if write_options.get("write_mode") == "merge":
+                merge_metrics = merge_to_delta(table_path, frame, write_options.get("key_columns"), storage_options,
+                                               write_options.get("watermark_column"), write_options.get("prune_by_watermark", False),
+                                               write_kwargs.get("writer_properties"))
+                if merge_metrics is None:
+                    log(f"ℹ️ La tabla {table_name} aún no existe, se crea con append", level="info")
+
+            if merge_metrics is None:
+                _write_deltalake(table_path, frame, mode='append', schema_mode='merge', engine='rust', storage_options=storage_options,
+                                 partition_by=partition_by or None, **write_kwargs)
+            return merge_metrics
+
+        # Reintentar si otro writer hizo commit sobre la misma tabla (concurrencia optimista)
+        with span("save_data", table=table_name, rows=records_quantity, execution_ids=execution_ids), \
+                metrics.timer("stage_seconds", stage="write", table=table_name):
+            merge_metrics = retry_on_conflict(functools.partial(_write, data), table_name)
+        metrics.inc("rows_total", records_quantity, stage="write", table=table_name)
+        metrics.inc("bytes_total", data.nbytes if isinstance(data, pa.Table) else int(data.memory_usage(deep=True).sum()), stage="write", table=table_name)
+        # El merge ya reporta sus archivos; el historial de un append sólo se lee si se pidió (lectura extra del log)
+        commit_metrics = merge_metrics or (get_last_commit_metrics(table_path, storage_options) if write_options.get("commit_metrics") else {})
+        if commit_metrics:
+            metrics.inc("files_total", commit_metrics.get("num_added_files", commit_metrics.get("num_target_files_added", 0)), stage="write", table=table_name)
        
       
         # Guardar log de recolección de confirmación
-        log_operation(_conn_mgr_fabric, project_name, 0, source_table, '', '',
-                                  '', '', _process_name, '', 'Success ',
-                                  _process_execution_id, 'UU', '', '', '')
+        if _state_store is not None:
+            _state_store.confirm(execution_ids, table_name)
+        for execution_id in execution_ids:
+            _log_operation(audit_writer, _conn_mgr_fabric, project_name, 0, source_table, '', '',
+                                      '', '', _process_name, '', 'Success ',
+                                      execution_id, 'UU', '', '', '')
 
         
         log(f"✅ Guardado exitoso: {records_quantity} registros en {table_name}.", level="info")
 
-        del df_data
-        del df_clean
+        del data
         gc.collect()
         return True  # Indicar éxito
 
 
     except Exception as e:
          # Guardar log de recolección de confirmación
-        log_operation(_conn_mgr_fabric, project_name, 0, table_name, '', '',
-                                  '', '', _process_name, f"❌ Error al guardar en Delta Lake: {e}", 'Error ',
-                                  _process_execution_id, 'UU', '', '', 'False')
+        for execution_id in execution_ids:
+            _log_operation(audit_writer, _conn_mgr_fabric, project_name, 0, table_name, '', '',
+                                      '', '', _process_name, f"❌ Error al guardar en Delta Lake: {e}", 'Error ',
+                                      execution_id, 'UU', '', '', 'False')
 
         log(f"❌ Error al guardar la tabla {table_name} en Delta Lake: {e}", level="error")
         gc.collect()
         return False  # Indicar fallo
+
+
+def save_data(df_data, project_name, table_name, df_schema, _process_execution_id, table_path, _conn_mgr_fabric, _process_name, _notebookutils, _write_deltalake, _write_options=None, _lakehouse=None):
+    """
+    Limpia y guarda los datos de una tabla en Delta Lake (`prepare_data` + `commit_data`).
+
+    Args:
+        _process_execution_id: id de ejecución o lista de ids (ver `commit_data`).
+        _write_options: dict opcional de `get_table_write_options`.
+        _lakehouse: `LakehouseTarget` opcional (ver `commit_data`).
+    """
+    execution_ids = _process_execution_id if isinstance(_process_execution_id, (list, tuple)) else [_process_execution_id]
+    try: 
+        log(f"💾 Recurso {table_name} |  Se guardarán {len(df_data)} registros...", level="info")
+        storage_options = _lakehouse.storage_options() if _lakehouse is not None else get_storage_options(_notebookutils)
+        df_clean = prepare_data(df_data, table_name, df_schema, table_path, storage_options, _write_options)
+        del df_data
+    except Exception as e:
+        for execution_id in execution_ids:
+            log_operation(_conn_mgr_fabric, project_name, 0, table_name, '', '',
+                                      '', '', _process_name, f"❌ Error al preparar los datos: {e}", 'Error ',
+                                      execution_id, 'UU', '', '', 'False')
+
+        log(f"❌ Error al preparar la tabla {table_name}: {e}", level="error")
+        gc.collect()
+        return False  # Indicar fallo
+
+    return commit_data(df_clean, project_name, table_name, _process_execution_id, table_path, _conn_mgr_fabric, _process_name, _notebookutils, _write_deltalake, _write_options, _lakehouse)
     
 
-def fetch_data(engine, query, max_retries=10, wait_seconds=30):
+def fetch_data(engine, query, max_retries=10, wait_seconds=30, params=None):
     result = {
         "success": False,
         "data": None,
@@ -321,7 +436,7 @@ def fetch_data(engine, query, max_retries=10, wait_seconds=30):
 
     while attempt < max_retries:
         try:
-            df = pd.read_sql(query, engine)
+            df = pd.read_sql(query, engine, params=params)
             result["success"] = True
             result["data"] = df
             return result
@@ -351,7 +466,7 @@ def fetch_data(engine, query, max_retries=10, wait_seconds=30):
     return result
 
 
-def fetch_data_pagination(engine, query, page_size=5000, max_retries=10, wait_seconds=30):
+def fetch_data_pagination(engine, query, page_size=5000, max_retries=10, wait_seconds=30, params=None):
     """
     Extrae datos de SQL Server en bloques paginados y retorna un único DataFrame.
 
@@ -361,6 +476,7 @@ def fetch_data_pagination(engine, query, page_size=5000, max_retries=10, wait_se
         page_size (int): Cantidad de registros por página.
         max_retries (int): Número máximo de reintentos en caso de timeout.
         wait_seconds (int): Tiempo de espera entre reintentos.
+        params (tuple): Parámetros posicionales (?) de la consulta, se envían en cada página.
 
     Returns:
         dict con:
@@ -380,7 +496,15 @@ def fetch_data_pagination(engine, query, page_size=5000, max_retries=10, wait_se
                     {query}                    
                     OFFSET {offset} ROWS FETCH NEXT {page_size} ROWS ONLY
                 """
-                df_page = pd.read_sql(paginated_query, engine)
+                page_start = time.perf_counter()
+                with span("fetch_page", offset=offset, page_size=page_size):
+                    df_page = pd.read_sql(paginated_query, engine, params=params)
+                page_seconds = time.perf_counter() - page_start
+                metrics.observe("page_seconds", page_seconds, stage="fetch")
+                metrics.observe("stage_seconds", page_seconds, stage="fetch")
+                metrics.observe("page_rows", len(df_page), buckets=SIZE_BUCKETS, stage="fetch")
+                metrics.inc("rows_total", len(df_page), stage="fetch")
+                metrics.inc("bytes_total", int(df_page.memory_usage(deep=True).sum()), stage="fetch")
 
                 # Si no trae más filas, fin de la paginación
                 if df_page.empty:
@@ -405,6 +529,7 @@ def fetch_data_pagination(engine, query, page_size=5000, max_retries=10, wait_se
                 if "timeout" in str(e).lower():
                     result["error"] = "timeout"
                     attempt += 1
+                    metrics.inc("retries_total", stage="fetch")
                     log(f"⏳ Timeout en intento {attempt} (offset {offset}). Reintentando en {wait_seconds}s...", level="warning")
                     time.sleep(wait_seconds)
                 else:
@@ -426,112 +551,148 @@ def fetch_data_pagination(engine, query, page_size=5000, max_retries=10, wait_se
             return result
 
 
-def fetch_all_data(row, resource, _process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, df_watermarks=None):
+def fetch_all_data(row, resource, _process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, df_watermarks=None, _audit_writer=None):
     """
     Extrae todos los datos de las tablas según los recursos especificados.
     
     Args:
-        df_watermarks: DataFrame opcional con los watermarks cacheados para optimizar consultas.
-                    Si no se proporciona, se harán consultas individuales.
+        df_watermarks: `WatermarkIndex` o `WatermarkStore` opcional con los watermarks cacheados para
+                    optimizar consultas. Si no se proporciona, se harán consultas individuales.
+        _audit_writer: `AuditWriter` opcional donde se encolan los registros de IngestaLogOperation.
     """
     conn_source = create_db_connection(row['serverdb'], 1433, row['db'], row['userDB'], row['userDBPwd'])
 
     grouped_extracted_data = defaultdict(list)
     for (resource_grouped, project), group in resource.groupby(["resource_name", "project"]):
-        log(f"🔹 PLATFORM → {row['id_Partner']} | Recurso {resource_grouped} | Proyecto: {project}", level="info")
+        log("🔹 PLATFORM → %s | Recurso %s | Proyecto: %s", row['id_Partner'], resource_grouped, project, level="info")
 
         id_partner = row['id_Partner']
         table_name_source = group['table_name'].iloc[0]
-        is_incremental = bool(group["is_incremental"].iloc[0])  # fuerza a booleano
-        last_watermark = None
-        current_watermark = None
-
-        # Determinar el schema correcto
-        schema = None
-        if 'schem' in row and pd.notna(row['schem']):
-            schema = row['schem']
-            log(f"Usando schema de row: {schema}", level="info")
-        elif 'schem' in group.columns and pd.notna(group['schem'].iloc[0]):
-            schema = group['schem'].iloc[0]
-            log(f"Usando schema de resource: {schema}", level="info")
-        else:
-            schema = 'dbo'
-            log(f"No se encontró schema, usando valor por defecto: {schema}", level="warning")
+        # Se restablece al salir de `log_context` en `process_platform_connection`
+        bind_log_context(project=project, table=table_name_source)
+        with span("fetch_table", project=project, table=table_name_source, resource=resource_grouped):
+            is_incremental = bool(group["is_incremental"].iloc[0])  # fuerza a booleano
+            last_watermark = None
+            current_watermark = None
+            query_params = None
+
+            # Determinar el schema correcto
+            schema = None
+            if 'schem' in row and pd.notna(row['schem']):
+                schema = row['schem']
+                log("Usando schema de row: %s", schema, level="info")
+            elif 'schem' in group.columns and pd.notna(group['schem'].iloc[0]):
+                schema = group['schem'].iloc[0]
+                log("Usando schema de resource: %s", schema, level="info")
+            else:
+                schema = 'dbo'
+                log("No se encontró schema, usando valor por defecto: %s", schema, level="warning")
         
         
     
-        # Obtener columnas validas usando el schema ya determinado
-        columns = get_valid_columns(conn_source, table_name_source, schema)
-        columns_sql = ", ".join(columns)
+            # Obtener columnas validas usando el schema ya determinado
+            column_types = get_column_types(conn_source, table_name_source, schema)
+            columns = get_valid_columns(conn_source, table_name_source, schema, column_types)
+            columns_sql = ", ".join(columns)
 
 
-        if is_incremental:
-            # Si es incremental → aplicamos filtro por watermark
-            last_watermark = get_last_watermark(project, row['id_Partner'], table_name_source, group['watermark_type'].iloc[0],  _conn_mgr_fabric, _environment, _log_table, df_watermarks)
-            current_watermark = get_current_watermark(conn_source, f"{schema}.{table_name_source}", group['watermark_column'].iloc[0], group['watermark_type'].iloc[0])
+            if is_incremental:
+                # Si es incremental → aplicamos filtro por watermark
+                last_watermark = get_last_watermark(project, row['id_Partner'], table_name_source, group['watermark_type'].iloc[0],  _conn_mgr_fabric, _environment, _log_table, df_watermarks)
+                current_watermark = get_current_watermark(conn_source, f"{schema}.{table_name_source}", group['watermark_column'].iloc[0], group['watermark_type'].iloc[0])
            
-            query = f"""
-                SELECT {columns_sql}
-                FROM {schema}.{table_name_source}
-                WHERE {group['watermark_column'].iloc[0]} > '{last_watermark}'
-                AND {group['watermark_column'].iloc[0]} <= '{current_watermark}'
-                ORDER BY  {group['watermark_column'].iloc[0]}
-            """
-        else:
-            query = f"""
-                SELECT {columns_sql}
-                FROM {schema}.{table_name_source}
-                ORDER BY 1
-            """
+                if last_watermark is None or current_watermark is None:
+                    raise RuntimeError(f"No se pudo determinar el rango de watermark de {table_name_source}")
+
+                # Rango como parámetros: el driver recibe el valor nativo (sin conversión implícita desde
+                # texto) y las fechas se comparan con el tipo de la columna
+                placeholder = sql_placeholder(column_types.get(group['watermark_column'].iloc[0]))
+                query = f"""
+                    SELECT {columns_sql}
+                    FROM {schema}.{table_name_source}
+                    WHERE {group['watermark_column'].iloc[0]} > {placeholder}
+                    AND {group['watermark_column'].iloc[0]} <= {placeholder}
+                    ORDER BY  {group['watermark_column'].iloc[0]}
+                """
+                query_params = (last_watermark.to_param(), current_watermark.to_param())
+            else:
+                query = f"""
+                    SELECT {columns_sql}
+                    FROM {schema}.{table_name_source}
+                    ORDER BY 1
+                """
                 
-        log(f"Ejecutando consulta en {table_name_source} | Incremental: {is_incremental} | Last Watermark: {last_watermark} | Current Watermark: {current_watermark}", level="info")
+            log("Ejecutando consulta en %s | Incremental: %s | Last Watermark: %s | Current Watermark: %s",
+                table_name_source, is_incremental, last_watermark, current_watermark, level="info")
         
-        response = fetch_data_pagination(conn_source, query)
-        if response["success"]:
+            response = fetch_data_pagination(conn_source, query, params=query_params)
+            if response["success"]:
                         
-            df_extracted_data = response["data"]
-            # Añadir columnas adicionales
-            if "idPartner" in df_extracted_data.columns:
-                if int(id_partner) > 1:
+                df_extracted_data = response["data"]
+                # Añadir columnas adicionales
+                if "idPartner" in df_extracted_data.columns:
+                    if int(id_partner) > 1:
+                        df_extracted_data["idPartner"] = id_partner
+                else:
                     df_extracted_data["idPartner"] = id_partner
-            else:
-                df_extracted_data["idPartner"] = id_partner
 
-            df_extracted_data["source_table"] = table_name_source
-            df_extracted_data["CreatedTS"] = pd.Timestamp.utcnow()  
+                df_extracted_data["source_table"] = table_name_source
+                df_extracted_data["CreatedTS"] = pd.Timestamp.utcnow()  
 
-            records_quantity = len(df_extracted_data)
-            log(f"✅ PLATFORM → {row['id_Partner']} | {table_name_source} | Se extrajeron {records_quantity} registros de la tabla {table_name_source} | Plataforma  {id_partner}", level="info")
+                # Deduplicar por llave primaria (+ idPartner) conservando el último por watermark
+                key_columns = get_primary_key_columns(group['keys_info'].iloc[0]) if 'keys_info' in group.columns else []
+                if key_columns:
+                    if "idPartner" not in key_columns:
+                        key_columns.append("idPartner")
+                    order_column = group['watermark_column'].iloc[0] if is_incremental else None
+                    df_extracted_data = deduplicate_by_keys(df_extracted_data, key_columns, order_column)
 
-            if df_extracted_data is not None and not df_extracted_data.empty:
-                if resource_grouped in grouped_extracted_data:
-                    grouped_extracted_data[resource_grouped] = pd.concat([grouped_extracted_data[resource_grouped], df_extracted_data], ignore_index=True)
-                else:
-                        grouped_extracted_data[resource_grouped] = df_extracted_data
+                df_extracted_data = encode_low_cardinality(df_extracted_data)
 
+                records_quantity = len(df_extracted_data)
+                log("✅ PLATFORM → %s | %s | Se extrajeron %s registros de la tabla %s | Plataforma  %s",
+                    row['id_Partner'], table_name_source, records_quantity, table_name_source, id_partner, level="info")
 
+                if df_extracted_data is not None and not df_extracted_data.empty:
+                    if resource_grouped in grouped_extracted_data:
+                        grouped_extracted_data[resource_grouped] = concat_dataframes([grouped_extracted_data[resource_grouped], df_extracted_data])
+                    else:
+                            grouped_extracted_data[resource_grouped] = df_extracted_data
 
-            #  Generar log de recolección de datos  
-            status = "empty" if df_extracted_data is None or df_extracted_data.empty else "pending"          
-            log_operation(_conn_mgr_fabric, project, id_partner, table_name_source, group['watermark_column'].iloc[0], current_watermark,
-                        last_watermark, records_quantity, _process_name, '', status, 
-                        _process_execution_id, 'I', _environment, row['db'], is_incremental)     
 
 
-        else:
-            log(f"❌ Error al obtener datos: {response['error']}", level="error")
-            raise RuntimeError(f"Error en fetch_data: {response['error']}")
+                #  Generar log de recolección de datos  
+                status = "empty" if df_extracted_data is None or df_extracted_data.empty else "pending"          
+                if isinstance(df_watermarks, WatermarkStore):
+                    # Estado local: el watermark queda pendiente hasta el commit y el log se envía en segundo plano
+                    if is_incremental and status == "empty":
+                        df_watermarks.advance(id_partner, table_name_source, current_watermark)
+                    elif is_incremental:
+                        df_watermarks.record_extracted(_process_execution_id, resource_grouped, id_partner, table_name_source, current_watermark)
+                    df_watermarks.log_operation(project, id_partner, table_name_source, group['watermark_column'].iloc[0], current_watermark,
+                                last_watermark, records_quantity, _process_name, '', status, 
+                                _process_execution_id, 'I', _environment, row['db'], is_incremental)
+                else:
+                    _log_operation(_audit_writer, _conn_mgr_fabric, project, id_partner, table_name_source, group['watermark_column'].iloc[0], current_watermark,
+                                last_watermark, records_quantity, _process_name, '', status, 
+                                _process_execution_id, 'I', _environment, row['db'], is_incremental)     
+
+
+            else:
+                log(f"❌ Error al obtener datos: {response['error']}", level="error")
+                raise RuntimeError(f"Error en fetch_data: {response['error']}")
 
     return grouped_extracted_data
 
 
-def process_platform_connection(_row, _resource, _process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, _max_retries, _retry_wait, df_watermarks=None):
+def process_platform_connection(_row, _resource, _process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, _max_retries, _retry_wait, df_watermarks=None, _audit_writer=None):
     """
     Lógica de ingesta para una conexión con reintentos.
     
     Args:
-        df_watermarks: DataFrame opcional con los watermarks cacheados para optimizar consultas.
+        df_watermarks: `WatermarkIndex` opcional con los watermarks cacheados para optimizar consultas.
                     Si no se proporciona, se harán consultas individuales.
+        _audit_writer: `AuditWriter` opcional (ver `fetch_all_data`).
     """
     start_time = time.time()
     intentos = 0
@@ -539,14 +700,20 @@ def process_platform_connection(_row, _resource, _process_execution_id, _conn_mg
     while intentos < _max_retries:
         try:
             intentos += 1
-            log(f"➡ [{intentos}/{_max_retries}] Iniciando {_row['id_Partner']} {_row['db']} en {_row['serverdb']}")
-                            
-            return fetch_all_data(_row, _resource, _process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, df_watermarks)
+            log("➡ [%s/%s] Iniciando %s %s en %s", intentos, _max_retries, _row['id_Partner'], _row['db'], _row['serverdb'])
+
+            # El batch es el sufijo del id de ejecución ({id global}-{batch})
+            with log_context(partner=_row['id_Partner'], execution_id=_process_execution_id,
+                             batch=str(_process_execution_id).rsplit('-', 1)[-1]), \
+                    span("process_platform_connection", execution_id=_process_execution_id, partner=_row['id_Partner'],
+                         db=_row['db'], attempt=intentos):
+                return fetch_all_data(_row, _resource, _process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, df_watermarks, _audit_writer)
             # return f"OK - {_row['id_Partner']} "          
 
 
         except Exception as e:
             log(f"⚠️ Error en intento {intentos} para {_row['db']}: {str(e)}", level="warning")
+            metrics.inc("retries_total", stage="platform", partner=_row['id_Partner'])
             if intentos < _max_retries:
                 log(f"⏳ Esperando {_retry_wait} segundos antes de reintentar...")
                 time.sleep(_retry_wait)
@@ -555,70 +722,222 @@ def process_platform_connection(_row, _resource, _process_execution_id, _conn_mg
                 return f"ERROR - {_row['db']}: {str(e)}"
             
 
-def procces_project(resource_project, df_pf_TryController, df_block_conns, df_schema, _conn_mgr_fabric, _process_name, _environment, _log_table, _max_retries, _retry_wait, _max_workers, _time_sleep, _notebookutils, _write_deltalake, _gl_process_execution_id):
-        from watermark_utils import get_all_last_watermarks
-        
-        # Obtener todos los watermarks una sola vez al inicio
-        df_watermarks = get_all_last_watermarks(resource_project, _conn_mgr_fabric, _environment, _log_table)
-        
-        process_number = 0
-        batches = get_batches(df_block_conns, batch_size=_max_workers)
-        total_batches = len(batches)
-        
-        if total_batches == 0:
-            log("⚠️ No hay registros para procesar", level="warning")
-            return
-            
-        for batch_num, df_batch in enumerate(batches, start=1):
-            log(f"🚀 Procesando batch {batch_num} de {total_batches} con {len(df_batch)} plataformas", level="info")
-            resultados = []            
-            process_number += 1
-            # Generar un UUID como id de ejecucción
-            
-            process_execution_id  = str(_gl_process_execution_id) + '-' + str(process_number)
-            grouped_by_table = defaultdict(list)
-            with ThreadPoolExecutor(max_workers=_max_workers) as executor:
-                futures = [executor.submit(process_platform_connection, row, df_pf_TryController, process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, _max_retries, _retry_wait, df_watermarks) for _, row in df_batch.iterrows()]
-                for future in as_completed(futures):
-                    try:
-                        result = future.result() 
-                        if result is None:
-                            continue
-                        for table_name, df in result.items():
-                            if df is not None and not df.empty:
-                                grouped_by_table[table_name].append(df)
-
-                        log("✅ Future completado y consolidado", level="info")
-                        
-                    except Exception as e:
-                        log(f"❌ Error en future: {e}", level="error")
-                    
-
-         
-            # 🔹 Concatenar DataFrames por tabla
-            final_data_by_table = {
-                table_name: pd.concat(dfs, ignore_index=True)
-                for table_name, dfs in grouped_by_table.items()
-            }
+def procces_project(resource_project, df_pf_TryController, df_block_conns, df_schema, _conn_mgr_fabric, _process_name, _environment, _log_table, _max_retries, _retry_wait, _max_workers, _time_sleep, _notebookutils, _write_deltalake, _gl_process_execution_id, _pipelined=False, _flush_rows=1000000, _flush_bytes=256 * 1024 * 1024, _flush_seconds=300, _maintenance=False, _max_writers=4, _adapter=None, _staging_dir=None, _state_store_path=None, _async_audit=False, _metrics_dir=None, _trace_dir=None, _trace_chrome=False, _prewarm_connections=False):
+        """
+        Ejecuta la ingesta de un proyecto por batches de plataformas y guarda los datos por tabla.
+
+        Args:
+            _pipelined: si es True, cada resultado pasa a un writer en segundo plano apenas termina
+                su future (sin barrera por batch ni `_time_sleep`), de modo que la extracción del
+                siguiente batch se solapa con la escritura del actual.
+            _flush_rows / _flush_bytes / _flush_seconds: umbrales del `CommitCoalescer` que agrupa
+                en un solo commit por tabla los datos de varios partners y batches.
+            _max_writers: commits de tablas distintas que se escriben en paralelo; los commits de
+                una misma tabla se serializan en orden.
+            _adapter: `ws_de.Adapter` opcional; si se entrega, el destino se resuelve con la conexión
+                lógica `lakehouse` (carpeta local o MinIO fuera de Fabric). Sin él se usa OneLake.
+            _staging_dir: carpeta de staging opcional. Los datos limpios se persisten ahí hasta su
+                commit y, al iniciar, se escriben primero los chunks que una corrida anterior dejó
+                sin commit (sin volver a leer los orígenes).
+            _state_store_path: archivo SQLite opcional para el estado local de watermarks
+                (`WatermarkStore`): las lecturas no van a Fabric SQL y los logs de cada tabla se
+                envían en segundo plano. Al iniciar se reconcilia con DataOn.LastWatermarkState.
+            _async_audit: si es True (y sin `_state_store_path`), los registros de IngestaLogOperation
+                se encolan en un `AuditWriter` que los envía por lotes en segundo plano; los workers
+                no esperan a Fabric SQL. La cola se vacía al terminar el proyecto. No se combina con
+                `_staging_dir`: la cola vive sólo en memoria y, si la sesión muere, los chunks en
+                staging sobreviven sin sus registros 'pending' (con el watermark). En ese caso el
+                log es síncrono; para log asíncrono con staging usar `_state_store_path`.
+            _metrics_dir: carpeta opcional donde exportar al terminar las métricas de la corrida
+                (resumen JSON por etapa y textfile de Prometheus, ver `metrics_utils`).
+            _trace_dir: carpeta opcional; si se indica se registran spans por batch, partner, tabla,
+                página, limpieza, commit y log, y al terminar se exportan como JSON lines
+                (`tracing_utils`). Con `_trace_chrome` también en formato Trace Event de Chrome.
+            _prewarm_connections: si es True, antes de empezar se abren en paralelo las conexiones a
+                Fabric SQL para `_max_workers` workers, en lugar de que todos hagan login a la vez
+                en el primer batch.
+            _maintenance: si es True, al terminar se compactan (Z-order por idPartner y watermark),
+                se hace checkpoint y vacuum de las tablas escritas que superan los umbrales de
+                archivos pequeños (ver `maintenance_utils`).
+        """
+        from watermark_utils import get_all_last_watermarks, get_all_last_watermarks_from_log
+
+        run_span = None
+        if _trace_dir:
+            tracer.reset()
+            tracer.enable()
+            run_span = start_span("procces_project", execution_id=_gl_process_execution_id, project=resource_project)
+
+        state_store = None
+        # Destino de los registros de IngestaLogOperation (None = envío síncrono)
+        audit_writer = None
+
+        def _finish_run():
+            if audit_writer is not None:
+                audit_writer.close()
+            if _metrics_dir:
+                export_run_metrics(_metrics_dir, resource_project, _gl_process_execution_id)
+            if run_span is not None:
+                end_span(run_span)
+                export_trace(_trace_dir, resource_project, _gl_process_execution_id, chrome=_trace_chrome)
+                tracer.disable()
 
-            log("📊 Resumen de final_data_by_table:", level="info")
-            for table_name, df in final_data_by_table.items():
-                log(f"  - {table_name}: {len(df)} filas × {len(df.columns)} columnas", level="info")
+        try:
+            if _prewarm_connections:
+                _conn_mgr_fabric.prewarm(_max_workers)
+
+            if _state_store_path:
+                # Estado local reconciliado con Fabric SQL: sirve como índice de watermarks de la corrida
+                state_store = WatermarkStore(_state_store_path, resource_project, _environment, _conn_mgr_fabric).reconcile(_log_table)
+                audit_writer = state_store
+
+            process_number = 0
+            batches = get_batches(df_block_conns, batch_size=_max_workers)
+            total_batches = len(batches)
+
+            lakehouse = get_lakehouse_target(_adapter, _notebookutils)
+
+            def _table_path(table_name):
+                # path_to = f"LH_Bronze_{resource_project}.{table_name}_partition"
+                # path_to = f"LH_Bonze_Generals.{table_name}_partition"                  
+                return lakehouse.table_path(resource_project, table_name)
+
+            def _prepare_table(table_name, df, process_execution_id):
+                try:
+                    log(f"💾 Recurso {table_name} |  Preparando {len(df)} registros...", level="info")
+                    write_options = get_table_write_options(df_pf_TryController, table_name)
+                    return prepare_data(df, table_name, df_schema, _table_path(table_name), lakehouse.storage_options(), write_options)
+                except Exception as e:
+                    _log_operation(audit_writer, _conn_mgr_fabric, resource_project, 0, table_name, '', '',
+                                              '', '', _process_name, f"❌ Error al preparar los datos: {e}", 'Error ',
+                                              process_execution_id, 'UU', '', '', 'False')
+                    log(f"❌ Error al preparar la tabla {table_name}: {e}", level="error")
+                    return None
+
+            def _commit_table(table_name, data, process_execution_ids):
+                path_to = _table_path(table_name)
+                log(f"Guardando en {path_to}")
+                write_options = get_table_write_options(df_pf_TryController, table_name)
+                return commit_data(data, resource_project, table_name, process_execution_ids, path_to, _conn_mgr_fabric, _process_name, _notebookutils, _write_deltalake, write_options, lakehouse, state_store, audit_writer)
+
+            staging = StagingArea(_staging_dir, resource_project) if _staging_dir else None
+            coalescer = CommitCoalescer(_commit_table, target_rows=_flush_rows, target_bytes=_flush_bytes, max_latency_seconds=_flush_seconds,
+                                        max_writers=_max_writers, staging=staging)
+            if staging is not None and recover_staged(staging, coalescer):
+                # Los chunks recuperados se escriben (y sus watermarks se confirman) antes de leer los
+                # watermarks: si no, la extracción vuelve a leer el mismo rango y en append se duplica
+                coalescer.flush()
+                coalescer.wait_commits()
+                failed = [name for name, _, ok in coalescer.results if not ok]
+                if failed:
+                    log(f"❌ No se pudieron escribir los chunks recuperados de {sorted(set(failed))}; "
+                        f"se detiene la corrida para no duplicar datos", level="error")
+                    coalescer.close()
+                    return
+
+            if state_store is not None:
+                df_watermarks = state_store
+            else:
+                # Obtener todos los watermarks una sola vez al inicio (un registro por partner y tabla)
+                df_watermarks = get_all_last_watermarks(resource_project, _conn_mgr_fabric, _environment, _log_table)
+                if df_watermarks is None:
+                    # Sin estado: una consulta agrupada sobre IngestaLog en lugar de una por tabla
+                    df_watermarks = get_all_last_watermarks_from_log(resource_project, _conn_mgr_fabric, _environment)
+                if _async_audit and staging is not None:
+                    log("⚠️ _async_audit no se combina con _staging_dir (los registros en memoria no sobreviven "
+                        "a una caída); se usa log síncrono. Use _state_store_path para log asíncrono", level="warning")
+                elif _async_audit:
+                    audit_writer = AuditWriter(_conn_mgr_fabric)
+
+            if total_batches == 0:
+                log("⚠️ No hay registros para procesar", level="warning")
+                coalescer.close()
+                return
+
+            if _pipelined:
+                # Un solo pool para todos los batches: cada future entrega sus datos al writer al completarse
+                writer = PipelinedTableWriter(_prepare_table, coalescer)
+                try:
+                    with ThreadPoolExecutor(max_workers=_max_workers) as executor:
+                        futures = {}
+                        for batch_num, df_batch in enumerate(batches, start=1):
+                            process_execution_id = str(_gl_process_execution_id) + '-' + str(batch_num)
+                            log(f"🚀 Encolando batch {batch_num} de {total_batches} con {len(df_batch)} plataformas", level="info")
+                            for _, row in df_batch.iterrows():
+                                future = executor.submit(in_current_context(process_platform_connection), row, df_pf_TryController, process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, _max_retries, _retry_wait, df_watermarks, audit_writer)
+                                futures[future] = process_execution_id
+
+                        for future in as_completed(futures):
+                            try:
+                                result = future.result()
+                                if not isinstance(result, dict):
+                                    continue
+                                for table_name, df in result.items():
+                                    if df is not None and not df.empty:
+                                        writer.submit(table_name, compact_dtypes(df, df_schema.get(table_name)), futures[future])
+                                log("✅ Future completado y enviado al writer", level="info")
+                            except Exception as e:
+                                log(f"❌ Error en future: {e}", level="error")
+                finally:
+                    results = writer.close()
+                log(f"📊 Writer pipelined: {len(results)} escrituras, {sum(1 for *_, ok in results if not ok)} con error", level="info")
+            else:
+                for batch_num, df_batch in enumerate(batches, start=1):
+                    log(f"🚀 Procesando batch {batch_num} de {total_batches} con {len(df_batch)} plataformas", level="info")
+                    resultados = []            
+                    process_number += 1
+                    # Generar un UUID como id de ejecucción
+                    
+                    process_execution_id  = str(_gl_process_execution_id) + '-' + str(process_number)
+                    batch_span = start_span("batch", execution_id=process_execution_id, batch=batch_num, platforms=len(df_batch))
+                    grouped_by_table = defaultdict(list)
+                    with ThreadPoolExecutor(max_workers=_max_workers) as executor:
+                        futures = [executor.submit(in_current_context(process_platform_connection), row, df_pf_TryController, process_execution_id, _conn_mgr_fabric, _process_name, _environment, _log_table, _max_retries, _retry_wait, df_watermarks, audit_writer) for _, row in df_batch.iterrows()]
+                        for future in as_completed(futures):
+                            try:
+                                result = future.result() 
+                                if result is None:
+                                    continue
+                                for table_name, df in result.items():
+                                    if df is not None and not df.empty:
+                                        # Compactar dtypes mientras el lote se acumula en memoria
+                                        grouped_by_table[table_name].append(compact_dtypes(df, df_schema.get(table_name)))
+
+                                log("✅ Future completado y consolidado", level="info")
+                                
+                            except Exception as e:
+                                log(f"❌ Error en future: {e}", level="error")
+                            
 
-            
-            # Esperar antes de guardar
-            log(f"⏳ Esperando antes de guardar los datos en Fabric...", level="info")
+                 
+                    # 🔹 Concatenar DataFrames por tabla
+                    final_data_by_table = {
+                        table_name: concat_dataframes(dfs)
+                        for table_name, dfs in grouped_by_table.items()
+                    }
 
-            time.sleep(_time_sleep)
+                    log("📊 Resumen de final_data_by_table:", level="info")
+                    for table_name, df in final_data_by_table.items():
+                        log(f"  - {table_name}: {len(df)} filas × {len(df.columns)} columnas", level="info")
 
-            # Guardar por tabla
-            for table_name, df in final_data_by_table.items():
-                if not df.empty:
-                    log(f"✅ Guardando {len(df)} filas en la tabla {table_name} en Fabric...", level="info")                    
                     
-                    # path_to = f"LH_Bronze_{resource_project}.{table_name}_partition"
-                    # path_to = f"LH_Bonze_Generals.{table_name}_partition"                  
-                    path_to = f"abfss://WS_Data_Engineering@onelake.dfs.fabric.microsoft.com/LH_{resource_project}.Lakehouse/Tables/bronze/{table_name}"
-                    log(f"Guardando en {path_to}")
-                    result_save_data = save_data(df, resource_project, table_name, df_schema, process_execution_id, path_to, _conn_mgr_fabric, _process_name, _notebookutils, _write_deltalake)
-
+                    # Esperar antes de guardar
+                    log(f"⏳ Esperando antes de guardar los datos en Fabric...", level="info")
+
+                    time.sleep(_time_sleep)
+
+                    # Guardar por tabla
+                    for table_name, df in final_data_by_table.items():
+                        if not df.empty:
+                            log(f"✅ Guardando {len(df)} filas en la tabla {table_name} en Fabric...", level="info")                    
+                            coalescer.add(table_name, _prepare_table(table_name, df, process_execution_id), process_execution_id)
+                    end_span(batch_span)
+
+                results = coalescer.close()
+
+            if _maintenance:
+                with span("maintenance", project=resource_project), metrics.timer("stage_seconds", stage="maintenance"):
+                    maintain_project_tables(df_pf_TryController, dict.fromkeys(name for name, *_ in results), _table_path, lakehouse.storage_options())
+        finally:
+            # También si la corrida falla: vaciar la auditoría y exportar métricas y trace
+            _finish_run()
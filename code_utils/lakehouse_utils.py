@@ -0,0 +1,103 @@
+import os
+from urllib.parse import urlparse
+from logger_utils import log
+from credential_utils import get_storage_token
+
+
+ONELAKE_ROOT = "abfss://WS_Data_Engineering@onelake.dfs.fabric.microsoft.com"
+LAKEHOUSE_CONNECTION = "lakehouse"
+
+
+def fabric_storage_options(_notebookutils):
+    """Opciones de almacenamiento para escribir en OneLake con el token de storage de Fabric (en cache)."""
+    return {
+        "bearer_token": get_storage_token(_notebookutils),
+        "use_fabric_endpoint": "true"
+    }
+
+
+def s3_storage_options(resolved):
+    """
+    Opciones de almacenamiento para un bucket S3 compatible (MinIO local).
+
+    Lee `s3_endpoint`, `access_key` y `secret_key` de la conexión resuelta (o de las variables
+    MINIO_ENDPOINT / MINIO_ACCESS_KEY / MINIO_SECRET_KEY que usa docker-compose.local.yml).
+    """
+    endpoint = resolved.get("s3_endpoint") or os.getenv("MINIO_ENDPOINT", "http://localhost:9000")
+    options = {
+        "AWS_ENDPOINT_URL": endpoint,
+        "AWS_ACCESS_KEY_ID": resolved.get("access_key") or os.getenv("MINIO_ACCESS_KEY", "minioadmin"),
+        "AWS_SECRET_ACCESS_KEY": resolved.get("secret_key") or os.getenv("MINIO_SECRET_KEY", "minioadmin"),
+        "AWS_REGION": resolved.get("region") or "us-east-1",
+        # MinIO local no tiene un servicio de locking: los commits de una tabla ya se serializan en el writer
+        "AWS_S3_ALLOW_UNSAFE_RENAME": "true",
+    }
+    if endpoint.startswith("http://"):
+        options["AWS_ALLOW_HTTP"] = "true"
+    return options
+
+
+class LakehouseTarget:
+    """
+    Destino de las tablas bronze: raíz del lakehouse y opciones de almacenamiento.
+
+    Las opciones se obtienen en cada llamada a `storage_options` (no se guardan), así el token
+    de Fabric se toma del cache vigente al momento de cada commit.
+
+    Args:
+        backend (str): 'fabric', 'file' o 's3'.
+        root (str): raíz del lakehouse (abfss://..., ruta local absoluta o s3://bucket/prefijo).
+        storage_options_fn: callable() -> dict con las opciones para deltalake (o None).
+    """
+
+    def __init__(self, backend, root, storage_options_fn=None):
+        self.backend = backend
+        self.root = root.rstrip("/")
+        self.storage_options_fn = storage_options_fn
+
+    def table_path(self, project, table_name):
+        """Ruta de la tabla bronze de un recurso del proyecto."""
+        if self.backend == "fabric":
+            return f"{self.root}/LH_{project}.Lakehouse/Tables/bronze/{table_name}"
+        return f"{self.root}/LH_{project}/Tables/bronze/{table_name}"
+
+    def storage_options(self):
+        """Opciones de almacenamiento vigentes para deltalake."""
+        return self.storage_options_fn() if self.storage_options_fn else None
+
+
+def get_lakehouse_target(_adapter=None, _notebookutils=None, _logical_name=LAKEHOUSE_CONNECTION):
+    """
+    Resuelve el destino del lakehouse.
+
+    Sin `_adapter` se usa OneLake con el token de `_notebookutils` (comportamiento en Fabric).
+    Con un `ws_de.Adapter` se resuelve la conexión lógica `lakehouse` de docs/config.yml:
+        - descriptor de Fabric (Adapter con notebookutils) -> OneLake.
+        - endpoint file://ruta -> carpeta local (relativa al directorio de trabajo).
+        - endpoint s3://bucket/prefijo -> MinIO / S3 con las credenciales de la conexión.
+
+    Returns:
+        LakehouseTarget
+    """
+    if _adapter is None:
+        return LakehouseTarget("fabric", ONELAKE_ROOT, lambda: fabric_storage_options(_notebookutils))
+
+    resolved = _adapter.resolve(_logical_name)
+    if resolved.get("type") == "fabric":
+        notebookutils = resolved.get("notebookutils") or _notebookutils
+        return LakehouseTarget("fabric", ONELAKE_ROOT, lambda: fabric_storage_options(notebookutils))
+
+    endpoint = resolved.get("endpoint") or ""
+    parsed = urlparse(endpoint)
+    if parsed.scheme == "file":
+        root = os.path.abspath(parsed.netloc + parsed.path)
+        os.makedirs(root, exist_ok=True)
+        target = LakehouseTarget("file", root)
+    elif parsed.scheme in ("s3", "s3a"):
+        options = s3_storage_options(resolved)
+        target = LakehouseTarget("s3", f"s3://{parsed.netloc}{parsed.path}", lambda: dict(options))
+    else:
+        raise ValueError(f"❌ Endpoint de lakehouse no soportado para '{_logical_name}': '{endpoint}'")
+
+    log(f"🏠 Lakehouse {target.backend}: {target.root}", level="info")
+    return target
@@ -1,10 +1,62 @@
 # logger_utils.py
 
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import queue
+from contextlib import contextmanager
 
 # Variables de configuración global (podrían moverse a un config.json más adelante)
 LOGGING_ENABLED = True
 LOG_LEVEL = logging.INFO
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Campos de contexto que se agregan a cada registro (ver `log_context`)
+CONTEXT_FIELDS = ("project", "partner", "table", "batch", "execution_id")
+
+_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+
+_log_context = contextvars.ContextVar("log_context", default={})
+
+
+class ContextFilter(logging.Filter):
+    """Copia al registro los campos de contexto del hilo que emite (los de `extra` tienen prioridad)."""
+
+    def filter(self, record):
+        context = _log_context.get()
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, context.get(field))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro con nivel, mensaje, hilo y los campos de contexto presentes."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value if isinstance(value, (int, float, bool)) else str(value)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # La cola es en memoria: el registro se entrega sin formatear y el mensaje se arma en el hilo
+    # del listener, no en el worker que emite
+    def prepare(self, record):
+        return record
+
 
 # Crear el logger base
 logger = logging.getLogger("FabricPipelineLogger")
@@ -12,28 +64,78 @@ logger.propagate = False
 
 if not logger.handlers:  # Evita handlers duplicados
     handler = logging.StreamHandler()
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    formatter = logging.Formatter(LOG_FORMAT)
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # Los workers sólo encolan; un único hilo escribe al stream (sin contención por el lock del handler)
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logger.addHandler(queue_handler)
     logger.setLevel(LOG_LEVEL)
+    logger.stream_handler = handler
+    logger.queue_listener = logging.handlers.QueueListener(log_queue, handler)
+    logger.queue_listener.start()
+    atexit.register(logger.queue_listener.stop)
+
+handler = logger.stream_handler
+
 
 # Función para emitir logs
-def log(msg, level="info"):
+def log(msg, *args, level="info", **fields):
+    """
+    Emite un log. El nivel se revisa antes de formatear y el mensaje admite formato diferido
+    (`log("Página %s de %s", page, table, level="debug")`): si el nivel está deshabilitado no se
+    arma el texto. `fields` agrega campos de contexto (partner, table, ...) sólo a este registro.
+    """
     if not LOGGING_ENABLED:
         return
-    level = level.lower()
-    if level == "debug":
-        logger.debug(msg)
-    elif level == "warning":
-        logger.warning(msg)
-    elif level == "error":
-        logger.error(msg)
-    else:
-        logger.info(msg)
+    levelno = _LEVELS.get(level.lower(), logging.INFO)
+    if not logger.isEnabledFor(levelno):
+        return
+    logger.log(levelno, msg, *args, extra=fields or None, stacklevel=2)
+
+
+def bind_log_context(**fields):
+    """Agrega campos de contexto a los logs del hilo actual. Retorna el token para `reset_log_context`."""
+    context = {**_log_context.get(), **{k: v for k, v in fields.items() if v is not None}}
+    return _log_context.set(context)
+
+
+def reset_log_context(token):
+    _log_context.reset(token)
+
+
+def get_log_context():
+    """Campos de contexto vigentes en el hilo actual."""
+    return _log_context.get()
+
+
+@contextmanager
+def log_context(**fields):
+    """Campos de contexto (project, partner, table, batch, execution_id) para los logs del bloque."""
+    token = bind_log_context(**fields)
+    try:
+        yield
+    finally:
+        reset_log_context(token)
+
+
+def flush_logs():
+    """Espera a que el listener escriba los logs encolados."""
+    logger.queue_listener.stop()
+    logger.queue_listener.start()
+
 
 # Función para configurar logging dinámicamente
-def set_logging(enabled: bool = True, level: str = "INFO"):
+def set_logging(enabled: bool = True, level: str = "INFO", json_format: bool = None):
+    """
+    Configura el logging. Con `json_format=True` cada registro se escribe como una línea JSON
+    con los campos de contexto; con False vuelve al formato de texto.
+    """
     global LOGGING_ENABLED
     LOGGING_ENABLED = enabled
     logger.setLevel(getattr(logging, level.upper()))
+    if json_format is not None:
+        flush_logs()  # lo ya encolado se escribe con el formato anterior
+        handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
     logger.info(f"🔧 Logging {'activado' if enabled else 'desactivado'} con nivel {level.upper()}")
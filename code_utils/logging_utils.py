@@ -1,11 +1,36 @@
+import queue
+import random
+import threading
+import time
 from logger_utils import log, set_logging
+from metrics_utils import metrics
+from tracing_utils import span
+
+
+# Llamada ODBC al procedimiento: admite arreglos de parámetros (fast_executemany)
+LOG_OPERATION_CALL = "{CALL [DataOn].[IngestaLogOperation] (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)}"
+
+_STOP = object()
+
+
+def _operation_params(project_name, id_partner, table_name, watermark_column, current_watermark,
+                      last_watermark, records_quantity, pipeline_name, error, status,
+                      activity_id, op, environment, db, _is_incremental):
+    """Parámetros de IngestaLogOperation en el orden del procedimiento; los watermarks van como texto."""
+    params = (project_name, id_partner, table_name, watermark_column, str(current_watermark), str(last_watermark),
+              records_quantity, pipeline_name, error, status, activity_id, op, environment, db, _is_incremental)
+    # Escalares de numpy (idPartner int64, etc.) a tipos nativos para el driver
+    return tuple(value.item() if hasattr(value, "item") else value for value in params)
+
 
 # Función para ejecutar el procedimiento almacenado IngestaLogOperation
 def log_operation(_conn_mgr_fabric, project_name, id_partner, table_name, watermark_column, current_watermark,
                                   last_watermark, records_quantity, pipeline_name, error, status,
                                   activity_id, op, environment, db, _is_incremental):
     try:
-        with _conn_mgr_fabric.get_sql_connection().cursor() as log_cursor:
+        # La conexión vuelve al pool al salir del bloque
+        with span("log_operation", table=table_name, status=status), metrics.timer("stage_seconds", stage="audit"), \
+                _conn_mgr_fabric.get_sql_connection() as log_conn, log_conn.cursor() as log_cursor:
             # cursor = conn.cursor()
             log_cursor.execute("""
                 DECLARE @RC INT;
@@ -14,13 +39,144 @@ def log_operation(_conn_mgr_fabric, project_name, id_partner, table_name, waterm
             """,
         project_name, id_partner, table_name, watermark_column, str(current_watermark), str(last_watermark),
         records_quantity, pipeline_name, error, status, activity_id, op, environment, db, _is_incremental)
-        while log_cursor.nextset():
-            pass
-        log_cursor.commit()
+            while log_cursor.nextset():
+                pass
+            log_cursor.commit()
         # cursor.commit()
         return True
 
     except Exception as e:
         log(f"❌ Error al registrar la operacion en IngestaLogOperation: {e}", level="error")
         return None
-    
+
+
+class AuditWriter:
+    """
+    Escritor en segundo plano de los registros de auditoría (DataOn.IngestaLogOperation).
+
+    Los workers sólo encolan con `log_operation` (mismos argumentos que la función sin
+    `_conn_mgr_fabric`) y siguen; un hilo toma los registros de la cola en lotes de hasta
+    `batch_size` y los envía con `executemany` + `fast_executemany` en una sola transacción,
+    en el orden en que se encolaron. Si el envío falla se reintenta el lote completo con espera
+    exponencial; `close` vacía la cola antes de terminar.
+
+    La cola está acotada (`max_queue`): si Fabric SQL no da abasto, `log_operation` espera en
+    lugar de acumular registros sin límite. Los registros viven sólo en memoria; para que
+    sobrevivan a la sesión usar la bandeja de `WatermarkStore`.
+
+    Args:
+        _conn_mgr_fabric: administrador de conexiones de Fabric SQL.
+        batch_size (int): registros máximos por envío.
+        linger_seconds (float): espera para completar un lote después del primer registro.
+        max_retries (int): intentos por lote antes de descartarlo.
+        backoff_seconds (float): espera base entre reintentos (crece exponencialmente).
+        max_queue (int): registros máximos en la cola.
+    """
+
+    def __init__(self, _conn_mgr_fabric, batch_size=200, linger_seconds=0.5, max_retries=5, backoff_seconds=1.0, max_queue=10000):
+        self.conn_mgr = _conn_mgr_fabric
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.stats = {"enqueued": 0, "sent": 0, "failed": 0, "batches": 0, "retries": 0}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="AuditWriter", daemon=True)
+        self._thread.start()
+
+    def log_operation(self, *args):
+        """Encola un registro de IngestaLogOperation; retorna True sin esperar el envío."""
+        with self._lock:
+            if not self._closed:
+                self._queue.put(_operation_params(*args))
+                self.stats["enqueued"] += 1
+                metrics.set_gauge("queue_depth", self._queue.qsize(), queue="audit")
+                return True
+        # Después de `close` ya no hay hilo que envíe: se registra de forma síncrona
+        return log_operation(self.conn_mgr, *args)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        """Toma un lote de la cola. Retorna (lote, se_pidio_detener)."""
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.time() + self.linger_seconds
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _send(self, batch):
+        with self.conn_mgr.get_sql_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.fast_executemany = True
+                # fast_executemany enlaza por columna con el tipo de la primera fila: se envían por
+                # tramos consecutivos con los mismos tipos (ej. records_quantity '' vs int) para no
+                # alterar el orden
+                start = 0
+                for end in range(1, len(batch) + 1):
+                    if end == len(batch) or _row_types(batch[end]) != _row_types(batch[start]):
+                        cursor.executemany(LOG_OPERATION_CALL, batch[start:end])
+                        start = end
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def _send_with_retry(self, batch):
+        for attempt in range(self.max_retries):
+            try:
+                with span("log_operation_batch", rows=len(batch), attempt=attempt + 1), metrics.timer("stage_seconds", stage="audit"):
+                    self._send(batch)
+                self.stats["sent"] += len(batch)
+                self.stats["batches"] += 1
+                return True
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    self.stats["failed"] += len(batch)
+                    log(f"❌ Se descartan {len(batch)} registros de auditoría después de {self.max_retries} intentos: {e}", level="error")
+                    return False
+                self.stats["retries"] += 1
+                metrics.inc("retries_total", stage="audit")
+                wait_time = self.backoff_seconds * (2 ** attempt) * (1 + random.random())
+                log(f"⚠️ Error al enviar {len(batch)} registros de auditoría (intento {attempt + 1}), "
+                    f"reintentando en {wait_time:.1f}s... Error: {e}", level="warning")
+                time.sleep(wait_time)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if batch:
+                self._send_with_retry(batch)
+
+    def close(self, timeout=None):
+        """Vacía la cola (enviando lo pendiente) y detiene el hilo. Retorna las estadísticas."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log(f"⚠️ El escritor de auditoría no terminó en {timeout}s; quedan {self.pending()} registros en cola", level="warning")
+        log(f"📝 Auditoría: {self.stats['sent']} registros en {self.stats['batches']} envíos, "
+            f"{self.stats['retries']} reintentos, {self.stats['failed']} descartados", level="info")
+        return self.stats
+
+
+def _row_types(row):
+    return tuple(type(value) for value in row)
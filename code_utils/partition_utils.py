@@ -3,6 +3,8 @@ import time   # módulo completo → para sleep
 import datetime  # módulo completo → para datetime.datetime y datetime.time
 import math
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 
 def get_block_number(total_blocks=4):
@@ -95,4 +97,106 @@ def get_block_number_in_window(total_blocks, window_start_hour, window_end_hour,
     block_index = int(current_pos // minutes_per_block)
     if block_index >= total_blocks:
         block_index = total_blocks - 1
-    return block_index
\ No newline at end of file
+    return block_index
+
+
+# Tipos de `type_field` (DataOn.PartitionFields) que se particionan por mes
+DATE_PARTITION_TYPES = ("date", "datetime", "datetime2", "smalldatetime", "datetimeoffset", "timestamp")
+# Máximo de valores distintos para particionar por identidad; por encima se usan buckets
+MAX_PARTITION_VALUES = 200
+PARTITION_BUCKETS = 32
+
+
+def plan_partition_columns(df, partition_info, max_values=MAX_PARTITION_VALUES):
+    """
+    Decide las columnas de partición de una tabla nueva a partir de `partition_info`.
+
+    - Campos fecha (`type_field` en DATE_PARTITION_TYPES) → columna derivada `<campo>_month` (AAAAMM).
+    - Otros campos con pocos valores distintos → el mismo campo (identidad).
+    - Otros campos con alta cardinalidad → columna derivada `<campo>_bucket` (hash % PARTITION_BUCKETS).
+
+    Args:
+        df (DataFrame | pa.Table): lote que crea la tabla (un pa.Table al recuperar chunks de staging).
+        partition_info: lista de dicts [{"field_name": ..., "type_field": ...}] o NaN/None.
+        max_values (int): máximo de valores distintos para particionar por identidad.
+
+    Returns:
+        list: nombres de columnas de partición (vacía si no hay campos válidos).
+    """
+    if not isinstance(partition_info, (list, tuple)):
+        return []
+
+    columns = df.column_names if isinstance(df, pa.Table) else df.columns
+    partition_columns = []
+    for item in partition_info:
+        field = item.get("field_name") if isinstance(item, dict) else None
+        if not field or field not in columns:
+            continue
+        type_field = str(item.get("type_field") or "").strip().lower()
+
+        if isinstance(df, pa.Table):
+            column = df.column(field)
+            if pa.types.is_dictionary(column.type):
+                column = column.cast(column.type.value_type)
+            is_datetime = pa.types.is_timestamp(column.type) or pa.types.is_date(column.type)
+            distinct = pc.count_distinct(column, mode="all").as_py()
+        else:
+            is_datetime = pd.api.types.is_datetime64_any_dtype(df[field])
+            distinct = df[field].nunique(dropna=False)
+
+        if type_field in DATE_PARTITION_TYPES or is_datetime:
+            partition_columns.append(f"{field}_month")
+        elif distinct <= max_values:
+            partition_columns.append(field)
+        else:
+            log(f"⚠️ Campo de partición {field} con alta cardinalidad, se particiona por {PARTITION_BUCKETS} buckets", level="warning")
+            partition_columns.append(f"{field}_bucket")
+
+    return partition_columns
+
+
+def add_partition_columns(df, partition_columns, buckets=PARTITION_BUCKETS):
+    """
+    Agrega al DataFrame las columnas derivadas (`_month`, `_bucket`) que requiere el layout.
+
+    Las columnas que ya existen en el DataFrame (particiones por identidad) no se modifican.
+    """
+    for column in partition_columns:
+        if column in df.columns:
+            continue
+        if column.endswith("_month") and column[:-len("_month")] in df.columns:
+            values = pd.to_datetime(df[column[:-len("_month")]], errors="coerce", utc=True)
+            df[column] = (values.dt.year * 100 + values.dt.month).fillna(0).astype("int32")
+        elif column.endswith("_bucket") and column[:-len("_bucket")] in df.columns:
+            hashes = pd.util.hash_pandas_object(df[column[:-len("_bucket")]].astype(str), index=False)
+            df[column] = (hashes % buckets).astype("int16")
+        else:
+            raise ValueError(f"❌ No se puede derivar la columna de partición {column}")
+    return df
+
+
+def conform_partition_columns(data, partition_columns, buckets=PARTITION_BUCKETS):
+    """
+    Deja los datos (DataFrame o pa.Table) listos para escribir con `partition_by=partition_columns`:
+    deriva las columnas que falten (ej. el layout de una tabla creada por otra corrida) y decodifica
+    las que vengan como categoría o diccionario, que delta-rs no acepta como valor de partición.
+    """
+    if not partition_columns:
+        return data
+
+    if isinstance(data, pa.Table):
+        if any(column not in data.column_names for column in partition_columns):
+            data = pa.Table.from_pandas(add_partition_columns(data.to_pandas(), partition_columns, buckets), preserve_index=False)
+        for column in partition_columns:
+            i = data.schema.get_field_index(column)
+            field = data.schema.field(i)
+            if pa.types.is_dictionary(field.type):
+                data = data.set_column(i, pa.field(column, field.type.value_type, field.nullable),
+                                       data.column(i).cast(field.type.value_type))
+        return data
+
+    data = add_partition_columns(data, partition_columns, buckets)
+    for column in partition_columns:
+        if isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype(object)
+    return data
@@ -0,0 +1,147 @@
+import datetime
+import json
+import os
+import shutil
+import threading
+import uuid
+from pyarrow import feather
+from logger_utils import log
+
+
+MANIFEST_FILE = "manifest.json"
+
+
+def _write_atomic(path, write_fn):
+    """Escribe un archivo vía un temporal + `os.replace`, así nunca queda un archivo a medio escribir."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write_fn(tmp_path)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class StagingArea:
+    """
+    Área de staging local para los datos limpios pendientes de commit en Delta.
+
+    Cada chunk se guarda como Arrow IPC (Feather v2, lz4) en `{root}/{project}/{process_execution_id}/`
+    junto a un `manifest.json` con el estado de cada chunk ('staged' o 'committed'). Chunks y
+    manifiesto se escriben de forma atómica; cuando todos los chunks de una ejecución tienen commit
+    su carpeta se elimina. Si la sesión muere antes del commit, `pending` retorna los chunks que
+    una corrida posterior debe escribir sin volver a leer los orígenes.
+
+    Nota: si la sesión muere justo entre el commit en Delta y `mark_committed`, el chunk se vuelve a
+    escribir al recuperarse (append duplicado; con write_mode='merge' es idempotente).
+    Los registros 'pending' de IngestaLog de cada chunk deben ser durables al guardarlo (log
+    síncrono o bandeja de `WatermarkStore`), por eso no se combina con `AuditWriter`.
+
+    Args:
+        root (str): carpeta base del staging (disco local o /lakehouse/default/Files/...).
+        project (str): proyecto; separa el staging de proyectos que corren en paralelo.
+    """
+
+    def __init__(self, root, project):
+        self.root = os.path.join(root, str(project))
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _execution_dir(self, process_execution_id):
+        return os.path.join(self.root, str(process_execution_id))
+
+    def _read_manifest(self, execution_dir):
+        with open(os.path.join(execution_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, execution_dir, manifest):
+        def write(path):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+        _write_atomic(os.path.join(execution_dir, MANIFEST_FILE), write)
+
+    def stage(self, table_name, data, process_execution_id):
+        """
+        Guarda un chunk (pa.Table) y lo registra en el manifiesto de su ejecución.
+
+        Returns:
+            dict que identifica el chunk (se entrega a `mark_committed`).
+        """
+        execution_dir = self._execution_dir(process_execution_id)
+        file_name = f"{table_name}-{uuid.uuid4().hex}.arrow"
+        os.makedirs(execution_dir, exist_ok=True)
+        _write_atomic(os.path.join(execution_dir, file_name),
+                      lambda path: feather.write_feather(data, path, compression="lz4"))
+
+        chunk = {"process_execution_id": str(process_execution_id), "table_name": table_name,
+                 "file": file_name, "rows": data.num_rows, "status": "staged"}
+        with self._lock:
+            if os.path.exists(os.path.join(execution_dir, MANIFEST_FILE)):
+                manifest = self._read_manifest(execution_dir)
+            else:
+                manifest = {"process_execution_id": str(process_execution_id),
+                            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(), "chunks": []}
+            manifest["chunks"].append(chunk)
+            self._write_manifest(execution_dir, manifest)
+        return chunk
+
+    def mark_committed(self, chunks):
+        """Marca chunks con commit en Delta; elimina la carpeta de las ejecuciones ya completas."""
+        by_execution = {}
+        for chunk in chunks:
+            by_execution.setdefault(chunk["process_execution_id"], set()).add(chunk["file"])
+
+        with self._lock:
+            for execution_id, files in by_execution.items():
+                execution_dir = self._execution_dir(execution_id)
+                manifest = self._read_manifest(execution_dir)
+                for chunk in manifest["chunks"]:
+                    if chunk["file"] in files:
+                        chunk["status"] = "committed"
+
+                if all(chunk["status"] == "committed" for chunk in manifest["chunks"]):
+                    shutil.rmtree(execution_dir, ignore_errors=True)
+                    log(f"🧹 Staging de la ejecución {execution_id} completo, se elimina", level="info")
+                else:
+                    self._write_manifest(execution_dir, manifest)
+                    for file_name in files:
+                        os.remove(os.path.join(execution_dir, file_name))
+
+    def pending(self):
+        """Retorna los chunks pendientes de commit de ejecuciones anteriores, por orden de creación."""
+        pending = []
+        with self._lock:
+            for execution_id in os.listdir(self.root):
+                execution_dir = self._execution_dir(execution_id)
+                if not os.path.exists(os.path.join(execution_dir, MANIFEST_FILE)):
+                    continue
+                manifest = self._read_manifest(execution_dir)
+                chunks = [c for c in manifest["chunks"] if c["status"] == "staged"]
+                pending.append((manifest["created_at"], chunks))
+        return [chunk for _, chunks in sorted(pending, key=lambda item: item[0]) for chunk in chunks]
+
+    def load(self, chunk):
+        """Lee un chunk del staging como pa.Table."""
+        return feather.read_table(os.path.join(self._execution_dir(chunk["process_execution_id"]), chunk["file"]))
+
+
+def recover_staged(staging, coalescer):
+    """
+    Entrega al `CommitCoalescer` los chunks que quedaron en staging sin commit.
+
+    Returns:
+        int: cantidad de chunks recuperados.
+    """
+    chunks = staging.pending()
+    for chunk in chunks:
+        try:
+            coalescer.add(chunk["table_name"], staging.load(chunk), chunk["process_execution_id"], staged_chunk=chunk)
+        except Exception as e:
+            log(f"❌ Error al recuperar el chunk {chunk['file']} del staging: {e}", level="error")
+
+    if chunks:
+        log(f"♻️ Se recuperaron {len(chunks)} chunks del staging ({sum(c['rows'] for c in chunks)} filas) "
+            f"sin volver a leer los orígenes", level="info")
+    return len(chunks)
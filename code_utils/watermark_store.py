@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import threading
+import time
+from logger_utils import log
+from logging_utils import log_operation
+from watermark_utils import WatermarkIndex, get_all_last_watermarks, get_all_last_watermarks_from_log
+
+
+def _json_default(value):
+    # Escalares de numpy (idPartner int64, etc.) y fechas
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class WatermarkStore:
+    """
+    Estado local de watermarks (SQLite) con escritura asíncrona hacia Fabric SQL.
+
+    - Lecturas: `get` responde desde un `WatermarkIndex` en memoria respaldado por SQLite, sin ir
+      a Fabric SQL en el camino crítico de cada tabla. Expone la misma interfaz (`get`, `empty`)
+      que el índice, así que se usa directamente como `df_watermarks`.
+    - Escrituras: `log_operation` guarda la llamada a DataOn.IngestaLogOperation en una bandeja de
+      salida (outbox) en SQLite y un hilo en segundo plano la envía en orden. Si Fabric SQL falla,
+      la llamada queda en la bandeja y se reintenta (también en la próxima corrida).
+    - Watermarks: `record_extracted` registra el watermark extraído como pendiente y `confirm` lo
+      promueve cuando el commit en Delta de esa ejecución y recurso tuvo éxito.
+    - `reconcile`: al iniciar envía lo que quedó en la bandeja y toma como fuente de verdad los
+      watermarks de DataOn.LastWatermarkState.
+
+    Args:
+        path (str): archivo SQLite (disco local de la sesión o /lakehouse/default/Files/...).
+        project (str): proyecto.
+        environment (str): ambiente (prod, dev, ...).
+        _conn_mgr_fabric: administrador de conexiones de Fabric SQL.
+        retry_seconds (float): espera antes de reintentar un envío fallido.
+    """
+
+    def __init__(self, path, project, environment, _conn_mgr_fabric, retry_seconds=30):
+        self.project = project
+        self.environment = environment
+        self.conn_mgr = _conn_mgr_fabric
+        self.retry_seconds = retry_seconds
+        self.index = WatermarkIndex()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._create_tables()
+        self._load_index()
+        self._thread = threading.Thread(target=self._run, name="WatermarkStoreWriter", daemon=True)
+        self._thread.start()
+
+    def _create_tables(self):
+        with self._db_lock:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS watermark_state (
+                    project TEXT, environment TEXT, idPartner INTEGER, TableName TEXT,
+                    value TEXT, updated_at REAL,
+                    PRIMARY KEY (project, environment, idPartner, TableName))
+            """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS watermark_pending (
+                    process_execution_id TEXT, resource_name TEXT, project TEXT, environment TEXT,
+                    idPartner INTEGER, TableName TEXT, value TEXT, created_at REAL)
+            """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, args TEXT, created_at REAL, attempts INTEGER DEFAULT 0)
+            """)
+
+    def _load_index(self):
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT idPartner, TableName, project, value FROM watermark_state WHERE project = ? AND environment = ?",
+                (self.project, self.environment)).fetchall()
+        self.index = WatermarkIndex.from_rows(rows)
+
+    # Interfaz de lectura compatible con WatermarkIndex
+    def get(self, id_partner, table_name, project):
+        return self.index.get(id_partner, table_name, project)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def empty(self):
+        return self.index.empty
+
+    def record_extracted(self, process_execution_id, resource_name, id_partner, table_name, value):
+        """Registra el watermark hasta el que se extrajo un (partner, tabla); queda pendiente del commit."""
+        if value is None:
+            return
+        with self._db_lock:
+            self._db.execute("INSERT INTO watermark_pending VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (str(process_execution_id), resource_name, self.project, self.environment,
+                              int(id_partner), table_name, str(value), time.time()))
+
+    def _set_watermark(self, id_partner, table_name, value):
+        # Se llama con self._db_lock tomado
+        self.index.update(id_partner, table_name, self.project, value)
+        self._db.execute(
+            "INSERT OR REPLACE INTO watermark_state VALUES (?, ?, ?, ?, ?, ?)",
+            (self.project, self.environment, int(id_partner), table_name,
+             str(self.index.get(id_partner, table_name, self.project)), time.time()))
+
+    def advance(self, id_partner, table_name, value):
+        """Avanza el watermark sin esperar un commit (extracciones vacías, sin datos que escribir)."""
+        if value is None:
+            return
+        with self._db_lock:
+            self._set_watermark(id_partner, table_name, value)
+
+    def confirm(self, process_execution_ids, resource_name):
+        """Promueve los watermarks pendientes de un recurso cuyo commit en Delta tuvo éxito."""
+        execution_ids = [str(e) for e in process_execution_ids]
+        placeholders = ", ".join("?" for _ in execution_ids)
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT idPartner, TableName, value FROM watermark_pending "
+                f"WHERE resource_name = ? AND process_execution_id IN ({placeholders})",
+                [resource_name, *execution_ids]).fetchall()
+            for id_partner, table_name, value in rows:
+                self._set_watermark(id_partner, table_name, value)
+            self._db.execute(
+                f"DELETE FROM watermark_pending WHERE resource_name = ? AND process_execution_id IN ({placeholders})",
+                [resource_name, *execution_ids])
+
+    def log_operation(self, *args):
+        """
+        Encola una llamada a `log_operation` (mismos argumentos sin `_conn_mgr_fabric`) para
+        enviarla en segundo plano. Las llamadas se envían en el orden en que se encolaron.
+        """
+        with self._db_lock:
+            self._db.execute("INSERT INTO outbox (args, created_at) VALUES (?, ?)",
+                             (json.dumps(args, default=_json_default), time.time()))
+        self._wakeup.set()
+        return True
+
+    def pending_outbox(self):
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def flush_outbox(self):
+        """Envía la bandeja de salida en orden; se detiene en el primer error. Retorna lo enviado."""
+        with self._flush_lock:
+            return self._flush_outbox()
+
+    def _flush_outbox(self):
+        sent = 0
+        while True:
+            with self._db_lock:
+                row = self._db.execute("SELECT id, args FROM outbox ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return sent
+
+            outbox_id, args = row
+            if log_operation(self.conn_mgr, *json.loads(args)) is None:
+                with self._db_lock:
+                    self._db.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (outbox_id,))
+                return sent
+
+            with self._db_lock:
+                self._db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+            sent += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(timeout=self.retry_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush_outbox()
+            except Exception as e:
+                log(f"❌ Error al enviar la bandeja de watermarks: {e}", level="error")
+
+    def reconcile(self, _log_table):
+        """
+        Sincroniza el estado local con Fabric SQL al iniciar una corrida.
+
+        Primero envía lo que una corrida anterior dejó en la bandeja. Si la bandeja quedó vacía,
+        los watermarks remotos reemplazan a los locales (son la fuente de verdad); si no, se
+        conserva el mayor de ambos para no retroceder watermarks aún no enviados. Si Fabric SQL no
+        responde se sigue con el estado local.
+        """
+        sent = self.flush_outbox()
+        pending = self.pending_outbox()
+
+        remote = get_all_last_watermarks(self.project, self.conn_mgr, self.environment, _log_table)
+        if remote is None:
+            remote = get_all_last_watermarks_from_log(self.project, self.conn_mgr, self.environment)
+        if remote is None:
+            log(f"⚠️ No se pudieron leer los watermarks remotos, se usa el estado local ({len(self.index)} llaves)", level="warning")
+            return self
+
+        with self._db_lock:
+            if pending == 0:
+                self._db.execute("DELETE FROM watermark_state WHERE project = ? AND environment = ?",
+                                 (self.project, self.environment))
+            for (id_partner, table_name, project), value in remote.items():
+                current = self.index.get(id_partner, table_name, project) if pending else None
+                if current is not None and current.kind == value.kind and current > value:
+                    continue
+                self._db.execute("INSERT OR REPLACE INTO watermark_state VALUES (?, ?, ?, ?, ?, ?)",
+                                 (self.project, self.environment, id_partner, table_name, str(value), time.time()))
+        self._load_index()
+        log(f"✅ Watermarks reconciliados: {len(self.index)} llaves, {sent} operaciones reenviadas, "
+            f"{pending} pendientes en la bandeja", level="info")
+        return self
+
+    def close(self, timeout=10):
+        """Detiene el hilo de envío después de intentar vaciar la bandeja."""
+        deadline = time.time() + timeout
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        while self.pending_outbox() and time.time() < deadline:
+            if self.flush_outbox() == 0:
+                time.sleep(min(self.retry_seconds, max(0, deadline - time.time())))
+        pending = self.pending_outbox()
+        if pending:
+            log(f"⚠️ Quedaron {pending} operaciones en la bandeja de watermarks; se enviarán en la próxima corrida", level="warning")
+        self._db.close()
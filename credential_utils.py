@@ -0,0 +1,124 @@
+import base64
+import json
+import threading
+import time
+from logger_utils import log
+
+
+REFRESH_MARGIN_SECONDS = 300   # se renueva el token cuando le quedan menos de 5 minutos
+DEFAULT_TTL_SECONDS = 1800     # vigencia asumida si el token no es un JWT con `exp`
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_token_expiry(token):
+    """
+    Retorna el `exp` (epoch en segundos) de un token JWT, o None si no se puede leer.
+
+    Sólo se decodifica el payload para conocer la vigencia; la firma no se valida.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+class TokenCache:
+    """
+    Cache thread-safe de un token de acceso con renovación anticipada.
+
+    El token se reutiliza hasta `refresh_margin_seconds` antes de su expiración. Sólo un hilo
+    lo renueva a la vez; mientras tanto los demás siguen usando el token vigente. Si la
+    renovación falla y el token en cache aún no expiró, se sigue usando ese token.
+
+    Args:
+        fetch_fn: callable() -> str que obtiene un token nuevo (ej. `credentials.getToken`).
+        name (str): nombre del token para los logs.
+        refresh_margin_seconds (float): anticipación con la que se renueva el token.
+        default_ttl_seconds (float): vigencia asumida si no se puede leer el `exp` del token.
+    """
+
+    def __init__(self, fetch_fn, name="token", refresh_margin_seconds=REFRESH_MARGIN_SECONDS,
+                 default_ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.fetch_fn = fetch_fn
+        self.name = name
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.default_ttl_seconds = default_ttl_seconds
+        self.stats = {"hits": 0, "refreshes": 0, "failures": 0}
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        # Los contadores tienen su propio lock: el de renovación se retiene durante `fetch_fn`
+        # y los aciertos no deben esperar por él
+        self._stats_lock = threading.Lock()
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def _is_fresh(self, now):
+        return self._token is not None and now < self._expires_at - self.refresh_margin_seconds
+
+    def _is_valid(self, now):
+        return self._token is not None and now < self._expires_at
+
+    def get(self):
+        """Retorna un token vigente, renovándolo si está por expirar."""
+        now = time.time()
+        if self._is_fresh(now):
+            self._count("hits")
+            return self._token
+
+        # Si otro hilo ya está renovando y el token actual sigue vigente, no esperar
+        if not self._lock.acquire(blocking=not self._is_valid(now)):
+            self._count("hits")
+            return self._token
+
+        try:
+            now = time.time()
+            if self._is_fresh(now):
+                self._count("hits")
+                return self._token
+
+            try:
+                token = self.fetch_fn()
+            except Exception as e:
+                self._count("failures")
+                if self._is_valid(now):
+                    log(f"⚠️ No se pudo renovar el token {self.name}, se usa el token en cache "
+                        f"(expira en {self._expires_at - now:.0f}s). Error: {e}", level="warning")
+                    return self._token
+                raise
+
+            self._token = token
+            self._expires_at = get_token_expiry(token) or (now + self.default_ttl_seconds)
+            self._count("refreshes")
+            log(f"🔑 Token {self.name} renovado (expira en {self._expires_at - now:.0f}s)", level="info")
+            return token
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Descarta el token en cache (ej. si el servicio lo rechazó)."""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+
+def get_token_cache(_notebookutils, audience="storage"):
+    """Retorna el `TokenCache` compartido para una audiencia de `notebookutils.credentials`."""
+    key = (id(_notebookutils), audience)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = TokenCache(lambda: _notebookutils.credentials.getToken(audience), name=audience)
+            _caches[key] = cache
+        return cache
+
+
+def get_storage_token(_notebookutils):
+    """Token de storage de Fabric desde el cache compartido por los writers y el Adapter."""
+    return get_token_cache(_notebookutils, "storage").get()
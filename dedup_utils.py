@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+from logger_utils import log
+
+
+def get_primary_key_columns(keys_info):
+    """
+    Obtiene las columnas de llave primaria desde `keys_info` (resultado de `get_schedules`).
+
+    Args:
+        keys_info: lista de dicts [{"field_name": "id", "is_primary_key": 1}, ...] o NaN/None.
+
+    Returns:
+        list: nombres de columnas marcadas como llave primaria (vacía si no hay información).
+    """
+    if not isinstance(keys_info, (list, tuple)):
+        return []
+
+    key_columns = []
+    for item in keys_info:
+        if not isinstance(item, dict) or not item.get("field_name"):
+            continue
+        # is_primary_key puede llegar como bool, 0/1 o texto ('1', 'True') según el origen
+        if str(item.get("is_primary_key")).strip().lower() in ("1", "true"):
+            key_columns.append(item["field_name"])
+    return key_columns
+
+
+def hash_keys(df, key_columns):
+    """Calcula un hash uint64 por fila sobre las columnas llave (8 bytes por fila)."""
+    return pd.util.hash_pandas_object(df[key_columns], index=False).to_numpy(dtype=np.uint64)
+
+
+def deduplicate_by_keys(df, key_columns, order_column=None):
+    """
+    Elimina filas duplicadas por llave primaria conservando la más reciente según `order_column`.
+
+    La detección se hace sobre un arreglo compacto de hashes de 64 bits en lugar de tuplas de
+    objetos Python. Las colisiones de hash se verifican contra los valores reales de la llave; si
+    existiera alguna se usa `drop_duplicates` exacto como respaldo.
+
+    Args:
+        df (DataFrame): chunk extraído para un (idPartner, tabla).
+        key_columns (list): columnas que forman la llave (PK + idPartner).
+        order_column (str, optional): columna watermark; gana el valor mayor. Si no se indica,
+            gana la última fila en el orden de llegada.
+
+    Returns:
+        DataFrame: datos sin duplicados (el mismo objeto si no había duplicados).
+    """
+    if df is None or df.empty or not key_columns:
+        return df
+
+    missing = [c for c in key_columns if c not in df.columns]
+    if missing:
+        log(f"⚠️ Columnas llave no encontradas {missing}, se omite la deduplicación", level="warning")
+        return df
+
+    if order_column and order_column in df.columns:
+        order = np.argsort(df[order_column].to_numpy(), kind="stable")
+    else:
+        order = np.arange(len(df))
+
+    hashes = hash_keys(df, key_columns)[order]
+    duplicated_sorted = pd.Series(hashes).duplicated(keep="last").to_numpy()
+    if not duplicated_sorted.any():
+        return df
+
+    drop_positions = order[duplicated_sorted]
+    keep_positions = order[~duplicated_sorted]
+
+    # Verificar colisiones: cada fila descartada debe tener la misma llave que la conservada
+    kept_by_hash = pd.Series(keep_positions, index=hashes[~duplicated_sorted])
+    counterpart = kept_by_hash.loc[hashes[duplicated_sorted]].to_numpy()
+    dropped_keys = df[key_columns].iloc[drop_positions].reset_index(drop=True)
+    kept_keys = df[key_columns].iloc[counterpart].reset_index(drop=True)
+    if not dropped_keys.equals(kept_keys):
+        log("⚠️ Colisión de hash en deduplicación, usando comparación exacta", level="warning")
+        if order_column and order_column in df.columns:
+            df = df.iloc[order]
+        return df.drop_duplicates(subset=key_columns, keep="last").sort_index()
+
+    mask = np.ones(len(df), dtype=bool)
+    mask[drop_positions] = False
+    log(f"🧹 Se descartaron {len(drop_positions)} filas duplicadas por llave {key_columns}", level="info")
+    return df[mask]
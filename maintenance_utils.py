@@ -0,0 +1,146 @@
+import time
+import pyarrow as pa
+from deltalake import DeltaTable
+from deltalake.exceptions import TableNotFoundError
+from logger_utils import log
+from delta_utils import get_table_write_options
+
+
+SMALL_FILE_BYTES = 32 * 1024 * 1024      # archivos por debajo de este tamaño se consideran pequeños
+TARGET_FILE_BYTES = 256 * 1024 * 1024    # tamaño objetivo de los archivos compactados
+MIN_FILES = 50                           # no se mantiene una tabla con menos archivos
+MIN_SMALL_FILE_RATIO = 0.3               # fracción mínima de archivos pequeños para compactar
+RETENTION_HOURS = 168                    # retención del vacuum (7 días, el mínimo por defecto de Delta)
+
+
+def get_table_file_stats(delta_table, small_file_bytes=SMALL_FILE_BYTES):
+    """
+    Calcula las estadísticas de archivos de la versión actual de una tabla Delta.
+
+    Returns:
+        dict con files, bytes, small_files y small_file_ratio.
+    """
+    sizes = pa.table(delta_table.get_add_actions(flatten=True)).column("size_bytes").to_pylist()
+    small_files = sum(1 for size in sizes if size < small_file_bytes)
+    return {
+        "files": len(sizes),
+        "bytes": sum(sizes),
+        "small_files": small_files,
+        "small_file_ratio": small_files / len(sizes) if sizes else 0.0,
+    }
+
+
+def needs_maintenance(stats, min_files=MIN_FILES, min_small_file_ratio=MIN_SMALL_FILE_RATIO):
+    """Indica si una tabla tiene suficientes archivos pequeños para justificar la compactación."""
+    return stats["files"] >= min_files and stats["small_file_ratio"] >= min_small_file_ratio
+
+
+def get_z_order_columns(delta_table, candidates):
+    """
+    Filtra las columnas de Z-order: deben existir en la tabla y no ser columnas de partición
+    (dentro de una partición su valor es constante, así que no aportan al ordenamiento).
+    """
+    metadata = delta_table.metadata()
+    partition_columns = set(metadata.partition_columns)
+    table_columns = {field.name for field in delta_table.schema().fields}
+    columns = []
+    for col in candidates:
+        if col and col in table_columns and col not in partition_columns and col not in columns:
+            columns.append(col)
+    return columns
+
+
+def maintain_table(table_path, storage_options, z_order_columns=None, min_files=MIN_FILES,
+                   min_small_file_ratio=MIN_SMALL_FILE_RATIO, small_file_bytes=SMALL_FILE_BYTES,
+                   target_size=TARGET_FILE_BYTES, retention_hours=RETENTION_HOURS, force=False):
+    """
+    Compacta (o aplica Z-order), crea un checkpoint y hace vacuum de una tabla Delta.
+
+    La tabla sólo se toca si supera los umbrales de cantidad de archivos y proporción de
+    archivos pequeños (o si `force` es True).
+
+    Args:
+        table_path (str): ruta de la tabla Delta.
+        storage_options (dict): opciones de almacenamiento (token de OneLake, etc.).
+        z_order_columns (list, optional): columnas candidatas para Z-order (idPartner, watermark).
+            Si ninguna aplica se hace una compactación simple.
+        min_files / min_small_file_ratio / small_file_bytes: umbrales para decidir la compactación.
+        target_size (int): tamaño objetivo de los archivos resultantes en bytes.
+        retention_hours (int): retención del vacuum; nunca se borran archivos más recientes.
+        force (bool): mantener la tabla aunque no supere los umbrales.
+
+    Returns:
+        dict con el reporte (archivos y bytes antes/después, operación, archivos borrados),
+        o None si la tabla no existe.
+    """
+    try:
+        delta_table = DeltaTable(table_path, storage_options=storage_options)
+    except TableNotFoundError:
+        log(f"⚠️ La tabla {table_path} no existe, se omite el mantenimiento", level="warning")
+        return None
+
+    before = get_table_file_stats(delta_table, small_file_bytes)
+    report = {"table_path": table_path, "operation": None, "before": before, "after": before,
+              "vacuumed_files": 0, "seconds": 0.0}
+
+    if not force and not needs_maintenance(before, min_files, min_small_file_ratio):
+        log(f"🆗 {table_path}: {before['files']} archivos ({before['small_file_ratio']:.0%} pequeños), "
+            f"no requiere mantenimiento", level="info")
+        return report
+
+    start = time.perf_counter()
+    columns = get_z_order_columns(delta_table, z_order_columns or [])
+    if columns:
+        report["operation"] = f"z_order({', '.join(columns)})"
+        delta_table.optimize.z_order(columns, target_size=target_size)
+    else:
+        report["operation"] = "compact"
+        delta_table.optimize.compact(target_size=target_size)
+
+    delta_table.create_checkpoint()
+    report["vacuumed_files"] = len(delta_table.vacuum(retention_hours=retention_hours, dry_run=False,
+                                                      enforce_retention_duration=True))
+    report["after"] = get_table_file_stats(delta_table, small_file_bytes)
+    report["seconds"] = round(time.perf_counter() - start, 3)
+
+    after = report["after"]
+    log(f"🧰 {table_path}: {report['operation']} {before['files']} → {after['files']} archivos, "
+        f"{before['bytes'] / 1024 / 1024:.1f} → {after['bytes'] / 1024 / 1024:.1f} MB, "
+        f"{report['vacuumed_files']} archivos borrados por vacuum ({report['seconds']}s)", level="info")
+    return report
+
+
+def maintain_project_tables(resource, table_names, table_path_fn, storage_options, **kwargs):
+    """
+    Ejecuta `maintain_table` sobre las tablas de un proyecto.
+
+    El Z-order se hace por idPartner y por la columna watermark del recurso (si es incremental),
+    que son los filtros habituales de las lecturas y del merge.
+
+    Args:
+        resource (DataFrame): programaciones del proyecto (`get_schedules`).
+        table_names (iterable): recursos a mantener.
+        table_path_fn: callable(table_name) -> ruta de la tabla Delta.
+        storage_options (dict): opciones de almacenamiento.
+        **kwargs: umbrales y opciones de `maintain_table`.
+
+    Returns:
+        list de reportes de las tablas existentes.
+    """
+    reports = []
+    for table_name in table_names:
+        try:
+            write_options = get_table_write_options(resource, table_name)
+            z_order_columns = ["idPartner", write_options["watermark_column"]]
+            report = maintain_table(table_path_fn(table_name), storage_options, z_order_columns, **kwargs)
+            if report is not None:
+                report["table_name"] = table_name
+                reports.append(report)
+        except Exception as e:
+            log(f"❌ Error en el mantenimiento de {table_name}: {e}", level="error")
+
+    maintained = [r for r in reports if r["operation"]]
+    log(f"🧰 Mantenimiento: {len(maintained)} de {len(reports)} tablas mantenidas, "
+        f"{sum(r['before']['files'] for r in maintained)} → {sum(r['after']['files'] for r in maintained)} archivos",
+        level="info")
+    return reports
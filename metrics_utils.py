@@ -0,0 +1,204 @@
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logger_utils import log, get_log_context
+
+
+# Límites de los histogramas: segundos (latencias) y cantidades (filas, bytes)
+TIME_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000)
+
+# Etiquetas que se toman del contexto de logs (`log_context`) si no se indican
+LABELS = ("project", "partner", "table", "stage")
+METRIC_PREFIX = "ws_de_"
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max")
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # la última posición es +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def summary(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "min": self.min, "max": self.max,
+                "mean": round(self.sum / self.count, 6) if self.count else None}
+
+
+class MetricsRegistry:
+    """
+    Métricas de la corrida en memoria: contadores, gauges e histogramas con etiquetas.
+
+    Las etiquetas `project`, `partner` y `table` que no se indican se toman del contexto de logs
+    del hilo (`logger_utils.log_context`), así las funciones de bajo nivel (paginación, limpieza)
+    no necesitan recibirlas. Al terminar la corrida se exportan con `export_json` (resumen) y
+    `export_prometheus` (textfile para el collector de node_exporter).
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        context = get_log_context()
+        values = {label: labels.get(label, context.get(label)) for label in LABELS}
+        values.update({k: v for k, v in labels.items() if k not in LABELS})
+        return name, tuple(sorted((k, str(v)) for k, v in values.items() if v is not None))
+
+    def inc(self, name, value=1, **labels):
+        """Suma `value` al contador `name`."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Fija el valor actual del gauge `name` (ej. profundidad de una cola)."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        """Registra una observación en el histograma `name` (los límites se fijan en la primera)."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Mide la duración del bloque en segundos en el histograma `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """Copia de las métricas como dict serializable a JSON."""
+        with self._lock:
+            return {
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self._counters.items())],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self._gauges.items())],
+                "histograms": [{"name": n, "labels": dict(l), **h.summary()} for (n, l), h in sorted(self._histograms.items())],
+            }
+
+    def stage_summary(self):
+        """Segundos, filas y bytes por etapa, sumados sobre todas las demás etiquetas."""
+        stages = {}
+        snapshot = self.snapshot()
+        for entry in snapshot["histograms"]:
+            if entry["name"] == "stage_seconds":
+                stage = stages.setdefault(entry["labels"].get("stage"), {"seconds": 0.0, "calls": 0, "rows": 0, "bytes": 0})
+                stage["seconds"] = round(stage["seconds"] + entry["sum"], 3)
+                stage["calls"] += entry["count"]
+        for entry in snapshot["counters"]:
+            if entry["name"] in ("rows_total", "bytes_total") and entry["labels"].get("stage") in stages:
+                stages[entry["labels"]["stage"]][entry["name"].split("_")[0]] += entry["value"]
+        for stage in stages.values():
+            stage["rows_per_second"] = round(stage["rows"] / stage["seconds"], 1) if stage["seconds"] else None
+        return stages
+
+    def export_json(self, path, **run_info):
+        """Escribe el resumen de la corrida (métricas + resumen por etapa) como JSON."""
+        summary = {**run_info, "exported_at": time.time(), "stages": self.stage_summary(), **self.snapshot()}
+        _write_text(path, json.dumps(summary, indent=2, default=str))
+        return path
+
+    def export_prometheus(self, path):
+        """Escribe las métricas en el formato de texto de Prometheus (textfile collector)."""
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({n for n, _ in metrics}):
+                    lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+                    for (n, labels), value in sorted(metrics.items()):
+                        if n == name:
+                            lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {value}")
+            for name in sorted({n for n, _ in self._histograms}):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                for (n, labels), histogram in sorted(self._histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {histogram.count}")
+        _write_text(path, "\n".join(lines) + "\n")
+        return path
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{k}="{_escape(v)}"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _write_text(path, text):
+    # Escritura atómica: el collector nunca lee un archivo a medio escribir
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Registro de la sesión, compartido por todos los módulos
+metrics = MetricsRegistry()
+
+
+def export_run_metrics(metrics_dir, project, process_execution_id):
+    """
+    Exporta las métricas al final de una corrida: `{project}_{id}.json` con el resumen y
+    `ws_de_{project}.prom` para Prometheus. Retorna las rutas, o None si falla.
+    """
+    try:
+        json_path = metrics.export_json(os.path.join(metrics_dir, f"{project}_{process_execution_id}.json"),
+                                        project=project, process_execution_id=str(process_execution_id))
+        prom_path = metrics.export_prometheus(os.path.join(metrics_dir, f"ws_de_{project}.prom"))
+        for stage, values in sorted(metrics.stage_summary().items(), key=lambda item: -item[1]["seconds"]):
+            log(f"⏱️ Etapa {stage}: {values['seconds']}s en {values['calls']} llamadas, {values['rows']} filas, "
+                f"{values['bytes'] / 1024 / 1024:.1f} MB", level="info")
+        return json_path, prom_path
+    except Exception as e:
+        log(f"❌ Error al exportar las métricas de la corrida: {e}", level="error")
+        return None
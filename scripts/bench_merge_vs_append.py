@@ -0,0 +1,104 @@
+"""Benchmark local: merge (upsert) vs append + deduplicación downstream sobre una tabla Delta.
+
+Simula varias corridas incrementales donde una fracción de las filas de cada lote son
+re-lecturas de filas ya cargadas (cambiaron en origen) y compara:
+
+- append: cada lote se agrega; el consumidor lee toda la tabla y deduplica por llave.
+- merge: cada lote se hace upsert con `merge_to_delta`; el consumidor lee la tabla tal cual.
+
+Uso:
+    python scripts/bench_merge_vs_append.py --rows 200000 --batches 10 --update-ratio 0.3
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from deltalake import DeltaTable, write_deltalake
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code_utils"))
+
+from delta_utils import merge_to_delta  # noqa: E402
+from logger_utils import set_logging  # noqa: E402
+
+
+KEYS = ["id", "idPartner"]
+
+
+def make_batch(rng, batch_num, rows, update_ratio, loaded_ids):
+    """Genera un lote con filas nuevas y re-lecturas de ids ya cargados."""
+    n_updates = int(rows * update_ratio) if len(loaded_ids) else 0
+    updated_ids = rng.choice(loaded_ids, size=min(n_updates, len(loaded_ids)), replace=False) if n_updates else np.array([], dtype=np.int64)
+    start = (loaded_ids.max() + 1) if len(loaded_ids) else 0
+    new_ids = np.arange(start, start + rows - len(updated_ids), dtype=np.int64)
+    ids = np.concatenate([updated_ids, new_ids])
+    return pd.DataFrame({
+        "id": ids,
+        "idPartner": (ids % 50).astype(np.int64),
+        "status": rng.choice(["ACTIVE", "INACTIVE", "PENDING"], size=len(ids)),
+        "amount": rng.random(len(ids)),
+        "updated_at": pd.Timestamp("2025-01-01", tz="UTC") + pd.to_timedelta(batch_num, unit="h"),
+    })
+
+
+def downstream_read(path, dedup):
+    df = DeltaTable(path).to_pandas()
+    if dedup:
+        df = df.sort_values("updated_at").drop_duplicates(subset=KEYS, keep="last")
+    return df
+
+
+def run(mode, path, batches):
+    write_time = 0.0
+    for df in batches:
+        start = time.perf_counter()
+        if mode == "merge":
+            if merge_to_delta(path, df, KEYS, None) is None:
+                write_deltalake(path, df, mode="append")
+        else:
+            write_deltalake(path, df, mode="append")
+        write_time += time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_read = downstream_read(path, dedup=(mode == "append"))
+    read_time = time.perf_counter() - start
+
+    table = DeltaTable(path)
+    return {
+        "mode": mode,
+        "write_s": round(write_time, 3),
+        "read_s": round(read_time, 3),
+        "rows_stored": table.to_pyarrow_dataset().count_rows(),
+        "rows_visible": len(df_read),
+        "files": len(table.file_uris()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="filas por lote")
+    parser.add_argument("--batches", type=int, default=10, help="cantidad de lotes")
+    parser.add_argument("--update-ratio", type=float, default=0.3, help="fracción de re-lecturas por lote")
+    args = parser.parse_args()
+
+    set_logging(enabled=True, level="WARNING")
+    rng = np.random.default_rng(0)
+
+    batches = []
+    loaded_ids = np.array([], dtype=np.int64)
+    for batch_num in range(args.batches):
+        df = make_batch(rng, batch_num, args.rows, args.update_ratio, loaded_ids)
+        loaded_ids = np.union1d(loaded_ids, df["id"].to_numpy())
+        batches.append(df)
+
+    workdir = tempfile.mkdtemp(prefix="bench_merge_")
+    try:
+        for mode in ("append", "merge"):
+            result = run(mode, os.path.join(workdir, mode), batches)
+            print(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
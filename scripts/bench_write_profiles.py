@@ -0,0 +1,106 @@
+"""Benchmark local: tiempo de escritura, tiempo de lectura y bytes por perfil de escritura (`WRITE_PROFILES`).
+
+Escribe la misma muestra en una tabla Delta por perfil y mide:
+
+- write_s: tiempo de `write_deltalake` con los WriterProperties del perfil.
+- read_s: tiempo de leer la tabla completa (escaneo downstream).
+- bytes: tamaño total de los archivos Parquet de la tabla.
+
+La muestra puede ser una tabla Delta o un archivo Parquet de nuestras tablas (ej. copiado desde
+OneLake a local_lakehouse/) o, si no se indica, datos sintéticos con la forma típica de bronze.
+
+Uso:
+    python scripts/bench_write_profiles.py --sample local_lakehouse/LH_Core/Tables/bronze/Loans --limit 500000
+    python scripts/bench_write_profiles.py --rows 300000 --repeat 3
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from deltalake import DeltaTable, write_deltalake
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code_utils"))
+
+from delta_utils import WRITE_PROFILES, build_write_kwargs  # noqa: E402
+from format_utils import encode_low_cardinality  # noqa: E402
+from logger_utils import set_logging  # noqa: E402
+
+
+def load_sample(path, limit):
+    """Carga la muestra desde una tabla Delta o un archivo/carpeta Parquet."""
+    if os.path.exists(os.path.join(path, "_delta_log")):
+        table = DeltaTable(path).to_pyarrow_table()
+    else:
+        table = pq.read_table(path)
+    return table.slice(0, limit) if limit else table
+
+
+def make_sample(rows, seed=0):
+    """Datos sintéticos con la forma de una tabla bronze: llaves, estados repetidos, montos y fechas."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "id": np.arange(rows, dtype=np.int64),
+        "idPartner": rng.integers(1, 60, rows).astype(np.int64),
+        "status": rng.choice(["ACTIVE", "INACTIVE", "PENDING", "CLOSED"], rows),
+        "city": rng.choice([f"city_{i}" for i in range(300)], rows),
+        "document": [f"{n:010d}" for n in rng.integers(0, 10**10, rows)],
+        "amount": np.round(rng.random(rows) * 1e6, 2),
+        "UpdatedAt": pd.Timestamp("2025-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 86400 * 90, rows), unit="s"),
+    })
+    return pa.Table.from_pandas(encode_low_cardinality(df), preserve_index=False)
+
+
+def table_bytes(path):
+    return sum(pa.table(DeltaTable(path).get_add_actions(flatten=True)).column("size_bytes").to_pylist())
+
+
+def run(profile, data, workdir, repeat):
+    kwargs = build_write_kwargs({"write_profile": profile})
+    write_times, read_times = [], []
+    for i in range(repeat):
+        path = os.path.join(workdir, f"{profile}_{i}")
+        start = time.perf_counter()
+        write_deltalake(path, data, mode="append", **kwargs)
+        write_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        DeltaTable(path).to_pyarrow_table()
+        read_times.append(time.perf_counter() - start)
+        size = table_bytes(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    return {
+        "profile": profile,
+        "write_s": round(min(write_times), 3),
+        "read_s": round(min(read_times), 3),
+        "mb": round(size / 1024 / 1024, 2),
+        "ratio": round(data.nbytes / size, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sample", help="tabla Delta o archivo/carpeta Parquet con la muestra")
+    parser.add_argument("--limit", type=int, default=0, help="filas máximas de la muestra (0 = todas)")
+    parser.add_argument("--rows", type=int, default=200000, help="filas sintéticas si no se indica --sample")
+    parser.add_argument("--repeat", type=int, default=3, help="repeticiones por perfil (se reporta el mínimo)")
+    parser.add_argument("--profiles", default=",".join(WRITE_PROFILES), help="perfiles separados por coma")
+    args = parser.parse_args()
+
+    set_logging(enabled=True, level="WARNING")
+    data = load_sample(args.sample, args.limit) if args.sample else make_sample(args.rows)
+    print(f"muestra: {data.num_rows} filas, {data.nbytes / 1024 / 1024:.1f} MB en memoria")
+
+    workdir = tempfile.mkdtemp(prefix="bench_profiles_")
+    try:
+        for profile in args.profiles.split(","):
+            print(run(profile.strip(), data, workdir, args.repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
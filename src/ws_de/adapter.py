@@ -7,6 +7,13 @@ try:
 except Exception:
     ConnectionManager = None
 
+try:
+    # shared, thread-safe token cache used by the Delta writers
+    from credential_utils import get_storage_token as _cached_storage_token
+except ImportError:
+    # code_utils is not on sys.path (e.g. the package used outside the notebooks)
+    _cached_storage_token = None
+
 
 class Adapter:
     """Adapter to abstract Fabric (notebookutils) vs local behavior.
@@ -80,11 +87,14 @@ class Adapter:
     def get_storage_token(self) -> Optional[str]:
         """Return a storage token string when running in Fabric, otherwise None.
 
-        In Fabric the caller typically uses `notebookutils.credentials.getToken("storage")`.
+        The token comes from the cache shared with the Delta writers when `credential_utils`
+        is importable, otherwise from `notebookutils.credentials.getToken("storage")`.
         """
         if not self.notebookutils:
             return None
         try:
+            if _cached_storage_token is not None:
+                return _cached_storage_token(self.notebookutils)
             return self.notebookutils.credentials.getToken("storage")
         except Exception:
             return None
@@ -0,0 +1,50 @@
+import base64
+import json
+import time
+
+import pytest
+
+from credential_utils import TokenCache, get_token_expiry
+
+
+def _jwt(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def test_get_token_expiry_reads_jwt_exp():
+    assert get_token_expiry(_jwt(1700000000)) == 1700000000
+    assert get_token_expiry("opaque-token") is None
+
+
+def test_token_cache_reuses_and_refreshes_before_expiry():
+    tokens = iter([_jwt(time.time() + 3600), _jwt(time.time() + 3600)])
+    cache = TokenCache(lambda: next(tokens), refresh_margin_seconds=300)
+
+    first = cache.get()
+    assert cache.get() == first
+    assert cache.stats == {"hits": 1, "refreshes": 1, "failures": 0}
+
+    cache._expires_at = time.time() + 60  # dentro del margen de renovación
+    cache.get()
+    assert cache.stats["refreshes"] == 2
+
+
+def test_token_cache_falls_back_to_valid_token_on_failure():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        if len(calls) > 1:
+            raise RuntimeError("throttled")
+        return _jwt(time.time() + 120)
+
+    cache = TokenCache(fetch, refresh_margin_seconds=300)
+    token = cache.get()
+
+    assert cache.get() == token
+    assert cache.stats["failures"] == 1
+
+    cache._expires_at = time.time() - 1
+    with pytest.raises(RuntimeError):
+        cache.get()
@@ -0,0 +1,165 @@
+import threading
+import time
+
+from db_utils import ConnectionPool, PooledConnection
+
+
+class FakeCursor:
+    fast_executemany = False
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def cursor(self):
+        if self.closed:
+            raise RuntimeError("connection closed")
+        return FakeCursor()
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_waits_fifo_for_released_connections_and_validates_on_borrow():
+    pool = ConnectionPool(max_connections=2, acquire_timeout=5)
+    first = pool.get_connection("sql", FakeConnection)
+    second = pool.get_connection("sql", FakeConnection)
+    assert first is not second
+    assert pool.get_connection("sql", FakeConnection, timeout=0.05) is None
+
+    served = []
+
+    def waiter(name):
+        served.append((name, pool.get_connection("sql", FakeConnection)))
+
+    threads = [threading.Thread(target=waiter, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)  # "a" llega antes que "b"
+
+    second.close()  # inválida: se descarta y se crea otra en su lugar
+    pool.release_connection("sql", second)
+    pool.release_connection("sql", first)
+    for thread in threads:
+        thread.join()
+
+    assert [name for name, _ in served] == ["a", "b"]
+    assert served[0][1] is not second and served[1][1] is not second
+    assert pool.connections["sql"]["in_use"] == 2
+
+
+def test_pooled_connection_returns_to_pool_when_dropped():
+    pool = ConnectionPool(max_connections=1, acquire_timeout=1)
+
+    def borrow():
+        return PooledConnection(pool, "sql", pool.get_connection("sql", FakeConnection))
+
+    cursor = borrow().cursor()
+    assert pool.connections["sql"]["in_use"] == 1  # el cursor mantiene el préstamo
+    del cursor
+    assert pool.connections["sql"]["in_use"] == 0
+
+    with borrow() as connection:
+        connection.cursor()
+    assert len(pool.connections["sql"]["idle"]) == 1
+
+
+def test_pooled_cursor_forwards_attribute_writes():
+    pool = ConnectionPool(max_connections=1, acquire_timeout=1)
+    with PooledConnection(pool, "sql", pool.get_connection("sql", FakeConnection)) as connection:
+        cursor = connection.cursor()
+        cursor.fast_executemany = True
+        assert cursor._cursor.fast_executemany is True
+        assert cursor.fast_executemany is True
+
+
+def test_slow_login_does_not_block_other_acquires():
+    pool = ConnectionPool(max_connections=2, acquire_timeout=5, reap_interval=None)
+    with pool.acquire_connection_context("sql", FakeConnection) as connection:
+        idle = connection
+    assert pool.connections["sql"]["in_use"] == 0
+
+    login_started, finish_login = threading.Event(), threading.Event()
+
+    def slow_login():
+        login_started.set()
+        finish_login.wait(5)
+        return FakeConnection()
+
+    slow = threading.Thread(target=pool.get_connection, args=("warehouse", slow_login))
+    slow.start()
+    login_started.wait(5)
+
+    # Con el login de "warehouse" en curso, otra llave y la conexión libre se entregan sin esperar
+    start = time.time()
+    assert pool.get_connection("sql", FakeConnection) is idle
+    assert pool.get_connection("other", FakeConnection) is not None
+    assert time.time() - start < 1
+    assert pool.connections["warehouse"]["creating"] == 1
+
+    finish_login.set()
+    slow.join()
+    assert (pool.connections["warehouse"]["in_use"], pool.connections["warehouse"]["creating"]) == (1, 0)
+
+
+def test_reaper_closes_expired_idle_connections():
+    pool = ConnectionPool(connection_timeout=0.05, reap_interval=0.02)
+    connection = pool.get_connection("sql", FakeConnection)
+    pool.release_connection("sql", connection)
+    time.sleep(0.3)
+    pool.close()
+    assert connection.closed
+    assert not pool.connections["sql"]["idle"]
+
+
+class PingCursor(FakeCursor):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql):
+        self.connection.pings += 1
+        if self.connection.broken:
+            raise RuntimeError("connection reset")
+
+    def fetchone(self):
+        return (1,)
+
+
+class PingConnection(FakeConnection):
+    def __init__(self):
+        super().__init__()
+        self.pings = 0
+        self.broken = False
+
+    def cursor(self):
+        super().cursor()
+        return PingCursor(self)
+
+
+def test_prewarm_ping_and_stats():
+    pool = ConnectionPool(max_connections=3, ping_after=0.05, reap_interval=None)
+    assert pool.prewarm("sql", PingConnection, 5) == 3
+    assert pool.prewarm("sql", PingConnection, 3) == 0
+    assert len(pool.connections["sql"]["idle"]) == 3
+
+    reused = pool.get_connection("sql", PingConnection)
+    assert reused.pings == 0  # recién usada: validación local sin ida al servidor
+    pool.release_connection("sql", reused)
+
+    time.sleep(0.1)
+    reused.broken = True
+    replacement = pool.get_connection("sql", PingConnection)
+    assert reused.pings == 1 and reused.closed
+    assert replacement is not reused
+
+    stats = pool.get_stats()
+    assert stats["prewarmed"] == 3
+    assert stats["total_requests"] == 2
+    assert stats["connection_reuse"] == 1 and stats["validation_failures"] == 1
+    assert stats["connections_created"] == 4
+    assert stats["reuse_ratio"] == 0.5
+    assert stats["active_connections"] == 1 and stats["idle_connections"] == 2
@@ -0,0 +1,34 @@
+import pandas as pd
+
+from dedup_utils import deduplicate_by_keys, get_primary_key_columns
+
+
+def test_get_primary_key_columns_accepts_mixed_flags():
+    keys_info = [
+        {"field_name": "id", "is_primary_key": 1},
+        {"field_name": "code", "is_primary_key": "True"},
+        {"field_name": "name", "is_primary_key": 0},
+    ]
+
+    assert get_primary_key_columns(keys_info) == ["id", "code"]
+    assert get_primary_key_columns(float("nan")) == []
+
+
+def test_deduplicate_keeps_latest_by_watermark():
+    df = pd.DataFrame({
+        "id": [1, 2, 1, 3, 2],
+        "idPartner": [10, 10, 10, 10, 10],
+        "updated": pd.to_datetime(["2025-01-03", "2025-01-01", "2025-01-02", "2025-01-01", "2025-01-05"]),
+        "value": ["a-new", "b-old", "a-old", "c", "b-new"],
+    })
+
+    result = deduplicate_by_keys(df, ["id", "idPartner"], "updated")
+
+    assert sorted(result["value"]) == ["a-new", "b-new", "c"]
+    assert list(result.index) == sorted(result.index)
+
+
+def test_deduplicate_without_duplicates_returns_same_frame():
+    df = pd.DataFrame({"id": [1, 2, 3], "idPartner": [1, 1, 1]})
+
+    assert deduplicate_by_keys(df, ["id", "idPartner"]) is df
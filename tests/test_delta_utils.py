@@ -0,0 +1,174 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+pytest.importorskip("deltalake")
+
+from deltalake import DeltaTable, write_deltalake  # noqa: E402
+from deltalake.exceptions import CommitFailedError  # noqa: E402
+
+import delta_utils  # noqa: E402
+from delta_utils import (build_merge_predicate, build_write_kwargs, cluster_data, ensure_table_properties,  # noqa: E402
+                         get_table_write_options, merge_to_delta, resolve_partition_columns, retry_on_conflict)
+
+
+def test_get_table_write_options_from_schedule():
+    resource = pd.DataFrame([{
+        "resource_name": "Loans",
+        "write_mode": "MERGE",
+        "keys_info": [{"field_name": "id", "is_primary_key": 1}],
+        "is_incremental": True,
+        "watermark_column": "UpdatedAt",
+        "merge_prune_watermark": "0",
+        "commit_metrics": 1,
+    }])
+
+    options = get_table_write_options(resource, "Loans")
+
+    assert options["write_mode"] == "merge"
+    assert options["key_columns"] == ["id"]
+    assert options["watermark_column"] == "UpdatedAt"
+    assert options["prune_by_watermark"] is False
+    assert options["commit_metrics"] is True
+    assert get_table_write_options(resource, "Other")["write_mode"] == "append"
+    assert get_table_write_options(resource, "Other")["commit_metrics"] is False
+
+
+def test_merge_to_delta_upserts_by_key(tmp_path):
+    path = str(tmp_path / "loans")
+    assert merge_to_delta(path, pd.DataFrame({"id": [1], "idPartner": [1]}), ["id"], None) is None
+
+    write_deltalake(path, pd.DataFrame({"id": [1, 2], "idPartner": [1, 1], "value": ["a", "b"]}))
+    batch = pd.DataFrame({"id": [2, 3], "idPartner": [1, 1], "value": ["b2", "c"]})
+
+    metrics = merge_to_delta(path, batch, ["id"], None)
+
+    result = DeltaTable(path).to_pandas().sort_values("id")
+    assert metrics["num_target_rows_updated"] == 1
+    assert result["value"].tolist() == ["a", "b2", "c"]
+
+
+def test_merge_to_delta_keys_arrow_batches_by_partner(tmp_path):
+    path = str(tmp_path / "loans")
+    write_deltalake(path, pd.DataFrame({"id": [1, 1], "idPartner": [7, 8], "value": ["a7", "a8"], "version": [1, 1]}))
+    batch = pa.Table.from_pandas(pd.DataFrame({"id": [1, 2], "idPartner": [8, 7], "value": ["b8", "b7"], "version": [2, 2]}),
+                                 preserve_index=False)
+
+    assert build_merge_predicate(batch, ["id", "idPartner"], "version", True) == (
+        "t.id = s.id AND t.idPartner = s.idPartner AND t.idPartner IN (7, 8) AND t.version <= 2")
+
+    merge_to_delta(path, batch, ["id"], None)
+
+    result = DeltaTable(path).to_pandas().sort_values(["idPartner", "id"])
+    assert list(zip(result["idPartner"], result["id"], result["value"])) == [(7, 1, "a7"), (7, 2, "b7"), (8, 1, "b8")]
+
+@pytest.mark.parametrize("as_arrow", [False, True])
+def test_merge_to_delta_updates_older_versions_from_repeated_keys(tmp_path, as_arrow):
+    path = str(tmp_path / "loans")
+    write_deltalake(path, pd.DataFrame({"id": [1, 2], "idPartner": [7, 7], "value": ["a", "b"], "version": [1, 2]}))
+    # Lote coalescido: id=2 llega dos veces y la versión 5 debe ganar sin importar el orden
+    batch = pd.DataFrame({"id": [2, 3, 2], "idPartner": [7, 7, 7], "value": ["b5", "c", "b4"], "version": [5, 3, 4]})
+    if as_arrow:
+        batch = pa.Table.from_pandas(batch, preserve_index=False)
+
+    merge_to_delta(path, batch, ["id"], None, "version", prune_by_watermark=True)
+
+    result = DeltaTable(path).to_pandas().sort_values("id")
+    assert list(zip(result["id"], result["value"], result["version"])) == [(1, "a", 1), (2, "b5", 5), (3, "c", 3)]
+
+
+def test_retry_on_conflict_retries_commit_failures():
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise CommitFailedError("version already exists")
+        return "ok"
+
+    assert retry_on_conflict(write, "Loans", wait_seconds=0) == "ok"
+    assert len(attempts) == 3
+
+
+def test_write_options_cluster_and_tune_files(tmp_path):
+    resource = pd.DataFrame([{
+        "resource_name": "Loans",
+        "is_incremental": True,
+        "watermark_column": "UpdatedAt",
+        "sort_within_files": 1,
+        "target_file_size_mb": 64,
+        "row_group_rows": 1000,
+        "stats_columns": "idPartner, UpdatedAt",
+    }])
+    options = get_table_write_options(resource, "Loans")
+
+    assert options["sort_columns"] == ["idPartner", "UpdatedAt"]
+    assert options["target_file_size"] == 64 * 1024 * 1024
+
+    df = pd.DataFrame({"idPartner": [2, 1, 2, 1], "UpdatedAt": pd.to_datetime(["2025-01-04", "2025-01-02", "2025-01-03", "2025-01-01"])})
+    clustered = cluster_data(df, options["sort_columns"])
+    assert clustered["idPartner"].tolist() == [1, 1, 2, 2]
+    assert clustered["UpdatedAt"].dt.day.tolist() == [1, 2, 3, 4]
+
+    path = str(tmp_path / "loans")
+    write_deltalake(path, clustered, **build_write_kwargs(options))
+    assert DeltaTable(path).metadata().configuration["delta.dataSkippingStatsColumns"] == "idPartner,UpdatedAt"
+
+
+def test_write_profile_from_schedule(tmp_path):
+    resource = pd.DataFrame([{"resource_name": "Loans", "write_profile": "Balanced"},
+                             {"resource_name": "Cities", "write_profile": "unknown"}])
+
+    assert get_table_write_options(resource, "Cities")["write_profile"] == "default"
+    assert "writer_properties" not in build_write_kwargs(get_table_write_options(resource, "Cities"))
+
+    kwargs = build_write_kwargs(get_table_write_options(resource, "Loans"))
+    path = str(tmp_path / "loans")
+    write_deltalake(path, pd.DataFrame({"id": range(10)}), **kwargs)
+    assert len(DeltaTable(path).to_pandas()) == 10
+
+
+def test_partition_layout_is_planned_once_and_then_read_from_the_table(tmp_path):
+    path = str(tmp_path / "loans")
+    partition_info = [{"field_name": "status", "type_field": "varchar"}]
+    few = pd.DataFrame({"status": ["A", "B"] * 5})
+    many = pd.DataFrame({"status": [f"s{i}" for i in range(500)]})
+
+    assert resolve_partition_columns(path, None, few, partition_info) == ["status"]
+    # Un lote posterior con alta cardinalidad no cambia el plan
+    assert resolve_partition_columns(path, None, many, partition_info) == ["status"]
+    assert resolve_partition_columns(path, None, None, None) == ["status"]
+
+    # Otra corrida creó la tabla con otro layout: manda el de la tabla
+    other = str(tmp_path / "cities")
+    assert resolve_partition_columns(other, None, few, partition_info) == ["status"]
+    write_deltalake(other, pd.DataFrame({"status": ["A"], "status_bucket": pa.array([1], pa.int16())}), partition_by=["status_bucket"])
+    assert resolve_partition_columns(other, None, few, partition_info) == ["status_bucket"]
+
+
+def test_ensure_table_properties_retries_after_a_failed_alter(tmp_path, monkeypatch):
+    path = str(tmp_path / "loans")
+    write_deltalake(path, pd.DataFrame({"id": [1]}))
+    configuration = {"delta.dataSkippingStatsColumns": "id"}
+    calls = []
+
+    class FlakyDeltaTable(DeltaTable):
+        @property
+        def alter(self):
+            table_alter = DeltaTable.alter.fget(self)
+
+            def set_table_properties(properties):
+                calls.append(properties)
+                if len(calls) == 1:
+                    raise OSError("throttled")
+                return table_alter.set_table_properties(properties)
+            return type("Alter", (), {"set_table_properties": staticmethod(set_table_properties)})()
+
+    monkeypatch.setattr(delta_utils, "DeltaTable", FlakyDeltaTable)
+
+    ensure_table_properties(path, None, configuration)  # falla sin propagar
+    ensure_table_properties(path, None, configuration)  # se reintenta
+    ensure_table_properties(path, None, configuration)  # ya aplicada: no vuelve a leer la tabla
+
+    assert len(calls) == 2
+    assert DeltaTable(path).metadata().configuration["delta.dataSkippingStatsColumns"] == "id"
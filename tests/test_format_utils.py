@@ -0,0 +1,82 @@
+import pandas as pd
+
+from format_utils import clean_data, compact_dtypes, concat_dataframes, encode_low_cardinality
+
+
+def test_encode_low_cardinality_only_repeated_text():
+    df = pd.DataFrame({
+        "status": ["A", "B", None] * 1000,
+        "branch": [f"b{i % 300}" for i in range(3000)],  # 10% distintos: no es baja cardinalidad
+        "name": [f"n{i}" for i in range(3000)],
+        "amount": range(3000),
+    })
+
+    encode_low_cardinality(df)
+
+    assert isinstance(df["status"].dtype, pd.CategoricalDtype)
+    assert df["branch"].dtype == object
+    assert df["name"].dtype == object
+    assert pd.api.types.is_integer_dtype(df["amount"])
+
+
+def test_encode_low_cardinality_skips_small_frames():
+    df = encode_low_cardinality(pd.DataFrame({"status": ["A", "B"] * 50}))
+
+    assert df["status"].dtype == object
+    assert isinstance(encode_low_cardinality(df, min_rows=0)["status"].dtype, pd.CategoricalDtype)
+
+
+def test_concat_dataframes_keeps_categories_across_partners():
+    df_a = encode_low_cardinality(pd.DataFrame({"status": ["ok", "ko"] * 1000}))
+    df_b = encode_low_cardinality(pd.DataFrame({"status": ["ok", "new"] * 1000}))
+
+    result = concat_dataframes([df_a, df_b])
+
+    assert isinstance(result["status"].dtype, pd.CategoricalDtype)
+    assert set(result["status"].cat.categories) == {"ok", "ko", "new"}
+    assert len(result) == 4000
+
+
+def test_clean_data_on_categorical_matches_plain_text():
+    values = ["ok", "OK", None, "ko"] * 500
+    df_plain = pd.DataFrame({"status": values})
+    df_encoded = encode_low_cardinality(pd.DataFrame({"status": values}))
+
+    plain = clean_data(df_plain, [("status", "varchar")])
+    encoded = clean_data(df_encoded, [("status", "varchar")])
+
+    assert isinstance(encoded["status"].dtype, pd.CategoricalDtype)
+    assert list(encoded["status"].astype(str)) == list(plain["status"])
+    assert set(encoded["status"].cat.categories) == {"OK", "KO", ""}
+
+
+def test_encode_again_after_clean_data_keeps_categoricals():
+    df = encode_low_cardinality(pd.DataFrame({"status": ["ok", None, "ko"] * 1000, "source_table": "Loans"}))
+
+    df = encode_low_cardinality(clean_data(df, [("status", "varchar"), ("source_table", "varchar")]))
+
+    assert isinstance(df["status"].dtype, pd.CategoricalDtype)
+    assert isinstance(df["source_table"].dtype, pd.CategoricalDtype)
+    assert set(df["status"].cat.categories) == {"OK", "KO", ""}
+
+def test_compact_dtypes_follows_sql_types_and_keeps_nulls():
+    df = pd.DataFrame({
+        "flag": [True, None, False],
+        "small": [1.0, None, 3.0],
+        "qty": [1, 2, 3],
+        "total": [10, 20, 30],
+    })
+    schema = [("flag", "bit"), ("small", "tinyint"), ("qty", "int"), ("total", "bigint")]
+
+    compact_dtypes(df, schema)
+
+    assert str(df["flag"].dtype) == "boolean"
+    assert str(df["small"].dtype) == "Int16"
+    assert df["qty"].dtype == "int32"
+    assert df["total"].dtype == "int64"
+
+    clean = clean_data(df, schema)
+
+    assert clean["flag"].dtype == bool
+    assert clean["small"].dtype == "int16"
+    assert clean["small"].tolist() == [1, 0, 3]
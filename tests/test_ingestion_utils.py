@@ -0,0 +1,210 @@
+import re
+import sqlite3
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+import sqlalchemy
+from sqlalchemy.pool import StaticPool
+
+import ingestion_utils
+from watermark_utils import WatermarkIndex
+
+
+class RecordingAudit:
+    def __init__(self):
+        self.calls = []
+
+    def log_operation(self, *args):
+        self.calls.append(args)
+        return True
+
+
+def _source_engine(rows):
+    """Origen SQL Server simulado en sqlite: esquema dbo, INFORMATION_SCHEMA y paginación OFFSET/FETCH."""
+    def connect():
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.execute("ATTACH DATABASE ':memory:' AS INFORMATION_SCHEMA")
+        conn.execute("ATTACH DATABASE ':memory:' AS dbo")
+        conn.execute("CREATE TABLE INFORMATION_SCHEMA.COLUMNS (TABLE_SCHEMA TEXT, TABLE_NAME TEXT, COLUMN_NAME TEXT, DATA_TYPE TEXT)")
+        conn.executemany("INSERT INTO INFORMATION_SCHEMA.COLUMNS VALUES ('dbo', 'Loans', ?, ?)",
+                         [("id", "int"), ("status", "varchar"), ("Version", "int"), ("shape", "geometry")])
+        conn.execute("CREATE TABLE dbo.Loans (id INT, status TEXT, Version INT, shape BLOB)")
+        conn.executemany("INSERT INTO dbo.Loans (id, status, Version) VALUES (?, ?, ?)", rows)
+        conn.commit()
+        return conn
+
+    engine = sqlalchemy.create_engine("sqlite://", creator=connect, poolclass=StaticPool)
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute", retval=True)
+    def _offset_fetch(conn, cursor, statement, parameters, context, executemany):
+        statement = re.sub(r"OFFSET (\d+) ROWS FETCH NEXT (\d+) ROWS ONLY", r"LIMIT \2 OFFSET \1", statement)
+        return statement, parameters
+
+    return engine
+
+
+@pytest.fixture
+def source(monkeypatch):
+    engine = _source_engine([(1, "open", 10), (2, "closed", 20), (3, "open", 30), (4, "open", 40)])
+    monkeypatch.setattr(ingestion_utils, "create_db_connection", lambda *args: engine)
+    return engine
+
+
+def _platform(id_partner=7):
+    return pd.Series({"id_Partner": id_partner, "serverdb": "srv", "db": "Core_7", "userDB": "u", "userDBPwd": "p", "schem": "dbo"})
+
+
+def _resource():
+    return pd.DataFrame([{
+        "resource_name": "Loans", "project": "Core", "table_name": "Loans", "schem": "dbo", "is_incremental": True,
+        "watermark_type": "INT", "watermark_column": "Version", "keys_info": "id",
+    }])
+
+
+def test_process_platform_connection_extracts_incremental_range(source, monkeypatch):
+    # Páginas de 1 fila para recorrer varias vueltas de OFFSET/FETCH
+    paginate = ingestion_utils.fetch_data_pagination
+    monkeypatch.setattr(ingestion_utils, "fetch_data_pagination",
+                        lambda engine, query, params=None: paginate(engine, query, page_size=1, params=params))
+    audit = RecordingAudit()
+    watermarks = WatermarkIndex.from_rows([(7, "Loans", "Core", 20)])
+
+    result = ingestion_utils.process_platform_connection(_platform(), _resource(), "run-1", None, "Ingest", "prod",
+                                                         "DataOn.LastWatermarkState", 1, 0, watermarks, audit)
+
+    assert set(result) == {"Loans"}
+    df = result["Loans"]
+    assert sorted(df["id"]) == [3, 4]
+    assert "shape" not in df.columns
+    assert set(df["idPartner"]) == {7} and set(df["source_table"]) == {"Loans"}
+    assert len(audit.calls) == 1
+    _, id_partner, table_name, _, current, last, quantity, *_ = audit.calls[0]
+    assert (id_partner, table_name, current, last, quantity) == (7, "Loans", 40, 20, 2)
+
+
+def test_prepared_text_partition_column_is_written_plain(tmp_path):
+    deltalake = pytest.importorskip("deltalake")
+    path = str(tmp_path / "loans")
+    df_schema = {"Loans": [("id", "int"), ("status", "varchar")]}
+    write_options = {"partition_info": [{"field_name": "status", "type_field": "varchar"}]}
+    # Extraído y codificado antes de la limpieza, como en fetch_all_data
+    df = ingestion_utils.encode_low_cardinality(pd.DataFrame({"id": range(2000), "status": ["open", "closed"] * 1000,
+                                                              "source_table": "Loans"}))
+
+    prepared = ingestion_utils.prepare_data(df, "Loans", df_schema, path, None, write_options)
+    data = pa.Table.from_pandas(prepared, preserve_index=False)
+
+    assert not pa.types.is_dictionary(data.schema.field("status").type)
+    assert pa.types.is_dictionary(data.schema.field("source_table").type)
+    deltalake.write_deltalake(path, data, partition_by=["status"])
+    assert deltalake.DeltaTable(path).metadata().partition_columns == ["status"]
+
+
+class NoSqlConnManager:
+    def get_sql_connection(self):
+        raise RuntimeError("sin Fabric SQL")
+
+
+def test_recovered_chunks_commit_before_extraction_without_duplicates(tmp_path, monkeypatch):
+    deltalake = pytest.importorskip("deltalake")
+    import watermark_store
+    from lakehouse_utils import LakehouseTarget
+
+    source_versions = [1, 2, 3, 4, 5]
+    lakehouse = LakehouseTarget("file", str(tmp_path / "lh"))
+    monkeypatch.setattr(ingestion_utils, "get_lakehouse_target", lambda *args: lakehouse)
+    monkeypatch.setattr(watermark_store, "log_operation", lambda *args: True)
+
+    def extract(row, resource, execution_id, conn_mgr, process_name, environment, log_table, max_retries, retry_wait,
+                store, audit_writer):
+        last = store.get(row["id_Partner"], "Loans", "Core")
+        versions = [v for v in source_versions if last is None or v > last.value]
+        if versions:
+            store.record_extracted(execution_id, "Loans", row["id_Partner"], "Loans", max(versions))
+        return {"Loans": pd.DataFrame({"id": versions, "Version": versions, "idPartner": row["id_Partner"],
+                                       "source_table": "Loans", "CreatedTS": pd.Timestamp.utcnow()})}
+
+    monkeypatch.setattr(ingestion_utils, "process_platform_connection", extract)
+
+    def run(write_fn, run_id):
+        schedule = pd.DataFrame({"resource_name": ["Loans"], "project": ["Core"]})
+        platforms = pd.DataFrame({"id_Partner": [7], "db": ["Core_7"], "serverdb": ["srv"]})
+        ingestion_utils.procces_project("Core", schedule, platforms, {"Loans": [("id", "int"), ("Version", "int")]},
+                                        NoSqlConnManager(), "Ingest", "prod", "LOG", 1, 0, 1, 0, None, write_fn, run_id,
+                                        _staging_dir=str(tmp_path / "staging"), _state_store_path=str(tmp_path / "state.db"))
+
+    def failing_write(*args, **kwargs):
+        raise OSError("lakehouse no disponible")
+
+    def write(path, data, **kwargs):
+        kwargs.pop("engine", None)
+        deltalake.write_deltalake(path, data, **kwargs)
+
+    run(failing_write, "run-1")  # extrae 1..5, el commit falla y el chunk queda en staging
+    run(write, "run-2")  # escribe el chunk recuperado y ya no hay nada nuevo que extraer
+    table_path = lakehouse.table_path("Core", "Loans")
+    assert sorted(deltalake.DeltaTable(table_path).to_pandas()["id"]) == [1, 2, 3, 4, 5]
+
+    source_versions += [6, 7]
+    run(write, "run-3")
+    assert sorted(deltalake.DeltaTable(table_path).to_pandas()["id"]) == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_failed_run_still_exports_metrics(tmp_path, monkeypatch):
+    def broken_lakehouse(*args):
+        raise RuntimeError("sin lakehouse")
+
+    monkeypatch.setattr(ingestion_utils, "get_lakehouse_target", broken_lakehouse)
+    monkeypatch.setattr(ingestion_utils, "get_all_last_watermarks", lambda *args: WatermarkIndex())
+    schedule = pd.DataFrame({"resource_name": ["Loans"], "project": ["Core"]})
+    platforms = pd.DataFrame({"id_Partner": [7], "db": ["Core_7"], "serverdb": ["srv"]})
+
+    with pytest.raises(RuntimeError):
+        ingestion_utils.procces_project("Core", schedule, platforms, {}, NoSqlConnManager(), "Ingest", "prod", "LOG",
+                                        1, 0, 1, 0, None, None, "run-9", _metrics_dir=str(tmp_path))
+
+    assert (tmp_path / "Core_run-9.json").exists()
+
+
+def test_async_audit_is_not_combined_with_staging(tmp_path, monkeypatch):
+    from lakehouse_utils import LakehouseTarget
+
+    created = []
+    monkeypatch.setattr(ingestion_utils, "AuditWriter", lambda *args: created.append(args))
+    monkeypatch.setattr(ingestion_utils, "get_lakehouse_target", lambda *args: LakehouseTarget("file", str(tmp_path / "lh")))
+    monkeypatch.setattr(ingestion_utils, "get_all_last_watermarks", lambda *args: WatermarkIndex())
+    monkeypatch.setattr(ingestion_utils, "process_platform_connection", lambda *args: {})
+    schedule = pd.DataFrame({"resource_name": ["Loans"], "project": ["Core"]})
+    platforms = pd.DataFrame({"id_Partner": [7], "db": ["Core_7"], "serverdb": ["srv"]})
+
+    ingestion_utils.procces_project("Core", schedule, platforms, {}, NoSqlConnManager(), "Ingest", "prod", "LOG",
+                                    1, 0, 1, 0, None, None, "run-1", _staging_dir=str(tmp_path / "staging"), _async_audit=True)
+    assert created == []
+
+    ingestion_utils.procces_project("Core", schedule, platforms, {}, NoSqlConnManager(), "Ingest", "prod", "LOG",
+                                    1, 0, 1, 0, None, None, "run-2", _async_audit=True)
+    assert len(created) == 1
+
+
+def test_recovered_chunk_creates_table_with_planned_partitions(tmp_path, monkeypatch):
+    deltalake = pytest.importorskip("deltalake")
+    import delta_utils
+    from lakehouse_utils import LakehouseTarget
+
+    # Sesión nueva: sin plan en memoria para la tabla, que todavía no existe
+    monkeypatch.setattr(delta_utils, "_planned_layouts", {})
+    path = str(tmp_path / "loans")
+    chunk = pa.Table.from_pandas(pd.DataFrame({"id": [1, 2], "status": pd.Categorical(["open", "closed"]),
+                                               "source_table": "Loans"}), preserve_index=False)
+    write_options = {"partition_info": [{"field_name": "status", "type_field": "varchar"}]}
+
+    def write(table_path, data, **kwargs):
+        kwargs.pop("engine", None)
+        deltalake.write_deltalake(table_path, data, **kwargs)
+
+    ok = ingestion_utils.commit_data(chunk, "Core", "Loans", ["run-1"], path, NoSqlConnManager(), "Ingest", None, write,
+                                     write_options, LakehouseTarget("file", str(tmp_path)), None, RecordingAudit())
+
+    assert ok is True
+    assert deltalake.DeltaTable(path).metadata().partition_columns == ["status"]
@@ -0,0 +1,50 @@
+import os
+
+from lakehouse_utils import get_lakehouse_target
+
+
+class DummyAdapter:
+    def __init__(self, resolved):
+        self.resolved = resolved
+
+    def resolve(self, logical_name):
+        return dict(self.resolved)
+
+
+class DummyNotebookUtils:
+    class credentials:
+        @staticmethod
+        def getToken(name):
+            return f"token-for-{name}"
+
+
+def test_fabric_target_without_adapter():
+    target = get_lakehouse_target(None, DummyNotebookUtils())
+
+    assert target.table_path("Core", "Loans") == (
+        "abfss://WS_Data_Engineering@onelake.dfs.fabric.microsoft.com/LH_Core.Lakehouse/Tables/bronze/Loans")
+    assert target.storage_options()["bearer_token"] == "token-for-storage"
+
+
+def test_file_target_from_adapter(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    target = get_lakehouse_target(DummyAdapter({"endpoint": "file://./local_lakehouse"}))
+
+    assert target.backend == "file"
+    assert target.table_path("Core", "Loans") == os.path.join(str(tmp_path), "local_lakehouse") + "/LH_Core/Tables/bronze/Loans"
+    assert target.storage_options() is None
+
+
+def test_s3_target_builds_minio_options():
+    target = get_lakehouse_target(DummyAdapter({
+        "endpoint": "s3://local-lakehouse",
+        "s3_endpoint": "http://minio:9000",
+        "access_key": "key",
+        "secret_key": "secret",
+    }))
+
+    options = target.storage_options()
+    assert target.table_path("Core", "Loans") == "s3://local-lakehouse/LH_Core/Tables/bronze/Loans"
+    assert options["AWS_ENDPOINT_URL"] == "http://minio:9000"
+    assert options["AWS_ACCESS_KEY_ID"] == "key"
+    assert options["AWS_ALLOW_HTTP"] == "true"
@@ -0,0 +1,39 @@
+import io
+import json
+import threading
+
+import logger_utils
+from logger_utils import flush_logs, log, log_context, set_logging
+
+
+class Unformattable:
+    def __str__(self):
+        raise AssertionError("el mensaje no debe formatearse con el nivel deshabilitado")
+
+
+def test_queue_logger_json_mode_carries_context_and_skips_disabled_levels():
+    stream = io.StringIO()
+    flush_logs()
+    previous = logger_utils.handler.setStream(stream)
+    try:
+        set_logging(enabled=True, level="INFO", json_format=True)
+        log("página %s", Unformattable(), level="debug")
+
+        def worker():
+            with log_context(partner=7, execution_id="gid-2", batch="2"):
+                log("Se extrajeron %s registros", 10, level="info", table="Loans")
+            log("sin contexto", level="warning")
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    finally:
+        flush_logs()
+        logger_utils.handler.setStream(previous)
+        set_logging(enabled=True, level="INFO", json_format=False)
+
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    extracted = next(e for e in entries if e["message"] == "Se extrajeron 10 registros")
+    assert (extracted["partner"], extracted["table"], extracted["batch"], extracted["execution_id"]) == (7, "Loans", "2", "gid-2")
+    assert "partner" not in next(e for e in entries if e["message"] == "sin contexto")
+    assert all("página" not in e["message"] for e in entries)
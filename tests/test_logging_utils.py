@@ -0,0 +1,66 @@
+import numpy as np
+
+from logging_utils import AuditWriter
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.fast_executemany = False
+
+    def executemany(self, sql, rows):
+        if self.conn.failures:
+            self.conn.failures -= 1
+            raise RuntimeError("connection reset")
+        assert self.fast_executemany
+        self.conn.pending.extend(rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnManager:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.pending = []
+        self.committed = []
+        self.borrowed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def get_sql_connection(self):
+        self.borrowed += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.borrowed -= 1
+
+
+def operation(i, records_quantity):
+    return ("Core", np.int64(7), f"T{i}", "UpdatedAt", "2025-01-01 00:00:00.000", "1990-01-01 00:00:00.000",
+            records_quantity, "pipeline", "", "pending", "run-1", "I", "prod", "db", True)
+
+
+def test_audit_writer_batches_in_order_retries_and_drains_on_close():
+    cm = FakeConnManager(failures=1)
+    writer = AuditWriter(cm, batch_size=3, linger_seconds=0.01, backoff_seconds=0.01)
+    for i in range(7):
+        assert writer.log_operation(*operation(i, '' if i == 4 else i)) is True
+
+    stats = writer.close()
+
+    assert [row[2] for row in cm.committed] == [f"T{i}" for i in range(7)]
+    assert type(cm.committed[0][1]) is int
+    assert stats["sent"] == 7 and stats["failed"] == 0 and stats["retries"] == 1
+    assert cm.borrowed == 0  # cada lote devuelve su conexión, también al fallar
@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("deltalake")
+
+from deltalake import DeltaTable, write_deltalake  # noqa: E402
+
+from maintenance_utils import maintain_table  # noqa: E402
+
+
+def _write_small_files(path, count):
+    for i in range(count):
+        df = pd.DataFrame({"id": [i], "idPartner": [i % 2], "UpdatedAt": [pd.Timestamp("2025-01-01") + pd.Timedelta(hours=i)]})
+        write_deltalake(path, df, mode="append", partition_by=["idPartner"])
+
+
+def test_maintain_table_skips_below_thresholds(tmp_path):
+    path = str(tmp_path / "loans")
+    _write_small_files(path, 3)
+
+    report = maintain_table(path, None, ["idPartner", "UpdatedAt"], min_files=10)
+
+    assert report["operation"] is None
+    assert report["after"]["files"] == 3
+    assert maintain_table(str(tmp_path / "missing"), None) is None
+
+
+def test_maintain_table_z_orders_and_reports(tmp_path):
+    path = str(tmp_path / "loans")
+    _write_small_files(path, 6)
+
+    report = maintain_table(path, None, ["idPartner", "UpdatedAt"], min_files=4)
+
+    # idPartner es columna de partición, así que sólo se ordena por el watermark
+    assert report["operation"] == "z_order(UpdatedAt)"
+    assert report["before"]["files"] == 6
+    assert report["after"]["files"] == 2
+    # los archivos reemplazados están dentro de la retención, vacuum no los borra
+    assert report["vacuumed_files"] == 0
+    assert len(DeltaTable(path).to_pandas()) == 6
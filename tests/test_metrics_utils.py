@@ -0,0 +1,25 @@
+import json
+
+from logger_utils import log_context
+from metrics_utils import SIZE_BUCKETS, MetricsRegistry
+
+
+def test_registry_labels_from_log_context_and_exports(tmp_path):
+    registry = MetricsRegistry()
+    with log_context(project="Core", partner=7, table="Loans"):
+        registry.observe("stage_seconds", 0.2, stage="fetch")
+        registry.observe("stage_seconds", 0.3, stage="fetch")
+        registry.observe("page_rows", 5000, buckets=SIZE_BUCKETS, stage="fetch")
+        registry.inc("rows_total", 10000, stage="fetch")
+    registry.inc("retries_total", stage="commit", table="Loans")
+    registry.set_gauge("queue_depth", 3, queue="audit")
+
+    summary = json.loads(open(registry.export_json(str(tmp_path / "run.json"), project="Core")).read())
+    assert summary["stages"]["fetch"] == {"seconds": 0.5, "calls": 2, "rows": 10000, "bytes": 0, "rows_per_second": 20000.0}
+    assert {"name": "retries_total", "labels": {"stage": "commit", "table": "Loans"}, "value": 1} in summary["counters"]
+
+    prom = open(registry.export_prometheus(str(tmp_path / "ws_de.prom"))).read().splitlines()
+    assert "# TYPE ws_de_stage_seconds histogram" in prom
+    assert 'ws_de_stage_seconds_bucket{partner="7",project="Core",stage="fetch",table="Loans",le="0.25"} 1' in prom
+    assert 'ws_de_stage_seconds_count{partner="7",project="Core",stage="fetch",table="Loans"} 2' in prom
+    assert 'ws_de_queue_depth{queue="audit"} 3' in prom
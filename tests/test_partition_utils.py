@@ -0,0 +1,38 @@
+import pandas as pd
+import pyarrow as pa
+
+from partition_utils import add_partition_columns, plan_partition_columns
+
+
+def test_plan_partition_columns_by_type_and_cardinality():
+    df = pd.DataFrame({
+        "idPartner": [1, 2] * 50,
+        "CreatedAt": pd.date_range("2025-01-01", periods=100, freq="D", tz="UTC"),
+        "code": [f"c{i}" for i in range(100)],
+    })
+    partition_info = [
+        {"field_name": "idPartner", "type_field": "int"},
+        {"field_name": "CreatedAt", "type_field": "datetime"},
+        {"field_name": "code", "type_field": "varchar"},
+        {"field_name": "missing", "type_field": "int"},
+    ]
+
+    columns = plan_partition_columns(df, partition_info, max_values=10)
+
+    assert columns == ["idPartner", "CreatedAt_month", "code_bucket"]
+    assert plan_partition_columns(df, None) == []
+    # Mismo plan sobre Arrow (chunks recuperados de staging), con columnas diccionario
+    table = pa.Table.from_pandas(df.astype({"code": "category"}), preserve_index=False)
+    assert plan_partition_columns(table, partition_info, max_values=10) == columns
+
+
+def test_add_partition_columns_derives_month_and_bucket():
+    df = pd.DataFrame({
+        "CreatedAt": pd.to_datetime(["2025-01-15", "2025-02-01"], utc=True),
+        "code": ["a", "b"],
+    })
+
+    add_partition_columns(df, ["CreatedAt_month", "code_bucket"], buckets=8)
+
+    assert df["CreatedAt_month"].tolist() == [202501, 202502]
+    assert df["code_bucket"].between(0, 7).all()
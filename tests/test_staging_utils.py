@@ -0,0 +1,45 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+from staging_utils import StagingArea, recover_staged
+from writer_utils import CommitCoalescer
+
+
+def test_failed_commit_stays_staged_and_is_recovered(tmp_path):
+    staging = StagingArea(str(tmp_path), "Core")
+    failing = CommitCoalescer(lambda *args: False, max_latency_seconds=60, staging=staging)
+    failing.add("Loans", pd.DataFrame({"id": [1, 2], "status": pd.Categorical(["A", "B"])}), "run-1")
+    failing.add("Cities", pd.DataFrame({"id": [9]}), "run-1")
+    failing.close()
+
+    assert sorted(c["table_name"] for c in staging.pending()) == ["Cities", "Loans"]
+
+    commits = []
+
+    def commit_fn(table_name, data, execution_ids):
+        commits.append((table_name, data.to_pandas()["id"].tolist(), execution_ids))
+        return True
+
+    # Una corrida nueva escribe lo pendiente sin volver a extraer
+    coalescer = CommitCoalescer(commit_fn, max_latency_seconds=60, staging=StagingArea(str(tmp_path), "Core"))
+    assert recover_staged(coalescer.staging, coalescer) == 2
+    coalescer.close()
+
+    assert sorted(commits) == [("Cities", [9], ["run-1"]), ("Loans", [1, 2], ["run-1"])]
+    assert staging.pending() == []
+    assert not os.path.exists(os.path.join(str(tmp_path), "Core", "run-1"))
+
+
+def test_mark_committed_keeps_pending_chunks(tmp_path):
+    staging = StagingArea(str(tmp_path), "Core")
+    first = staging.stage("Loans", pa.table({"id": [1]}), "run-1")
+    staging.stage("Loans", pa.table({"id": [2]}), "run-1")
+
+    staging.mark_committed([first])
+
+    pending = staging.pending()
+    assert len(pending) == 1
+    assert staging.load(pending[0]).to_pandas()["id"].tolist() == [2]
+
@@ -0,0 +1,32 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tracing_utils import Tracer, in_current_context
+
+
+def test_spans_propagate_execution_id_across_threads_and_export(tmp_path):
+    tracer = Tracer()
+    tracer.enable()
+
+    def fetch_table(table):
+        with tracer.span("fetch_table", table=table):
+            if table == "Broken":
+                raise RuntimeError("timeout")
+
+    with tracer.span("batch", execution_id="gid-1"):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(in_current_context(fetch_table), table) for table in ("Loans", "Broken")]
+        with pytest.raises(RuntimeError):
+            futures[1].result()
+
+    spans = {span.attributes.get("table", span.name): span for span in tracer.spans()}
+    assert spans["Loans"].parent_id == spans["batch"].span_id
+    assert spans["Loans"].execution_id == "gid-1" and spans["Loans"].trace_id == "gid-1"
+    assert spans["Broken"].status == "error" and spans["Broken"].attributes["error"] == "timeout"
+
+    lines = open(tracer.export_jsonl(str(tmp_path / "trace.jsonl"))).read().splitlines()
+    assert [json.loads(line)["name"] for line in lines][0] == "batch"
+    events = json.load(open(tracer.export_chrome_trace(str(tmp_path / "trace.chrome.json"))))["traceEvents"]
+    assert sum(1 for e in events if e["ph"] == "X") == 3
@@ -0,0 +1,57 @@
+import sqlite3
+
+import pandas as pd
+
+import watermark_store
+from watermark_store import WatermarkStore
+
+
+class SqliteConnManager:
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.execute("ATTACH DATABASE ':memory:' AS DataOn")
+        self.conn.create_function("varchar", 1, lambda size: None)
+        self.conn.create_function("CONVERT", 3, lambda _type, value, _style: value)
+        self.conn.execute("""CREATE TABLE DataOn.LastWatermarkState (project TEXT, idPartner INT, TableName TEXT,
+                             environment TEXT, Status TEXT, is_incremental INT, currentWaterMarkValue TEXT)""")
+        self.conn.execute("INSERT INTO DataOn.LastWatermarkState VALUES ('Core', 7, 'Loans', 'prod', 'Success', 1, '2025-01-05 00:00:00')")
+
+    def get_sql_connection(self):
+        return self.conn
+
+
+def test_store_reconciles_and_confirms_after_commit(tmp_path, monkeypatch):
+    sent = []
+    monkeypatch.setattr(watermark_store, "log_operation", lambda cm, *args: sent.append(args) or True)
+
+    store = WatermarkStore(str(tmp_path / "state.db"), "Core", "prod", SqliteConnManager(), retry_seconds=0.05).reconcile("DataOn.LastWatermarkState")
+    assert store.get(7, "Loans", "Core") == pd.Timestamp("2025-01-05")
+
+    store.record_extracted("run-1", "Loans", 7, "Loans", "2025-01-09 00:00:00.000")
+    store.log_operation("Core", 7, "Loans", "UpdatedAt", "2025-01-09 00:00:00.000")
+    assert store.get(7, "Loans", "Core") == pd.Timestamp("2025-01-05")
+
+    store.confirm(["run-1"], "Loans")
+    store.close()
+
+    assert store.get(7, "Loans", "Core") == pd.Timestamp("2025-01-09")
+    assert sent == [("Core", 7, "Loans", "UpdatedAt", "2025-01-09 00:00:00.000")]
+
+    # El estado local sobrevive a la sesión
+    reopened = WatermarkStore(str(tmp_path / "state.db"), "Core", "prod", None)
+    assert reopened.get(7, "Loans", "Core") == pd.Timestamp("2025-01-09")
+    reopened.close()
+
+
+def test_outbox_keeps_failed_calls_for_next_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(watermark_store, "log_operation", lambda cm, *args: None)
+    store = WatermarkStore(str(tmp_path / "state.db"), "Core", "prod", None, retry_seconds=0.05)
+    store.log_operation("Core", 7, "Loans")
+    store.close(timeout=0.1)
+
+    sent = []
+    monkeypatch.setattr(watermark_store, "log_operation", lambda cm, *args: sent.append(args) or True)
+    store = WatermarkStore(str(tmp_path / "state.db"), "Core", "prod", None)
+    assert store.flush_outbox() == 1
+    store.close()
+    assert sent == [("Core", 7, "Loans")]
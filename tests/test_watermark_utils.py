@@ -0,0 +1,84 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from watermark_utils import Watermark, WatermarkIndex, get_all_last_watermarks, get_last_watermark_from_cache, sql_placeholder
+
+
+def test_index_keeps_typed_maximum_per_key():
+    index = WatermarkIndex.from_rows([
+        (7, "Loans", "Core", "2025-01-02 10:00:00.123"),
+        (7, "Loans", "Core", "2025-01-10 08:00:00.000"),
+        ("7", "Loans", "Core", "2025-01-03 00:00:00.000"),
+        (7, "Cities", "Core", "9"),
+        (7, "Cities", "Core", "10"),
+        (8, "Loans", "Core", None),
+    ])
+
+    assert index.get(7, "Loans", "Core") == pd.Timestamp("2025-01-10 08:00:00")
+    assert index.get(7, "Cities", "Core") == 10
+    assert index.get(8, "Loans", "Core") is None
+    assert len(index) == 2
+
+
+def test_cache_lookup_formats_by_type_and_defaults():
+    index = WatermarkIndex.from_rows([(7, "Loans", "Core", "2025-01-02 10:00:00.123"), (7, "Cities", "Core", "42")])
+
+    assert get_last_watermark_from_cache("Core", index, 7, "Loans", "DATETIME") == "2025-01-02 10:00:00.123"
+    assert get_last_watermark_from_cache("Core", index, "7", "Cities", "INT") == 42
+    assert get_last_watermark_from_cache("Core", index, 9, "Loans", "DATETIME") == "1990-01-01 00:00:00.000"
+    assert get_last_watermark_from_cache("Core", index, 9, "Cities", "INT") == 0
+
+
+def test_watermark_parses_once_and_compares_natively():
+    wm = Watermark.parse("2025-01-02 10:00:00.1234567", "DATETIME")
+
+    assert str(wm) == "2025-01-02 10:00:00.123"
+    assert wm.to_param() == pd.Timestamp("2025-01-02 10:00:00.123456").to_pydatetime()
+    assert wm > Watermark.parse(pd.Timestamp("2025-01-02 10:00:00"))
+    assert Watermark.parse("0x00000000000007D1") > Watermark.parse(b"\x07\xd0")
+    assert str(Watermark.parse(b"\x07\xd1")) == "0x00000000000007D1"
+    assert Watermark.parse(np.int64(42)) == 42 and Watermark.parse("42").kind == "INT"
+    assert Watermark.parse("", "INT") is None and Watermark.parse("not a date", "DATETIME") is None
+
+
+def test_datetime_bounds_keep_sub_millisecond_values():
+    # Una columna `datetime` guarda .1233333: el límite superior no puede quedar por debajo
+    current = Watermark.parse(pd.Timestamp("2025-01-02 10:00:00.123333"), "DATETIME")
+
+    assert current > Watermark.parse("2025-01-02 10:00:00.123", "DATETIME")
+    assert current.to_param().microsecond == 123333
+    assert sql_placeholder("datetime") == "CAST(? AS datetime)"
+    assert sql_placeholder("DATETIME2") == "CAST(? AS datetime2)"
+    assert sql_placeholder("bigint") == "?" and sql_placeholder(None) == "?"
+
+
+class SqliteConnManager:
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("ATTACH DATABASE ':memory:' AS DataOn")
+        # CONVERT(varchar(30), x, 121) de SQL Server: en sqlite el valor ya es texto
+        self.conn.create_function("varchar", 1, lambda size: None)
+        self.conn.create_function("CONVERT", 3, lambda _type, value, _style: value)
+        self.conn.execute("""CREATE TABLE DataOn.LastWatermarkState (project TEXT, idPartner INT, TableName TEXT,
+                             environment TEXT, Status TEXT, is_incremental INT, currentWaterMarkValue TEXT)""")
+
+    def insert(self, *rows):
+        self.conn.executemany("INSERT INTO DataOn.LastWatermarkState VALUES ('Core', ?, ?, 'prod', 'Success', 1, ?)", rows)
+
+    def get_sql_connection(self):
+        return self.conn
+
+
+def test_last_watermarks_are_aggregated_on_the_server_with_bound_filters():
+    cm = SqliteConnManager()
+    cm.insert((7, "Loans", "2025-01-01 00:00:00"), (7, "Loans", "2025-01-05 00:00:00"), (8, "Loans", "2025-01-02 00:00:00"))
+    cm.conn.execute("INSERT INTO DataOn.LastWatermarkState VALUES ('O''Brien', 9, 'Loans', 'prod', 'Success', 1, '2025-01-09')")
+
+    index = get_all_last_watermarks("Core", cm, "prod", "DataOn.LastWatermarkState")
+
+    assert len(index) == 2
+    assert index.get(7, "Loans", "Core") == pd.Timestamp("2025-01-05")
+    # Proyecto con comilla: el filtro va como parámetro, no interpolado en el texto
+    assert get_all_last_watermarks("O'Brien", cm, "prod", "DataOn.LastWatermarkState").get(9, "Loans", "O'Brien") == pd.Timestamp("2025-01-09")
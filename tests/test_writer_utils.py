@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pandas as pd
+
+from writer_utils import CommitCoalescer, PipelinedTableWriter
+
+
+def _recording_commit(calls):
+    def commit_fn(table_name, data, execution_ids):
+        calls.append((table_name, data.num_rows, execution_ids))
+        return True
+    return commit_fn
+
+
+def test_coalescer_groups_partners_and_batches_into_one_commit():
+    calls = []
+    coalescer = CommitCoalescer(_recording_commit(calls), target_rows=4, max_latency_seconds=60)
+
+    coalescer.add("Loans", pd.DataFrame({"id": [1, 2], "status": pd.Categorical(["A", "B"])}), "run-1")
+    assert calls == []
+    coalescer.add("Loans", pd.DataFrame({"id": [3, 4], "status": pd.Categorical(["C", "A"])}), "run-2")
+    coalescer.add("Cities", pd.DataFrame({"id": [1]}), "run-2")
+    results = coalescer.close()
+
+    assert calls == [("Loans", 4, ["run-1", "run-2"]), ("Cities", 1, ["run-2"])]
+    assert coalescer.stats["submissions"] == 3
+    assert coalescer.stats["commits"] == 2
+    assert coalescer.stats["commits_saved"] == 1
+    assert all(ok for *_, ok in results)
+
+
+def test_coalescer_commits_on_byte_threshold():
+    calls = []
+    coalescer = CommitCoalescer(_recording_commit(calls), target_rows=10**9, target_bytes=1, max_latency_seconds=60)
+
+    coalescer.add("Loans", pd.DataFrame({"id": [1]}), "run-1")
+
+    assert calls == [("Loans", 1, ["run-1"])]
+
+
+def test_pipelined_writer_prepares_and_records_failures():
+    calls = []
+
+    def prepare_fn(table_name, df, execution_id):
+        if table_name == "Broken":
+            raise RuntimeError("boom")
+        return df
+
+    writer = PipelinedTableWriter(prepare_fn, CommitCoalescer(_recording_commit(calls), max_latency_seconds=60))
+    writer.submit("Loans", pd.DataFrame({"id": [1, 2]}), "run-1")
+    writer.submit("Broken", pd.DataFrame({"id": [1]}), "run-1")
+    results = writer.close()
+
+    assert calls == [("Loans", 2, ["run-1"])]
+    assert ("Broken", 1, False) in results
+
+
+def test_pipelined_writer_prepares_tables_independently():
+    calls = []
+    release = threading.Event()
+
+    def prepare_fn(table_name, df, execution_id):
+        if table_name == "Slow":
+            release.wait(5)
+        return df
+
+    writer = PipelinedTableWriter(prepare_fn, CommitCoalescer(_recording_commit(calls), target_rows=1, max_latency_seconds=60))
+    writer.submit("Slow", pd.DataFrame({"id": [1]}), "run-1")
+    writer.submit("Loans", pd.DataFrame({"id": [1, 2]}), "run-1")
+
+    deadline = time.monotonic() + 5
+    while not calls and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Loans hizo commit mientras Slow seguía limpiándose
+    assert calls == [("Loans", 2, ["run-1"])]
+    release.set()
+    writer.close()
+    assert [name for name, *_ in calls] == ["Loans", "Slow"]
+
+
+def test_coalescer_parallel_commits_keep_per_table_order():
+    calls = []
+    active = {"Loans": 0}
+    overlap = []
+
+    def commit_fn(table_name, data, execution_ids):
+        if table_name == "Loans":
+            active["Loans"] += 1
+            overlap.append(active["Loans"])
+            time.sleep(0.05)
+            active["Loans"] -= 1
+        calls.append((table_name, execution_ids))
+        return True
+
+    coalescer = CommitCoalescer(commit_fn, target_rows=1, max_latency_seconds=60, max_writers=4)
+    for run in ("run-1", "run-2", "run-3"):
+        coalescer.add("Loans", pd.DataFrame({"id": [1]}), run)
+        coalescer.add("Cities", pd.DataFrame({"id": [1]}), run)
+    coalescer.close()
+
+    assert [ids for name, ids in calls if name == "Loans"] == [["run-1"], ["run-2"], ["run-3"]]
+    assert max(overlap) == 1
+    assert coalescer.stats["commits"] == 6
+
+
+def test_coalescer_commits_dictionary_and_plain_text_of_the_same_column():
+    calls = []
+
+    def commit_fn(table_name, data, execution_ids):
+        calls.append(data)
+        return True
+
+    coalescer = CommitCoalescer(commit_fn, target_rows=10**9, max_latency_seconds=60)
+    coalescer.add("Loans", pd.DataFrame({"id": [1, 2], "status": pd.Categorical(["A", "B"])}), "run-1")
+    coalescer.add("Loans", pd.DataFrame({"id": [3, 4], "status": ["C", None]}), "run-2")
+    coalescer.add("Loans", pd.DataFrame({"id": [5], "status": pd.Categorical(["A"])}), "run-3")
+    results = coalescer.close()
+
+    assert results == [("Loans", 5, True)]
+    assert calls[0].column("status").to_pylist() == ["A", "B", "C", None, "A"]
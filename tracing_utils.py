@@ -0,0 +1,177 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logger_utils import log
+
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    Unidad de trabajo medida (proyecto, batch, partner, tabla, página, commit, ...).
+
+    Hereda de su span padre el `trace_id` y el `execution_id`, así todos los spans de una corrida
+    quedan asociados a su id de ejecución aunque corran en otros hilos.
+    """
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "execution_id", "attributes",
+                 "start", "end", "status", "thread_id", "thread_name", "_token")
+
+    def __init__(self, name, parent=None, execution_id=None, attributes=None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.execution_id = execution_id if execution_id is not None else (parent.execution_id if parent else None)
+        self.trace_id = parent.trace_id if parent else str(self.execution_id or uuid.uuid4().hex)
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.end = None
+        self.status = "ok"
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self._token = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return {
+            "name": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "execution_id": self.execution_id, "start": self.start, "duration": round(self.duration, 6),
+            "status": self.status, "thread": self.thread_name, "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """
+    Registro de spans de la sesión. Deshabilitado por defecto: `span` no crea nada hasta que se
+    llama a `enable`, así el costo en las rutas calientes es una sola verificación.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def start_span(self, name, execution_id=None, **attributes):
+        """Inicia un span hijo del span actual y lo activa en el hilo. Cerrar con `end_span`."""
+        if not self.enabled:
+            return None
+        span = Span(name, _current_span.get(), execution_id, {k: _jsonable(v) for k, v in attributes.items()})
+        span._token = _current_span.set(span)
+        return span
+
+    def end_span(self, span, error=None):
+        if span is None:
+            return
+        span.end = time.time()
+        if error is not None:
+            span.status = "error"
+            span.attributes["error"] = str(error)
+        try:
+            _current_span.reset(span._token)
+        except ValueError:
+            # Cerrado desde otro contexto (ej. en un hilo distinto al que lo inició)
+            pass
+        with self._lock:
+            self._spans.append(span)
+
+    @contextmanager
+    def span(self, name, execution_id=None, **attributes):
+        """Span del bloque; si el bloque lanza una excepción el span queda con status 'error'."""
+        span = self.start_span(name, execution_id, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, error=e)
+            span = None
+            raise
+        finally:
+            self.end_span(span)
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+
+    def export_jsonl(self, path):
+        """Una línea JSON por span, ordenados por inicio."""
+        _write_lines(path, (json.dumps(span.to_dict(), default=str) for span in sorted(self.spans(), key=lambda s: s.start)))
+        return path
+
+    def export_chrome_trace(self, path):
+        """Formato Trace Event de Chrome (chrome://tracing, Perfetto o speedscope) para ver flame charts."""
+        events = []
+        for span in sorted(self.spans(), key=lambda s: s.start):
+            events.append({
+                "name": span.name, "cat": span.execution_id or "", "ph": "X", "pid": 1, "tid": span.thread_id,
+                "ts": int(span.start * 1e6), "dur": int(span.duration * 1e6),
+                "args": {**span.attributes, "status": span.status, "span_id": span.span_id, "parent_id": span.parent_id},
+            })
+        threads = {span.thread_id: span.thread_name for span in self.spans()}
+        events.extend({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}} for tid, name in threads.items())
+        _write_lines(path, [json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str)])
+        return path
+
+
+def _jsonable(value):
+    # Escalares de numpy (idPartner int64, etc.) a tipos nativos
+    return value.item() if hasattr(value, "item") else value
+
+
+def _write_lines(path, lines):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(line + "\n")
+    os.replace(tmp_path, path)
+
+
+# Tracer de la sesión, compartido por todos los módulos
+tracer = Tracer()
+span = tracer.span
+start_span = tracer.start_span
+end_span = tracer.end_span
+
+
+def in_current_context(fn):
+    """
+    Envuelve `fn` para que corra con una copia del contexto actual (span activo y contexto de logs).
+    Se usa al entregar trabajo a un ThreadPoolExecutor: los hilos del pool no heredan el contexto.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def export_trace(trace_dir, project, process_execution_id, chrome=False):
+    """
+    Exporta los spans de la corrida a `trace_{project}_{id}.jsonl` y, con `chrome=True`, a
+    `trace_{project}_{id}.chrome.json`. Retorna la ruta del JSONL, o None si falla.
+    """
+    try:
+        base = os.path.join(trace_dir, f"trace_{project}_{process_execution_id}")
+        path = tracer.export_jsonl(f"{base}.jsonl")
+        if chrome:
+            tracer.export_chrome_trace(f"{base}.chrome.json")
+        log(f"🧭 Trace de la corrida: {len(tracer.spans())} spans en {path}", level="info")
+        return path
+    except Exception as e:
+        log(f"❌ Error al exportar el trace de la corrida: {e}", level="error")
+        return None
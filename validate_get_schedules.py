@@ -24,6 +24,13 @@ OPTIONAL_COLUMNS = [
     "enabled",
     "platform_name",
     "schem",
+    "write_mode",
+    "merge_prune_watermark",
+    "sort_within_files",
+    "target_file_size_mb",
+    "row_group_rows",
+    "stats_columns",
+    "write_profile",
 ]
 
 
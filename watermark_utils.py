@@ -1,111 +1,336 @@
+import functools
+import threading
+import numpy as np
 import pandas as pd
 from logger_utils import log
-from format_utils import format_datetime_for_sqlserver
 
-def get_all_last_watermarks(resource_project, _conn_mgr_fabric, _environment, _log_table):
+
+WATERMARK_TYPES = ("DATETIME", "INT", "ROWVERSION")
+
+
+@functools.total_ordering
+class Watermark:
     """
-    Obtiene todos los registros de la tabla DataOn.LastWatermarkState y los devuelve como un DataFrame.
-    Retorna None en los siguientes casos:
-    1. Si no hay resultados en la consulta
-    2. Si hay un error en la ejecución
-    3. Si el DataFrame está vacío después de filtrar
+    Valor de watermark tipado: fecha (precisión completa), entero o rowversion (8 bytes).
+
+    Se parsea una sola vez al leerlo y se compara de forma nativa (sin pasar por texto). Para
+    consultas se entrega con `to_param` como parámetro del driver y `str` lo serializa una sola
+    vez como 'YYYY-MM-DD HH:MM:SS.mmm' (fechas), número (enteros) o '0x...' (rowversion), que es
+    el formato que se guarda en DataOn.IngestaLog. Las fechas no se truncan al parsear: una
+    columna `datetime` guarda pasos de 1/300 s (ej. .123333) y un límite truncado dejaría fuera
+    del rango la fila con ese valor.
+
+    Se compara también contra valores crudos del mismo tipo (pd.Timestamp, int, bytes o su texto).
+
+    Args:
+        kind (str): 'DATETIME', 'INT' o 'ROWVERSION'.
+        value: pd.Timestamp (sin zona), int o bytes.
     """
-    try:
-        query = f"""
+
+    __slots__ = ("kind", "value", "_text")
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+        self._text = None
+
+    @classmethod
+    def parse(cls, raw, kind=None):
+        """
+        Convierte un valor crudo (del driver, de pandas o texto) en `Watermark`. Sin `kind` el
+        tipo se infiere del valor. Retorna None si viene vacío o no se puede parsear.
+        """
+        if isinstance(raw, Watermark):
+            return raw if kind is None or raw.kind == kind else cls.parse(raw.value, kind)
+        if raw is None or (not isinstance(raw, (str, bytes, bytearray)) and pd.isna(raw)):
+            return None
+        if isinstance(raw, str):
+            raw = raw.strip()
+            if raw == "":
+                return None
+
+        kind = (kind or cls._infer_kind(raw)).upper()
+        try:
+            if kind == "INT":
+                return cls(kind, int(raw))
+            if kind == "ROWVERSION":
+                if isinstance(raw, (bytes, bytearray)):
+                    return cls(kind, bytes(raw).rjust(8, b"\x00"))
+                number = int(raw, 16) if isinstance(raw, str) else int(raw)
+                return cls(kind, number.to_bytes(8, "big"))
+            if kind == "DATETIME":
+                parsed = pd.Timestamp(raw)
+                if parsed.tzinfo is not None:
+                    parsed = parsed.tz_convert(None)
+                return cls(kind, parsed)
+        except (ValueError, TypeError, OverflowError):
+            return None
+        raise ValueError(f"❌ Tipo de watermark no soportado: {kind}")
+
+    @staticmethod
+    def _infer_kind(raw):
+        if isinstance(raw, (bytes, bytearray)):
+            return "ROWVERSION"
+        if isinstance(raw, (int, np.integer)) and not isinstance(raw, bool):
+            return "INT"
+        if isinstance(raw, str):
+            if raw.lower().startswith("0x"):
+                return "ROWVERSION"
+            if raw.lstrip("-").isdigit():
+                return "INT"
+        return "DATETIME"
+
+    @classmethod
+    def default(cls, kind):
+        """Watermark inicial cuando una tabla no tiene historial (1990-01-01, 0 o 0x00...)."""
+        kind = kind.upper()
+        if kind == "DATETIME":
+            return cls(kind, pd.Timestamp("1990-01-01 00:00:00"))
+        if kind == "INT":
+            return cls(kind, 0)
+        if kind == "ROWVERSION":
+            return cls(kind, bytes(8))
+        raise ValueError(f"❌ Tipo de watermark no soportado: {kind}")
+
+    def to_param(self):
+        """
+        Valor para enviar como parámetro de la consulta (datetime, int o bytes). Las fechas van
+        con microsegundos (la precisión del driver); usar `sql_placeholder` para compararlas con
+        el tipo de la columna.
+        """
+        if self.kind == "DATETIME":
+            return self.value.floor("us").to_pydatetime()
+        return self.value
+
+    def __str__(self):
+        if self._text is None:
+            if self.kind == "DATETIME":
+                self._text = self.value.strftime("%Y-%m-%d %H:%M:%S.") + f"{self.value.microsecond // 1000:03d}"
+            elif self.kind == "ROWVERSION":
+                self._text = "0x" + self.value.hex().upper()
+            else:
+                self._text = str(self.value)
+        return self._text
+
+    def __repr__(self):
+        return f"Watermark({self.kind}, {self})"
+
+    def _coerce(self, other):
+        if isinstance(other, Watermark):
+            return other if other.kind == self.kind else None
+        return Watermark.parse(other, self.kind)
+
+    def __eq__(self, other):
+        other = self._coerce(other)
+        return other is not None and self.value == other.value
+
+    def __lt__(self, other):
+        coerced = self._coerce(other)
+        if coerced is None:
+            return NotImplemented
+        return self.value < coerced.value
+
+    def __hash__(self):
+        return hash((self.kind, self.value))
+
+
+# Tipos de fecha de SQL Server a los que se convierte el parámetro antes de comparar
+SQL_DATETIME_TYPES = ("date", "datetime", "datetime2", "smalldatetime", "datetimeoffset")
+
+
+def sql_placeholder(sql_type=None):
+    """
+    Marcador del parámetro de watermark en la consulta. Para columnas de fecha se convierte al
+    tipo de la columna (`CAST(? AS datetime)`): el driver envía datetime2 y, sin la conversión,
+    una fila `datetime` en .1233333 queda por encima del límite .123333 y no entra en `<= ?`.
+    """
+    if sql_type and str(sql_type).lower() in SQL_DATETIME_TYPES:
+        return f"CAST(? AS {str(sql_type).lower()})"
+    return "?"
+
+
+def parse_watermark(raw):
+    """
+    Convierte un watermark crudo (texto del CONVERT estilo 121, valor del driver o Watermark) a
+    `Watermark`, infiriendo su tipo. Retorna None si viene vacío o no se puede parsear.
+    """
+    return Watermark.parse(raw)
+
+
+class WatermarkIndex:
+    """
+    Índice de watermarks por (idPartner, TableName, project) con el máximo ya tipado.
+
+    Reemplaza el DataFrame con MultiIndex: cada consulta es un acceso O(1) a un dict en lugar
+    de filtrar con máscaras y ordenar. Las lecturas no toman lock (un `dict.get` es atómico) y
+    las actualizaciones se serializan, así el índice se comparte entre los hilos de extracción.
+    """
+
+    def __init__(self):
+        self._values = {}  # {(idPartner, TableName, project): Watermark}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Construye el índice desde tuplas (idPartner, TableName, project, valor_crudo)."""
+        index = cls()
+        for id_partner, table_name, project, raw in rows:
+            index.update(id_partner, table_name, project, raw)
+        return index
+
+    @classmethod
+    def from_dataframe(cls, df, value_column="currentWaterMarkValue"):
+        """Construye el índice desde el resultado de DataOn.LastWatermarkState (con o sin índice)."""
+        df = df.reset_index() if isinstance(df.index, pd.MultiIndex) else df
+        return cls.from_rows(zip(df["idPartner"], df["TableName"], df["project"], df[value_column]))
+
+    @staticmethod
+    def _key(id_partner, table_name, project):
+        return (int(id_partner), table_name, project)
+
+    def update(self, id_partner, table_name, project, raw):
+        """Registra un watermark; sólo reemplaza el valor guardado si el nuevo es mayor."""
+        value = parse_watermark(raw)
+        if value is None:
+            return
+        key = self._key(id_partner, table_name, project)
+        with self._lock:
+            current = self._values.get(key)
+            if current is None or current.kind != value.kind or value > current:
+                self._values[key] = value
+
+    def get(self, id_partner, table_name, project):
+        """Retorna el watermark máximo (`Watermark`), o None si no existe."""
+        return self._values.get(self._key(id_partner, table_name, project))
+
+    def items(self):
+        """Retorna una copia de los pares ((idPartner, TableName, project), valor)."""
+        with self._lock:
+            return list(self._values.items())
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def empty(self):
+        return not self._values
+
+def _build_last_watermarks_query(_source_table, _watermark_column):
+    """
+    Consulta del último watermark por (idPartner, TableName): el MAX se resuelve en el servidor,
+    así el resultado tiene el tamaño del catálogo y no el del historial de ejecuciones. El
+    proyecto y el ambiente se envían como parámetros (`?`).
+    """
+    return f"""
             SELECT 
                 project,
                 idPartner,
                 TableName,
-                environment,
-                Status,
-                is_incremental,
-                CAST(lastWatermarkValue AS varchar(30)) AS lastWatermarkValue,
-                CAST(currentWaterMarkValue AS varchar(30)) AS currentWaterMarkValue
-            FROM {_log_table}
+                CONVERT(varchar(30), MAX({_watermark_column}), 121) AS currentWaterMarkValue
+            FROM {_source_table}
             WHERE Status = 'Success'
-              AND project = '{resource_project}'
+              AND project = ?
               AND is_incremental = 1
-              AND environment = '{_environment}'
+              AND environment = ?
+            GROUP BY project, idPartner, TableName
         """
-        df_watermarks = pd.read_sql(query, _conn_mgr_fabric.get_sql_connection())
+
+
+def get_all_last_watermarks(resource_project, _conn_mgr_fabric, _environment, _log_table):
+    """
+    Obtiene el último watermark por (idPartner, TableName) de la tabla DataOn.LastWatermarkState y
+    los devuelve como un `WatermarkIndex` (máximo tipado por idPartner, TableName y project).
+
+    Retorna None en los siguientes casos:
+    1. Si no hay resultados en la consulta
+    2. Si hay un error en la ejecución
+    3. Si el DataFrame está vacío después de filtrar
+    """
+    try:
+        query = _build_last_watermarks_query(_log_table, "currentWaterMarkValue")
+        with _conn_mgr_fabric.get_sql_connection() as conn:
+            df_watermarks = pd.read_sql(query, conn, params=[resource_project, _environment])
         
         # Si no hay resultados, retornar None
         if df_watermarks.empty:
             log(f"⚠️ No se encontraron watermarks en {_log_table} para project={resource_project}, environment={_environment}", level="warning")
             return None
 
-        # Agregar índices para optimizar búsquedas
-        df_watermarks.set_index(['idPartner', 'TableName', 'project'], inplace=True)
-        df_watermarks.sort_index(inplace=True)
+        # Indexar por (idPartner, TableName, project) con el valor ya tipado
+        watermark_index = WatermarkIndex.from_dataframe(df_watermarks)
         
         # Verificar si hay registros después de filtrar e indexar
-        if len(df_watermarks) == 0:
+        if watermark_index.empty:
             log(f"⚠️ No hay watermarks válidos después de filtrar", level="warning")
             return None
             
-        log(f"✅ Se obtuvieron {len(df_watermarks)} registros de watermarks", level="info")
-        return df_watermarks
+        log(f"✅ Se obtuvieron {len(watermark_index)} watermarks", level="info")
+        return watermark_index
 
     except Exception as e:
         log(f"❌ Error al obtener todos los watermarks: {str(e)}", level="error")
         return None
 
+
+def get_all_last_watermarks_from_log(resource_project, _conn_mgr_fabric, _environment):
+    """
+    Obtiene el último watermark por (idPartner, TableName) desde DataOn.IngestaLog en una sola
+    consulta agrupada. Es el respaldo cuando no hay estado en DataOn.LastWatermarkState y evita
+    una consulta TOP 1 por tabla en `get_last_watermark`.
+    """
+    try:
+        query = _build_last_watermarks_query("DataOn.IngestaLog", "CurrentWaterMark")
+        with _conn_mgr_fabric.get_sql_connection() as conn:
+            df_watermarks = pd.read_sql(query, conn, params=[resource_project, _environment])
+        watermark_index = WatermarkIndex.from_dataframe(df_watermarks)
+        log(f"✅ Se obtuvieron {len(watermark_index)} watermarks desde DataOn.IngestaLog", level="info")
+        return watermark_index
+
+    except Exception as e:
+        log(f"❌ Error al obtener los watermarks desde DataOn.IngestaLog: {str(e)}", level="error")
+        return None
+
+
 def get_last_watermark_from_cache(_project, df_watermarks, _id_partner, _table_name, _watermark_type):
     """
-    Obtiene el último watermark para una tabla específica desde el DataFrame cacheado.
-    Siempre retorna un valor válido (nunca None):
-    - Para DATETIME: '1990-01-01 00:00:00' formateado
+    Obtiene el último watermark para una tabla específica desde el `WatermarkIndex` cacheado.
+    Siempre retorna un `Watermark` válido (nunca None); por defecto:
+    - Para DATETIME: 1990-01-01 00:00:00.000
     - Para INT: 0
+    - Para ROWVERSION: 0x0000000000000000
     """
+    watermark_type = str(_watermark_type).upper()
     try:
-        # Valor por defecto según el tipo
-        default_value = format_datetime_for_sqlserver('1990-01-01 00:00:00') if _watermark_type.upper() == "DATETIME" else 0
-
         # Validar el tipo de watermark
-        if _watermark_type.upper() not in ["DATETIME", "INT"]:
+        if watermark_type not in WATERMARK_TYPES:
             log(f"❌ Tipo de watermark no soportado: {_watermark_type}", level="error")
-            return default_value
+            return None
+
+        # Valor por defecto según el tipo
+        default_value = Watermark.default(watermark_type)
 
         # Verificar si df_watermarks es None o está vacío
         if df_watermarks is None or df_watermarks.empty:
             log(f"⚠️ DataFrame de watermarks vacío o None, usando valor por defecto", level="warning")
             return default_value
 
-        # Intentar obtener el registro específico usando los índices
-        try:
-            # Filtrar usando valores del índice con los tres componentes
-            mask = (df_watermarks.index.get_level_values('idPartner') == int(_id_partner)) & \
-                  (df_watermarks.index.get_level_values('TableName') == _table_name) & \
-                  (df_watermarks.index.get_level_values('project') == _project)
-            watermark_rows = df_watermarks[mask]
-            
-            if watermark_rows.empty:
-                log(f"⚠️ No se encontraron watermarks para partner={_id_partner}, tabla={_table_name}, del proyecto={_project}, usando valor por defecto", level="warning")
-                return default_value
-                
-            if len(watermark_rows) == 1:
-                last_watermark_raw = watermark_rows['currentWaterMarkValue'].iloc[0]
-                log(f"✅ Watermark encontrado para partner={_id_partner}, tabla={_table_name}", level="info")
-            else:
-                # Si hay múltiples registros, tomar el más reciente
-                last_watermark_raw = watermark_rows.sort_values('currentWaterMarkValue', ascending=False)['currentWaterMarkValue'].iloc[0]
-                log(f"✅ Se encontraron múltiples watermarks, usando el más reciente para partner={_id_partner}, tabla={_table_name}", level="info")
-
-            # Verificar si el valor es None o vacío
-            if pd.isna(last_watermark_raw) or last_watermark_raw == '' or last_watermark_raw is None:
-                log(f"⚠️ Watermark encontrado es nulo o vacío, usando valor por defecto", level="warning")
-                return default_value
-
-            # Procesar el valor según el tipo
-            if _watermark_type.upper() == "DATETIME":
-                return format_datetime_for_sqlserver(last_watermark_raw)
-            else:  # INT
-                return int(last_watermark_raw)
-
-        except (KeyError, IndexError):
-            log(f"⚠️ No se encontró watermark para partner={_id_partner}, tabla={_table_name}, usando valor por defecto", level="warning")
+        # Compatibilidad: un DataFrame con MultiIndex se indexa antes de consultar
+        if isinstance(df_watermarks, pd.DataFrame):
+            df_watermarks = WatermarkIndex.from_dataframe(df_watermarks)
+
+        last_watermark = df_watermarks.get(_id_partner, _table_name, _project)
+        if last_watermark is None:
+            log(f"⚠️ No se encontraron watermarks para partner={_id_partner}, tabla={_table_name}, del proyecto={_project}, usando valor por defecto", level="warning")
+            return default_value
+
+        log(f"✅ Watermark encontrado para partner={_id_partner}, tabla={_table_name}", level="info")
+
+        # El índice infiere el tipo desde el texto; debe coincidir con el tipo configurado
+        if last_watermark.kind != watermark_type:
+            log(f"⚠️ Watermark {last_watermark} no es de tipo {watermark_type} para partner={_id_partner}, tabla={_table_name}, usando valor por defecto", level="warning")
             return default_value
+        return last_watermark
 
     except Exception as e:
         log(f"❌ Error al obtener el last_watermark desde cache: {str(e)}", level="error")
-        return default_value  # Retorna el valor por defecto en lugar de None
+        return Watermark.default(watermark_type)  # Retorna el valor por defecto en lugar de None
@@ -0,0 +1,267 @@
+import time
+import threading
+import queue
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+import pandas as pd
+import pyarrow as pa
+from logger_utils import log
+from metrics_utils import metrics
+
+
+_STOP = object()
+
+
+class CommitCoalescer:
+    """
+    Agrupa en un solo commit de Delta los datos limpios de varios partners y batches por tabla.
+
+    Cada `add` deja los datos (convertidos a Arrow) en el buffer de su tabla; la tabla se escribe
+    cuando alcanza `target_rows` filas, `target_bytes` bytes o cuando su dato más antiguo lleva
+    `max_latency_seconds` esperando. `close` escribe lo pendiente.
+
+    Con `max_writers` > 1 los commits de tablas distintas corren en paralelo en un pool acotado
+    (cada tabla es un log de Delta independiente y la escritura pasa casi todo el tiempo esperando
+    I/O). Los commits de una misma tabla se encadenan: cada uno espera al anterior, de modo que
+    se aplican en orden y nunca compiten entre sí.
+
+    Con `staging` (`StagingArea`) cada entrega se persiste en disco antes de quedar en el buffer y
+    se marca como confirmada sólo después de su commit, así una corrida posterior puede escribir
+    lo que quedó pendiente (ver `staging_utils.recover_staged`).
+
+    Args:
+        commit_fn: callable(table_name, pa.Table, process_execution_ids) -> bool que hace el commit.
+        target_rows (int): filas acumuladas por tabla que disparan el commit.
+        target_bytes (int): bytes Arrow acumulados por tabla que disparan el commit.
+        max_latency_seconds (float): tiempo máximo que un dato espera en el buffer.
+        max_writers (int): commits simultáneos de tablas distintas (1 = commits en el hilo llamador).
+        staging (StagingArea, optional): área de staging donde persistir las entregas hasta su commit.
+    """
+
+    def __init__(self, commit_fn, target_rows=1000000, target_bytes=256 * 1024 * 1024, max_latency_seconds=300, max_writers=1, staging=None):
+        self.commit_fn = commit_fn
+        self.target_rows = target_rows
+        self.target_bytes = target_bytes
+        self.max_latency_seconds = max_latency_seconds
+        self.staging = staging
+        self.results = []
+        self.stats = {"submissions": 0, "commits": 0, "commits_saved": 0, "rows": 0, "bytes": 0}
+        self._buffers = defaultdict(list)  # {table_name: [(pa.Table, process_execution_id, staged_chunk), ...]}
+        self._buffer_rows = defaultdict(int)
+        self._buffer_bytes = defaultdict(int)
+        self._buffer_since = {}
+        self._lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self._executor = None
+        self._last_commit = {}  # {table_name: Future del último commit encolado}
+        if max_writers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=max_writers, thread_name_prefix="DeltaWriter")
+            # Acota los commits encolados para no retener en memoria más datos de los que se pueden escribir
+            self._slots = threading.BoundedSemaphore(max_writers * 2)
+
+    def add(self, table_name, data, process_execution_id, staged_chunk=None):
+        """
+        Agrega datos limpios (DataFrame o pa.Table) al buffer de la tabla y hace commit si corresponde.
+
+        `staged_chunk` identifica datos que ya están en staging (recuperados de una corrida anterior).
+        """
+        if data is None or len(data) == 0:
+            return
+        if isinstance(data, pd.DataFrame):
+            data = pa.Table.from_pandas(data, preserve_index=False)
+        data = data.replace_schema_metadata(None)
+        if self.staging is not None and staged_chunk is None:
+            staged_chunk = self.staging.stage(table_name, data, process_execution_id)
+
+        with self._lock:
+            self._buffers[table_name].append((data, process_execution_id, staged_chunk))
+            self._buffer_rows[table_name] += data.num_rows
+            self._buffer_bytes[table_name] += data.nbytes
+            self._buffer_since.setdefault(table_name, time.monotonic())
+            self.stats["submissions"] += 1
+            metrics.set_gauge("buffered_rows", self._buffer_rows[table_name], queue="coalescer", table=table_name)
+
+            if (self._buffer_rows[table_name] >= self.target_rows
+                    or self._buffer_bytes[table_name] >= self.target_bytes):
+                self.flush(table_name)
+        self.flush_due()
+
+    def flush_due(self):
+        """Hace commit de las tablas cuyo dato más antiguo superó `max_latency_seconds`."""
+        now = time.monotonic()
+        with self._lock:
+            for table_name in list(self._buffers):
+                if now - self._buffer_since[table_name] >= self.max_latency_seconds:
+                    self.flush(table_name)
+
+    def flush(self, table_name=None):
+        """Hace commit de una tabla (o de todas si `table_name` es None)."""
+        with self._lock:
+            table_names = [table_name] if table_name is not None else list(self._buffers)
+            for name in table_names:
+                self._commit(name)
+
+    def wait_commits(self):
+        """Espera a que terminen los commits ya encolados en el pool de writers."""
+        with self._lock:
+            pending = list(self._last_commit.values())
+        wait(pending)
+
+    def close(self):
+        """Hace commit de todo lo pendiente y retorna los resultados [(tabla, filas, ok), ...]."""
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._last_commit.clear()
+        log(f"📦 Coalescer: {self.stats['submissions']} entregas en {self.stats['commits']} commits "
+            f"({self.stats['commits_saved']} commits ahorrados)", level="info")
+        return self.results
+
+    def _commit(self, table_name):
+        entries = self._buffers.pop(table_name, [])
+        rows = self._buffer_rows.pop(table_name, 0)
+        metrics.set_gauge("buffered_rows", 0, queue="coalescer", table=table_name)
+        size = self._buffer_bytes.pop(table_name, 0)
+        self._buffer_since.pop(table_name, None)
+        if not entries:
+            return
+
+        if self._executor is None:
+            self._run_commit(table_name, entries, rows, size)
+            return
+
+        # Se llama con self._lock tomado; los writers no lo necesitan, así que bloquear aquí es seguro
+        with metrics.timer("pool_wait_seconds", pool="delta_writer", table=table_name):
+            self._slots.acquire()
+        previous = self._last_commit.get(table_name)
+        self._last_commit[table_name] = self._executor.submit(self._run_commit, table_name, entries, rows, size, previous)
+
+    def _run_commit(self, table_name, entries, rows, size, previous=None):
+        try:
+            if previous is not None:
+                # Serializa los commits de la misma tabla en el orden en que se encolaron
+                wait([previous])
+
+            process_execution_ids = list(dict.fromkeys(execution_id for _, execution_id, _ in entries))
+            log(f"✍️ Commit de {rows} filas ({size / 1024 / 1024:.1f} MB) en {table_name} ({len(entries)} entregas)", level="info")
+            try:
+                data = pa.concat_tables(_unify_dictionary_columns([data for data, _, _ in entries]), promote_options="permissive")
+                ok = self.commit_fn(table_name, data, process_execution_ids)
+            except Exception as e:
+                log(f"❌ Error en el commit de {table_name}: {e}", level="error")
+                ok = False
+
+            staged_chunks = [chunk for _, _, chunk in entries if chunk is not None]
+            if ok and staged_chunks:
+                try:
+                    self.staging.mark_committed(staged_chunks)
+                except Exception as e:
+                    log(f"⚠️ No se pudo actualizar el staging de {table_name}: {e}", level="warning")
+
+            with self._stats_lock:
+                self.stats["commits"] += 1
+                self.stats["commits_saved"] += len(entries) - 1
+                self.stats["rows"] += rows
+                self.stats["bytes"] += size
+                self.results.append((table_name, rows, ok))
+        finally:
+            if self._executor is not None:
+                self._slots.release()
+
+
+def _unify_dictionary_columns(tables):
+    """
+    Decodifica a su tipo de valor las columnas que vienen como diccionario en unas entregas y con
+    otro tipo en otras (ej. `status` codificado para un partner y texto plano para otro):
+    `concat_tables` no promueve entre diccionario y valores. Las columnas con el mismo tipo en
+    todas las entregas conservan la codificación.
+    """
+    types = defaultdict(set)
+    for table in tables:
+        for field in table.schema:
+            types[field.name].add(field.type)
+    mixed = {name for name, column_types in types.items()
+             if len(column_types) > 1 and any(pa.types.is_dictionary(t) for t in column_types)}
+    if not mixed:
+        return tables
+
+    unified = []
+    for table in tables:
+        for i, field in enumerate(table.schema):
+            if field.name in mixed and pa.types.is_dictionary(field.type):
+                table = table.set_column(i, pa.field(field.name, field.type.value_type, field.nullable),
+                                         table.column(i).cast(field.type.value_type))
+        unified.append(table)
+    return unified
+
+class PipelinedTableWriter:
+    """
+    Writer en segundo plano para solapar la extracción con la escritura.
+
+    Los resultados de cada partner se encolan con `submit` apenas termina su future. Cada tabla
+    tiene su propia cola y su propio hilo escritor (creados en la primera entrega), que limpia los
+    datos con `prepare_fn` y los entrega a un `CommitCoalescer`, que decide cuándo hacer commit;
+    así una tabla lenta de limpiar no detiene a las demás. `close` hace commit de lo pendiente.
+
+    Args:
+        prepare_fn: callable(table_name, df, process_execution_id) -> datos limpios listos para
+            escribir, o None si la preparación falló.
+        coalescer (CommitCoalescer): agrupador de commits por tabla.
+        max_pending (int): máximo de entregas encoladas por tabla; `submit` se bloquea al
+            alcanzarlo para no acumular memoria si la escritura es más lenta que la extracción.
+    """
+
+    def __init__(self, prepare_fn, coalescer, max_pending=200):
+        self.prepare_fn = prepare_fn
+        self.coalescer = coalescer
+        self.max_pending = max_pending
+        self.results = []
+        self._lanes = {}  # {table_name: (queue.Queue, threading.Thread)}
+        self._lock = threading.Lock()
+
+    def submit(self, table_name, df, process_execution_id):
+        """Encola los datos de una tabla para su escritura."""
+        if df is None or df.empty:
+            return
+        lane = self._lane(table_name)
+        lane.put((df, process_execution_id))
+        metrics.set_gauge("queue_depth", lane.qsize(), queue="pipelined_writer", table=table_name)
+
+    def close(self):
+        """Hace commit de todo lo pendiente y espera a que terminen los hilos escritores."""
+        with self._lock:
+            lanes = list(self._lanes.values())
+        for lane, _ in lanes:
+            lane.put(_STOP)
+        for _, thread in lanes:
+            thread.join()
+        return self.results + self.coalescer.close()
+
+    def _lane(self, table_name):
+        with self._lock:
+            if table_name not in self._lanes:
+                lane = queue.Queue(maxsize=self.max_pending)
+                thread = threading.Thread(target=self._run, args=(table_name, lane),
+                                          name=f"PipelinedTableWriter-{table_name}", daemon=True)
+                self._lanes[table_name] = (lane, thread)
+                thread.start()
+            return self._lanes[table_name][0]
+
+    def _run(self, table_name, lane):
+        poll_seconds = max(0.1, min(1.0, self.coalescer.max_latency_seconds / 10))
+        while True:
+            try:
+                item = lane.get(timeout=poll_seconds)
+            except queue.Empty:
+                self.coalescer.flush_due()
+                continue
+
+            if item is _STOP:
+                break
+
+            df, process_execution_id = item
+            try:
+                self.coalescer.add(table_name, self.prepare_fn(table_name, df, process_execution_id), process_execution_id)
+            except Exception as e:
+                log(f"❌ Error en el writer al preparar {table_name}: {e}", level="error")
+                self.results.append((table_name, len(df), False))